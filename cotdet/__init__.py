@@ -5,9 +5,25 @@ from . import modeling
 from .config import add_maskformer2_config
 # dataset loading
 from .data.dataset_mappers.coco_tasks_mapper import COCOTaskDatasetMapper
+from .data.bucketed_sampler import build_bucketed_test_loader
+from .data.tar_dataset import TarShardDataset
+from .data.stage_timer import DataStageTimer, DataStageTimingHook
+# checkpointing
+from .checkpoint import AsyncCheckpointer
 # models
 from .model import CoTDet
+from .distillation import CoTDetDistiller
+# deployment
+from .export import CoTDetDeployModel
+from .tiling import CoTDetWithTiling
+from .streaming import CoTDetStream
 # evaluation
 from .evaluation.instance_evaluation import InstanceSegEvaluator
+from .evaluation.multi_task_evaluation import MultiTaskEvaluator
+from .evaluation.dataset_order_evaluation import DatasetOrderEvaluator
+from .evaluation.async_evaluation import AsyncEvalHook
 # util
 from .utils import box_ops, misc, utils
+from .utils.module_timer import ModuleTimer, ModuleTimingHook, instrument_cotdet
+from .utils.shape_cache import SHAPE_CACHE, ShapeCache
+from .utils.quantization import quantize_cotdet
@@ -0,0 +1,295 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import json
+import os
+import pickle
+import shutil
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from detectron2.checkpoint import DetectionCheckpointer
+
+__all__ = ["AsyncCheckpointer", "is_sharded_checkpoint", "load_sharded_checkpoint"]
+
+MANIFEST_VERSION = 1
+# offsets of the tensors in the shard files
+_ALIGNMENT = 64
+
+
+class _TensorRef:
+    """
+    Stands for a tensor in the pickled structure of a shard.
+    """
+
+    def __init__(self, offset, nbytes, dtype, shape):
+        self.offset = offset
+        self.nbytes = nbytes
+        self.dtype = dtype
+        self.shape = shape
+
+
+def _shard_name(key):
+    # e.g. "model.backbone", "trainer", "iteration"
+    return "".join(c if c.isalnum() or c in "._-" else "_" for c in key)
+
+
+def _split_shards(data):
+    """
+    Split the checkpoint dict into shards: the state dict of the model by top-level module,
+    every other entry on its own.
+    """
+    shards = OrderedDict()
+    for key, value in data.items():
+        if key != "model":
+            shards[key] = (key, None, value)
+            continue
+        for name, tensor in value.items():
+            prefix = name.split(".", 1)[0]
+            shard = shards.setdefault("model." + prefix, ("model", prefix, OrderedDict()))[2]
+            shard[name] = tensor
+    return shards
+
+
+def _write_shard(directory, name, obj):
+    """
+    Write the tensors of `obj` one after the other in "<name>.bin" and the rest of it,
+    where tensors are replaced by :class:`_TensorRef`, in "<name>.pkl".
+    """
+    with open(os.path.join(directory, name + ".bin"), "wb") as f:
+
+        def replace(x):
+            if isinstance(x, torch.Tensor):
+                data = x.detach().reshape(-1).view(torch.uint8).numpy()
+                offset = f.tell()
+                f.write(memoryview(data))
+                f.write(b"\0" * (-f.tell() % _ALIGNMENT))
+                return _TensorRef(offset, data.nbytes, str(x.dtype).split(".")[-1], tuple(x.shape))
+            if isinstance(x, dict):
+                ret = type(x)((k, replace(v)) for k, v in x.items())
+                if hasattr(x, "_metadata"):
+                    ret._metadata = x._metadata
+                return ret
+            if isinstance(x, (list, tuple)):
+                return type(x)(replace(v) for v in x)
+            return x
+
+        structure = replace(obj)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(os.path.join(directory, name + ".pkl"), "wb") as f:
+        pickle.dump(structure, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_shard(directory, name):
+    """
+    Inverse of :func:`_write_shard`. Tensors are memory-mapped from "<name>.bin": their data is
+    read from the disk when they are first used, e.g. by `load_state_dict`.
+    """
+    with open(os.path.join(directory, name + ".pkl"), "rb") as f:
+        structure = pickle.load(f)
+    path = os.path.join(directory, name + ".bin")
+    # copy-on-write, so that the tensors are writable but the file is never modified
+    data = np.memmap(path, dtype=np.uint8, mode="c") if os.path.getsize(path) > 0 else None
+
+    def restore(x):
+        if isinstance(x, _TensorRef):
+            dtype = getattr(torch, x.dtype)
+            if x.nbytes == 0:
+                return torch.empty(x.shape, dtype=dtype)
+            buffer = torch.from_numpy(data[x.offset : x.offset + x.nbytes])
+            return buffer.view(dtype).reshape(x.shape)
+        if isinstance(x, dict):
+            ret = type(x)((k, restore(v)) for k, v in x.items())
+            if hasattr(x, "_metadata"):
+                ret._metadata = x._metadata
+            return ret
+        if isinstance(x, (list, tuple)):
+            return type(x)(restore(v) for v in x)
+        return x
+
+    return restore(structure)
+
+
+def is_sharded_checkpoint(path):
+    """
+    Whether `path` is the manifest of a checkpoint written by :class:`AsyncCheckpointer`.
+    The manifest is a json file, while `torch.save` writes a zip or pickle file.
+    """
+    with open(path, "rb") as f:
+        return f.read(1) == b"{"
+
+
+def load_sharded_checkpoint(path):
+    """
+    Load a checkpoint written by :class:`AsyncCheckpointer`.
+
+    Args:
+        path (str): path of the manifest.
+
+    Returns:
+        dict: the same dict as `torch.load` would return for a checkpoint of :class:`Checkpointer`.
+    """
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    assert manifest["version"] == MANIFEST_VERSION, manifest["version"]
+    directory = os.path.join(os.path.dirname(path), manifest["directory"])
+    data = {}
+    for shard in manifest["shards"]:
+        obj = _read_shard(directory, shard["name"])
+        if shard["prefix"] is None:
+            data[shard["key"]] = obj
+        else:
+            data.setdefault(shard["key"], OrderedDict()).update(obj)
+    return data
+
+
+class _ShardedPathManager:
+    """
+    Forwards to a PathManager, but removing the manifest of a sharded checkpoint also removes its
+    shards, e.g. when :class:`PeriodicCheckpointer` deletes the old checkpoints with `max_to_keep`.
+    """
+
+    def __init__(self, path_manager):
+        self._path_manager = path_manager
+
+    def __getattr__(self, name):
+        return getattr(self._path_manager, name)
+
+    def rm(self, path, **kwargs):
+        directory = None
+        if os.path.isfile(path) and is_sharded_checkpoint(path):
+            with open(path, "r") as f:
+                directory = json.load(f)["directory"]
+        self._path_manager.rm(path, **kwargs)
+        if directory is not None:
+            shutil.rmtree(os.path.join(os.path.dirname(path), directory), ignore_errors=True)
+
+
+class AsyncCheckpointer(DetectionCheckpointer):
+    """
+    Same as :class:`DetectionCheckpointer`, but :meth:`save` only copies the state to CPU
+    memory, and a background thread writes it to the disk, so that training does not wait.
+
+    A checkpoint "<name>.pth" is a json manifest listing the shards, one per top-level module
+    of the model and one per other checkpointable, stored in a directory next to it. The
+    manifest and "last_checkpoint" are only written once all shards are, with atomic renames,
+    so an interrupted write never replaces a complete checkpoint. Loading memory-maps the
+    shards. It can load regular checkpoints as well, and works with `resume_or_load`.
+
+    Only one write runs at a time: a save waits for the previous write to finish.
+    The checkpoints must be on a local file system. Deleting a manifest with `path_manager.rm`,
+    as :class:`PeriodicCheckpointer` does with `max_to_keep`, deletes its shards as well.
+    """
+
+    def __init__(self, model, save_dir="", *, save_to_disk=None, **checkpointables):
+        super().__init__(model, save_dir, save_to_disk=save_to_disk, **checkpointables)
+        self.path_manager = _ShardedPathManager(self.path_manager)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._pending_file = None
+        # CPU copies of the state, reused by the next saves
+        self._buffers = {}
+
+    def _snapshot(self, obj, path=()):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            buffer = self._buffers.get(path)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                # pinned memory makes the copies from the GPU asynchronous
+                buffer = torch.empty(
+                    obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda and torch.cuda.is_available()
+                )
+                self._buffers[path] = buffer
+            return buffer.copy_(obj, non_blocking=obj.is_cuda)
+        if isinstance(obj, dict):
+            ret = type(obj)((k, self._snapshot(v, path + (k,))) for k, v in obj.items())
+            if hasattr(obj, "_metadata"):
+                ret._metadata = obj._metadata.copy()
+            return ret
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, path + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, name, **kwargs):
+        if not self.save_dir or not self.save_to_disk:
+            return
+        # the previous write still reads the buffers
+        self.wait()
+
+        data = {}
+        data["model"] = self.model.state_dict()
+        for key, obj in self.checkpointables.items():
+            data[key] = obj.state_dict()
+        data.update(kwargs)
+        data = self._snapshot(data)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        basename = "{}.pth".format(name)
+        save_file = os.path.join(self.save_dir, basename)
+        assert os.path.basename(save_file) == basename, basename
+        self.logger.info("Saving checkpoint to {} in the background".format(save_file))
+        self._pending = self._executor.submit(self._write, save_file, data)
+        self._pending_file = save_file
+
+    def wait(self):
+        """
+        Wait for the checkpoint being written, if any.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            self._pending_file = None
+            pending.result()
+
+    def get_checkpoint_file(self):
+        # "last_checkpoint" only names the checkpoint being written once it is complete, while
+        # PeriodicCheckpointer asks for the checkpoint just saved to delete it later
+        if self._pending is not None:
+            return self._pending_file
+        return super().get_checkpoint_file()
+
+    def resume_or_load(self, path, *, resume=True):
+        self.wait()
+        return super().resume_or_load(path, resume=resume)
+
+    def _write(self, save_file, data):
+        directory = "{}.shards-{}".format(os.path.basename(save_file), uuid.uuid4().hex[:8])
+        tmp_directory = os.path.join(self.save_dir, directory + ".tmp")
+        os.makedirs(tmp_directory)
+        manifest = {"version": MANIFEST_VERSION, "directory": directory, "shards": []}
+        for shard_key, (key, prefix, obj) in _split_shards(data).items():
+            name = _shard_name(shard_key)
+            _write_shard(tmp_directory, name, obj)
+            manifest["shards"].append({"name": name, "key": key, "prefix": prefix})
+        os.rename(tmp_directory, os.path.join(self.save_dir, directory))
+
+        old_directory = None
+        if os.path.isfile(save_file) and is_sharded_checkpoint(save_file):
+            with open(save_file, "r") as f:
+                old_directory = json.load(f)["directory"]
+        self._atomic_write(save_file, json.dumps(manifest, indent=2))
+        if old_directory is not None and old_directory != directory:
+            shutil.rmtree(os.path.join(self.save_dir, old_directory), ignore_errors=True)
+        self.tag_last_checkpoint(os.path.basename(save_file))
+        self.logger.info("Saved checkpoint to {}".format(save_file))
+
+    def _atomic_write(self, path, content):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def tag_last_checkpoint(self, last_filename_basename):
+        self._atomic_write(os.path.join(self.save_dir, "last_checkpoint"), last_filename_basename)
+
+    def _load_file(self, filename):
+        if is_sharded_checkpoint(filename):
+            return load_sharded_checkpoint(filename)
+        return super()._load_file(filename)
@@ -24,6 +24,20 @@ def add_maskformer2_config(cfg):
     cfg.SOLVER.WEIGHT_DECAY_EMBED = 0.0
     # optimizer
     cfg.SOLVER.OPTIMIZER = "ADAMW"
+    # put the time of each optimizer step (with clipping) in the EventStorage as "optimizer_time"
+    cfg.SOLVER.TIME_OPTIMIZER_STEP = False
+    # write the checkpoints as shards in a background thread, see cotdet.checkpoint
+    cfg.SOLVER.ASYNC_CHECKPOINT = False
+    # put the time and peak memory of the main regions of the model in the EventStorage as
+    # "module_time/<region>" and "module_mem/<region>" (with MEMORY), see cotdet.utils.module_timer
+    cfg.SOLVER.MODULE_TIMING = CN()
+    cfg.SOLVER.MODULE_TIMING.ENABLED = False
+    cfg.SOLVER.MODULE_TIMING.PERIOD = 20
+    # synchronize CUDA around every region, slower but includes the time of the kernels
+    cfg.SOLVER.MODULE_TIMING.SYNC_CUDA = False
+    # also measure the peak memory of the regions. It resets the CUDA peak memory stats around every region, so the
+    # "max_mem" of the metrics printer only covers the last region
+    cfg.SOLVER.MODULE_TIMING.MEMORY = False
     cfg.SOLVER.BACKBONE_MULTIPLIER = 0.1
 
     # CoTDet model config
@@ -44,6 +58,8 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.CoTDet.MASK_WEIGHT = 5.0
     cfg.MODEL.CoTDet.BOX_WEIGHT = 5.
     cfg.MODEL.CoTDet.GIOU_WEIGHT = 2.
+    # compute each loss for all decoder layers at once instead of layer by layer
+    cfg.MODEL.CoTDet.FUSED_CRITERION = False
 
     # cost weight
     cfg.MODEL.CoTDet.COST_CLASS_WEIGHT = 4.0
@@ -97,6 +113,78 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.CoTDet.TEST.PANO_TRANSFORM_EVAL = True
     cfg.MODEL.CoTDet.TEST.PANO_TEMPERATURE = 0.06
     # cfg.MODEL.CoTDet.TEST.EVAL_FLAG = 1
+    # number of queries of every decoder layer at inference, e.g. [300, 300, 300, 150, 150, 150, 100, 100, 100],
+    # the queries with the lowest class scores are dropped before a layer with fewer. Empty keeps all of them
+    cfg.MODEL.CoTDet.TEST.QUERY_SCHEDULE = []
+    # early exit of the decoder at inference: stop after the first layer, from the MIN_LAYERS-th, where the
+    # class scores and the boxes of the TOPK best queries changed less than SCORE_DELTA and BOX_DELTA since the
+    # previous layer for all the images, or their best score is above SCORE_CUTOFF (1.0 disables it). The exit is
+    # decided for the whole batch, so it depends on the test batch size
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT = CN()
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.ENABLED = False
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.MIN_LAYERS = 3
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.TOPK = 10
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.SCORE_DELTA = 0.01
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.BOX_DELTA = 0.01
+    cfg.MODEL.CoTDet.TEST.EARLY_EXIT.SCORE_CUTOFF = 1.0
+    # skip the decoding of the images without any object of their task at inference: the ones whose best
+    # token score for their task in the query selection is below it get no instances. 0 decodes all of them, see
+    # tools/calibrate_relevance_gate.py to choose it
+    cfg.MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD = 0.0
+    # dynamic INT8 quantization of the nn.Linear layers of the modules under MODULES for the inference on CPU with
+    # --eval-only: the MLPs and projections of the knowledge and the heads, the projections of the deformable
+    # attention and the FFNs. The deformable sampling, the convolutions and the attention stay in fp32. The layers
+    # whose name ends with one of EXCLUDE are kept in fp32, see `tools/benchmark.py --task quantization`
+    cfg.MODEL.CoTDet.TEST.QUANTIZATION = CN()
+    cfg.MODEL.CoTDet.TEST.QUANTIZATION.ENABLED = False
+    cfg.MODEL.CoTDet.TEST.QUANTIZATION.MODULES = ["sem_seg_head.pixel_decoder.transformer", "sem_seg_head.predictor"]
+    cfg.MODEL.CoTDet.TEST.QUANTIZATION.EXCLUDE = []
+    # tiled inference of the images larger than SIZE (0 for INPUT.IMAGE_SIZE, the training crops): overlapping tiles
+    # of SIZE run BATCH_SIZE at a time and their instances above SCORE_THRESHOLD are merged by a same-class NMS of
+    # their boxes or masks (MERGE "box" or "mask") at NMS_THRESHOLD. Set INPUT.MIN_SIZE_TEST 0 to keep the full
+    # resolution of the images
+    cfg.MODEL.CoTDet.TEST.TILING = CN()
+    cfg.MODEL.CoTDet.TEST.TILING.ENABLED = False
+    cfg.MODEL.CoTDet.TEST.TILING.SIZE = 0
+    # fraction of SIZE shared by neighbouring tiles, at least
+    cfg.MODEL.CoTDet.TEST.TILING.OVERLAP = 0.25
+    cfg.MODEL.CoTDet.TEST.TILING.BATCH_SIZE = 4
+    cfg.MODEL.CoTDet.TEST.TILING.MERGE = "box"
+    cfg.MODEL.CoTDet.TEST.TILING.NMS_THRESHOLD = 0.5
+    cfg.MODEL.CoTDet.TEST.TILING.SCORE_THRESHOLD = 0.05
+    # inference on video streams with cotdet.CoTDetStream: the decoder reuses the queries and boxes of the previous
+    # frame and runs the two-stage query selection every QUERY_REFRESH_INTERVAL frames (1 runs it on every frame)
+    cfg.MODEL.CoTDet.TEST.STREAMING = CN()
+    cfg.MODEL.CoTDet.TEST.STREAMING.QUERY_REFRESH_INTERVAL = 10
+    # reuse the backbone and pixel encoder features of the last encoded frame while the mean absolute difference of
+    # the frames, in [0, 1], is below it. 0 encodes every frame
+    cfg.MODEL.CoTDet.TEST.STREAMING.FEATURE_REUSE_THRESHOLD = 0.0
+    cfg.MODEL.CoTDet.TEST.STREAMING.SCORE_THRESHOLD = 0.3
+    # the detectron2.tracking tracker of the instances above SCORE_THRESHOLD and its arguments, "" disables tracking
+    cfg.MODEL.CoTDet.TEST.STREAMING.TRACKER = "VanillaHungarianBBoxIOUTracker"
+    cfg.MODEL.CoTDet.TEST.STREAMING.MAX_NUM_INSTANCES = 200
+    cfg.MODEL.CoTDet.TEST.STREAMING.MAX_LOST_FRAME_COUNT = 0
+    cfg.MODEL.CoTDet.TEST.STREAMING.MIN_BOX_REL_DIM = 0.02
+    cfg.MODEL.CoTDet.TEST.STREAMING.MIN_INSTANCE_PERIOD = 1
+    cfg.MODEL.CoTDet.TEST.STREAMING.TRACK_IOU_THRESHOLD = 0.5
+
+    # distillation of a frozen teacher CoTDet, built from TEACHER_CONFIG with TEACHER_WEIGHTS, into the trained model:
+    # the class probabilities at TEMPERATURE and the boxes of the teacher queries matched to the same targets as the
+    # queries of the student, and the knowledge similarity maps of every token at KNOWLEDGE_TEMPERATURE
+    cfg.MODEL.CoTDet.DISTILLATION = CN()
+    cfg.MODEL.CoTDet.DISTILLATION.ENABLED = False
+    cfg.MODEL.CoTDet.DISTILLATION.TEACHER_CONFIG = ""
+    cfg.MODEL.CoTDet.DISTILLATION.TEACHER_WEIGHTS = ""
+    cfg.MODEL.CoTDet.DISTILLATION.TEMPERATURE = 1.0
+    cfg.MODEL.CoTDet.DISTILLATION.KNOWLEDGE_TEMPERATURE = 0.1
+    cfg.MODEL.CoTDet.DISTILLATION.LOGIT_WEIGHT = 2.0
+    cfg.MODEL.CoTDet.DISTILLATION.BOX_WEIGHT = 5.0
+    cfg.MODEL.CoTDet.DISTILLATION.GIOU_WEIGHT = 2.0
+    cfg.MODEL.CoTDet.DISTILLATION.KNOWLEDGE_WEIGHT = 1.0
+    # directory of the teacher outputs of every sample, "" disables the cache. The samples hit it from the second
+    # epoch, it is only used when the training augmentation is deterministic: INPUT.RANDOM_FLIP "none" and
+    # INPUT.MIN_SCALE == INPUT.MAX_SCALE <= 1, without INPUT.BATCHED_AUG
+    cfg.MODEL.CoTDet.DISTILLATION.CACHE_DIR = ""
 
     # Sometimes `backbone.size_divisibility` is set to 0 for some backbone (e.g. ResNet)
     # you can use this config to override
@@ -108,14 +196,56 @@ def add_maskformer2_config(cfg):
     cfg.MODEL.SEM_SEG_HEAD.TRANSFORMER_ENC_LAYERS = 0
     # pixel decoder
     cfg.MODEL.SEM_SEG_HEAD.PIXEL_DECODER_NAME = "CoTDetEncoder"
+    # run the pixel decoder under autocast with SOLVER.AMP, instead of in fp32
+    cfg.MODEL.SEM_SEG_HEAD.ENCODER_AMP = True
+    # fraction of the tokens refined by the encoder layers, the ones most similar to the knowledge of
+    # the task, the others are passed through unchanged. 1.0 refines all of them. Needs CONVS_DIM == HIDDEN_DIM
+    cfg.MODEL.SEM_SEG_HEAD.ENCODER_SPARSE_RATIO = 1.0
 
     # transformer module
     cfg.MODEL.CoTDet.TRANSFORMER_DECODER_NAME = "CoTDetDecoder"
 
+    # activation checkpointing in training, trades compute for memory
+    cfg.MODEL.CoTDet.CHECKPOINT = CN()
+    # indices of the encoder layers, e.g. [0, 1, 2, 3, 4, 5] for all of them
+    cfg.MODEL.CoTDet.CHECKPOINT.ENC_LAYERS = []
+    # indices of the decoder layers
+    cfg.MODEL.CoTDet.CHECKPOINT.DEC_LAYERS = []
+    # indices of the decoder layers whose class/mask prediction heads are checkpointed
+    cfg.MODEL.CoTDet.CHECKPOINT.PRED_HEADS = []
+
     # LSJ aug
     cfg.INPUT.IMAGE_SIZE = 1024
     cfg.INPUT.MIN_SCALE = 0.1
     cfg.INPUT.MAX_SCALE = 2.0
+    # run the LSJ aug on the collated batch on the device of the model instead of in the workers
+    cfg.INPUT.BATCHED_AUG = CN()
+    cfg.INPUT.BATCHED_AUG.ENABLED = False
+
+    # stream the training set from tar shards (paths or glob patterns) instead of DATASETS.TRAIN
+    cfg.DATASETS.TRAIN_TAR_SHARDS = []
+    cfg.DATALOADER.SHUFFLE_BUFFER_SIZE = 1000
+    # time the stages of the training mapper and report them in the EventStorage
+    cfg.DATALOADER.STAGE_TIMING = False
+
+    # batch test images by the aspect ratio of their padded shape
+    cfg.TEST.BUCKETED_BATCHING = CN()
+    cfg.TEST.BUCKETED_BATCHING.ENABLED = False
+    cfg.TEST.BUCKETED_BATCHING.IMS_PER_BATCH = 4
+    # edges on the h / w ratio, N edges give N + 1 buckets
+    cfg.TEST.BUCKETED_BATCHING.ASPECT_RATIO_EDGES = [0.5, 0.67, 0.8, 1.0, 1.25, 1.5, 2.0]
+
+    # evaluate snapshots of the weights in background processes of the main rank, every
+    # TEST.EVAL_PERIOD, instead of stopping all ranks for the evaluation
+    cfg.TEST.ASYNC_EVAL = CN()
+    cfg.TEST.ASYNC_EVAL.ENABLED = False
+    # maximum number of evaluations running at once, the snapshots beyond it are skipped
+    cfg.TEST.ASYNC_EVAL.MAX_IN_FLIGHT = 1
+    # device of the evaluation processes
+    cfg.TEST.ASYNC_EVAL.DEVICE = "cuda"
+    # keep the best snapshot as model_best.pth according to this metric, e.g. "bbox/AP"
+    cfg.TEST.ASYNC_EVAL.BEST_METRIC = ""
+    cfg.TEST.ASYNC_EVAL.BEST_MODE = "max"
 
     # point loss configs
     # Number of points sampled during training for a mask point head.
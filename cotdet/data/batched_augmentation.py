@@ -0,0 +1,158 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import torch
+from torch.nn import functional as F
+
+from detectron2.config import configurable
+from detectron2.structures import Boxes, ImageList, Instances
+
+__all__ = ["BatchedLSJAugmentation"]
+
+
+def masks_to_boxes(masks):
+    """
+    Tight XYXY boxes around a batch of bool masks [N, H, W], with the same convention as
+    :meth:`BitMasks.get_bounding_boxes` (the right/bottom edges are exclusive).
+    """
+    h, w = masks.shape[-2:]
+    x_any = masks.any(dim=1)
+    y_any = masks.any(dim=2)
+    x = torch.arange(w, device=masks.device)
+    y = torch.arange(h, device=masks.device)
+    x1 = torch.where(x_any, x, w).min(dim=1).values
+    x2 = torch.where(x_any, x + 1, 0).max(dim=1).values
+    y1 = torch.where(y_any, y, h).min(dim=1).values
+    y2 = torch.where(y_any, y + 1, 0).max(dim=1).values
+    return torch.stack([x1, y1, x2, y2], dim=1).float()
+
+
+class BatchedLSJAugmentation:
+    """
+    Large scale jittering applied to a whole batch on the device of the model.
+
+    It samples the same distribution as the ``RandomFlip`` + ``ResizeScale`` + ``FixedSizeCrop``
+    pipeline of :func:`build_transform_gen`, but warps all images of the batch with a single
+    ``grid_sample`` call and fuses the pixel normalization into it. The inputs are the
+    original uint8 images and instances with full-resolution ``gt_masks``, which is what
+    :class:`COCOTaskDatasetMapper` produces when ``INPUT.BATCHED_AUG.ENABLED`` is set.
+
+    Unlike the per-image pipeline, the padding takes the pixel mean (0 after normalization)
+    and boxes are recomputed from the warped masks instead of the warped polygons.
+    """
+
+    @configurable
+    def __init__(self, *, image_size, min_scale, max_scale, random_flip="horizontal"):
+        """
+        Args:
+            image_size (int): side of the square crop, as ``INPUT.IMAGE_SIZE``.
+            min_scale, max_scale (float): range of the random scale of the target size.
+            random_flip (str): "horizontal", "vertical" or "none".
+        """
+        self.image_size = image_size
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.random_flip = random_flip
+
+    @classmethod
+    def from_config(cls, cfg):
+        return {
+            "image_size": cfg.INPUT.IMAGE_SIZE,
+            "min_scale": cfg.INPUT.MIN_SCALE,
+            "max_scale": cfg.INPUT.MAX_SCALE,
+            "random_flip": cfg.INPUT.RANDOM_FLIP,
+        }
+
+    def __repr__(self):
+        return "{}(image_size={}, min_scale={}, max_scale={}, random_flip={})".format(
+            self.__class__.__name__, self.image_size, self.min_scale, self.max_scale, self.random_flip
+        )
+
+    def _sample_axis(self, size, new_size, offset, flip, canvas, padded):
+        """
+        Normalized sampling coordinates along one axis of the output canvas, and whether
+        each output pixel falls inside the resized image.
+        """
+        out = torch.arange(canvas, device=size.device, dtype=torch.float32)
+        resized = out[None] + offset[:, None]
+        valid = (out[None] < self.image_size) & (resized < new_size[:, None])
+        # pixel centers of the resized image mapped back to the original image, clamped to
+        # the first/last pixel center so that bilinear sampling replicates the border
+        src = (resized + 0.5) * (size / new_size)[:, None]
+        src = torch.minimum(torch.maximum(src, src.new_tensor(0.5)), size[:, None] - 0.5)
+        src = torch.where(flip[:, None], size[:, None] - src, src)
+        return src * 2 / padded - 1, valid
+
+    @torch.no_grad()
+    def __call__(self, images, instances, pixel_mean, pixel_std, size_divisibility=0, image_index=None):
+        """
+        Args:
+            images (list[Tensor]): uint8 images in (C, H, W) format, on the target device.
+            instances (list[Instances]): ground truth with "gt_classes" and "gt_masks" in the
+                resolution of the images.
+            pixel_mean, pixel_std (Tensor): of shape (C, 1, 1).
+            size_divisibility (int): pad the output canvas to a multiple of it.
+            image_index (Tensor or None): maps each item of `instances` to its image, for
+                multi-task batches. None means one item per image.
+
+        Returns:
+            ImageList: the normalized batch, with every image size equal to `image_size`.
+            list[Instances]: the augmented ground truth.
+        """
+        device = pixel_mean.device
+        batch = ImageList.from_tensors(images)
+        num_images = len(images)
+        h_pad, w_pad = batch.tensor.shape[-2:]
+        sizes = torch.as_tensor(batch.image_sizes, device=device, dtype=torch.float32)
+        h, w = sizes.unbind(1)
+
+        # ResizeScale: fit the image into a randomly scaled target box
+        scale = torch.empty(num_images, device=device).uniform_(self.min_scale, self.max_scale)
+        output_scale = torch.minimum(self.image_size * scale / h, self.image_size * scale / w)
+        new_h = torch.round(h * output_scale)
+        new_w = torch.round(w * output_scale)
+        # FixedSizeCrop: one random offset shared by both axes, then pad to the crop size
+        ratio = torch.rand(num_images, device=device)
+        offset_y = torch.round((new_h - self.image_size).clamp(min=0) * ratio)
+        offset_x = torch.round((new_w - self.image_size).clamp(min=0) * ratio)
+        flip = torch.rand(num_images, device=device) < 0.5
+        no_flip = torch.zeros_like(flip)
+        flip_x = flip if self.random_flip == "horizontal" else no_flip
+        flip_y = flip if self.random_flip == "vertical" else no_flip
+
+        canvas = self.image_size
+        if size_divisibility > 1:
+            canvas = (canvas + size_divisibility - 1) // size_divisibility * size_divisibility
+        grid_x, valid_x = self._sample_axis(w, new_w, offset_x, flip_x, canvas, w_pad)
+        grid_y, valid_y = self._sample_axis(h, new_h, offset_y, flip_y, canvas, h_pad)
+        grid = torch.stack(
+            [grid_x[:, None, :].expand(-1, canvas, -1), grid_y[:, :, None].expand(-1, -1, canvas)], dim=-1
+        )
+        valid = valid_y[:, None, :, None] & valid_x[:, None, None, :]
+
+        images = F.grid_sample(batch.tensor.float(), grid, mode="bilinear", align_corners=False)
+        images = torch.where(valid, (images - pixel_mean) / pixel_std, images.new_zeros(()))
+        images = ImageList(images, [(self.image_size, self.image_size)] * num_images)
+
+        if image_index is None:
+            image_index = torch.arange(num_images, device=device)
+        # masks of one item are stacked as channels so that they share its sampling grid
+        num_masks = max([len(x) for x in instances] + [1])
+        masks = torch.zeros((len(instances), num_masks, h_pad, w_pad), dtype=torch.float32, device=device)
+        for i, x in enumerate(instances):
+            m = x.gt_masks.to(device)
+            masks[i, : m.shape[0], : m.shape[1], : m.shape[2]] = m
+        crop = slice(0, self.image_size)
+        mask_grid = grid[image_index][:, crop, crop]
+        masks = F.grid_sample(masks, mask_grid, mode="bilinear", align_corners=False) > 0.5
+        masks &= valid[image_index][:, :, crop, crop]
+
+        new_instances = []
+        for i, x in enumerate(instances):
+            gt_masks = masks[i, : len(x)]
+            keep = gt_masks.flatten(1).any(dim=1)
+            gt_masks = gt_masks[keep]
+            target = Instances((self.image_size, self.image_size))
+            target.gt_classes = x.gt_classes.to(device)[keep]
+            target.gt_masks = gt_masks
+            target.gt_boxes = Boxes(masks_to_boxes(gt_masks))
+            new_instances.append(target)
+        return images, new_instances
@@ -0,0 +1,126 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import bisect
+import logging
+from collections import defaultdict
+
+import torch.utils.data as torchdata
+
+from detectron2.config import configurable
+from detectron2.data import DatasetFromList, DatasetMapper, MapDataset, get_detection_dataset_dicts
+from detectron2.data.build import trivial_batch_collator
+from detectron2.data.samplers import InferenceSampler
+from detectron2.data.transforms import ResizeShortestEdge
+from detectron2.utils import comm
+
+__all__ = ["BucketedInferenceBatchSampler", "build_bucketed_test_loader", "get_padded_shape_buckets"]
+
+
+def get_padded_shape_buckets(dataset_dicts, min_size, max_size, size_divisibility, aspect_ratio_edges):
+    """
+    Assign every record to the bucket of the shape it is padded to at test time.
+
+    The test mapper resizes with :class:`ResizeShortestEdge`, so the padded shape only depends
+    on the "height" and "width" of the record and can be computed without reading the image.
+
+    Args:
+        dataset_dicts (list[dict]): records with "height" and "width".
+        min_size, max_size (int): as ``INPUT.MIN_SIZE_TEST`` and ``INPUT.MAX_SIZE_TEST``.
+        size_divisibility (int): the padded shape is a multiple of it.
+        aspect_ratio_edges (list[float]): sorted edges of the buckets on the h / w ratio of the
+            padded shape. N edges give N + 1 buckets.
+
+    Returns:
+        list[int]: the bucket of every record.
+    """
+    bucket_ids = []
+    for d in dataset_dicts:
+        h, w = ResizeShortestEdge.get_output_shape(d["height"], d["width"], min_size, max_size)
+        if size_divisibility > 1:
+            h = (h + size_divisibility - 1) // size_divisibility * size_divisibility
+            w = (w + size_divisibility - 1) // size_divisibility * size_divisibility
+        bucket_ids.append(bisect.bisect_right(aspect_ratio_edges, h / w))
+    return bucket_ids
+
+
+class BucketedInferenceBatchSampler(torchdata.Sampler):
+    """
+    A batch sampler for inference that only batches images of the same padded shape bucket,
+    so that batches larger than 1 waste little compute on padding.
+
+    Like :class:`InferenceSampler`, every rank gets a contiguous shard of the dataset and
+    all samples are produced exactly once. Batches are yielded in the order of their first
+    sample, the last batch of a bucket may be smaller than `batch_size`.
+    """
+
+    def __init__(self, bucket_ids, batch_size):
+        """
+        Args:
+            bucket_ids (list[int]): the bucket of every sample of the dataset.
+            batch_size (int): maximum number of samples in a batch.
+        """
+        assert len(bucket_ids) > 0
+        self._batch_size = batch_size
+        local_indices = InferenceSampler._get_local_indices(
+            len(bucket_ids), comm.get_world_size(), comm.get_rank()
+        )
+        open_batches = defaultdict(list)
+        self._batches = []
+        for idx in local_indices:
+            batch = open_batches[bucket_ids[idx]]
+            if not batch:
+                self._batches.append(batch)
+            batch.append(idx)
+            if len(batch) == batch_size:
+                del open_batches[bucket_ids[idx]]
+
+    def __iter__(self):
+        for batch in self._batches:
+            yield list(batch)
+
+    def __len__(self):
+        return len(self._batches)
+
+
+def _bucketed_test_loader_from_config(cfg, dataset_name, mapper=None):
+    dataset = get_detection_dataset_dicts(dataset_name, filter_empty=False)
+    bucket_cfg = cfg.TEST.BUCKETED_BATCHING
+    size_divisibility = cfg.MODEL.CoTDet.SIZE_DIVISIBILITY
+    bucket_ids = get_padded_shape_buckets(
+        dataset,
+        cfg.INPUT.MIN_SIZE_TEST,
+        cfg.INPUT.MAX_SIZE_TEST,
+        size_divisibility if size_divisibility > 0 else 32,
+        sorted(bucket_cfg.ASPECT_RATIO_EDGES),
+    )
+    return {
+        "dataset": dataset,
+        "mapper": DatasetMapper(cfg, False) if mapper is None else mapper,
+        "batch_sampler": BucketedInferenceBatchSampler(bucket_ids, bucket_cfg.IMS_PER_BATCH),
+        "num_workers": cfg.DATALOADER.NUM_WORKERS,
+    }
+
+
+@configurable(from_config=_bucketed_test_loader_from_config)
+def build_bucketed_test_loader(dataset, *, mapper, batch_sampler, num_workers=0, collate_fn=None):
+    """
+    Similar to `build_detection_test_loader`, but batches images by padded shape bucket
+    with :class:`BucketedInferenceBatchSampler`.
+
+    The batches are lists of dicts like with `build_detection_test_loader`, the model pads
+    them. Use :class:`DatasetOrderEvaluator` to get the results back in dataset order.
+    """
+    if isinstance(dataset, list):
+        dataset = DatasetFromList(dataset, copy=False)
+    if mapper is not None:
+        dataset = MapDataset(dataset, mapper)
+    logging.getLogger(__name__).info(
+        "Bucketed inference: {} images in {} batches on this rank".format(
+            sum(len(b) for b in batch_sampler), len(batch_sampler)
+        )
+    )
+    return torchdata.DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
+        collate_fn=trivial_batch_collator if collate_fn is None else collate_fn,
+    )
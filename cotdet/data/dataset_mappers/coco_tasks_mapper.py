@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Modified by Bowen Cheng from https://github.com/facebookresearch/detr/blob/master/d2/detr/dataset_mapper.py
+import contextlib
 import copy
 import logging
 
@@ -12,6 +13,9 @@ from detectron2.data import transforms as T
 
 from pycocotools import mask as coco_mask
 
+from ..stage_timer import DataStageTimer
+from ..tar_dataset import read_image_bytes
+
 __all__ = ["COCOTaskDatasetMapper"]
 
 
@@ -81,6 +85,16 @@ class COCOTaskDatasetMapper:
     4. Prepare image and annotation to Tensors
     """
 
+    # stages timed by the optional DataStageTimer
+    STAGES = (
+        "read_image",
+        "transform_image",
+        "padding_mask",
+        "transform_annotations",
+        "annotations_to_instances",
+        "poly_to_mask",
+    )
+
     @configurable
     def __init__(
         self,
@@ -88,6 +102,7 @@ class COCOTaskDatasetMapper:
         *,
         tfm_gens,
         image_format,
+        stage_timer=None,
     ):
         """
         NOTE: this interface is experimental.
@@ -96,6 +111,7 @@ class COCOTaskDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             tfm_gens: data augmentation
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            stage_timer: an optional :class:`DataStageTimer` with the :attr:`STAGES` of this mapper.
         """
         self.tfm_gens = tfm_gens
         logging.getLogger(__name__).info(
@@ -104,19 +120,30 @@ class COCOTaskDatasetMapper:
 
         self.img_format = image_format
         self.is_train = is_train
-    
+        self.stage_timer = stage_timer
+
     @classmethod
     def from_config(cls, cfg, is_train=True):
         # Build augmentation
-        tfm_gens = build_transform_gen(cfg, is_train)
+        if is_train and cfg.INPUT.BATCHED_AUG.ENABLED:
+            # keep the original image, it is augmented by the model with BatchedLSJAugmentation
+            tfm_gens = []
+        else:
+            tfm_gens = build_transform_gen(cfg, is_train)
 
         ret = {
             "is_train": is_train,
             "tfm_gens": tfm_gens,
             "image_format": cfg.INPUT.FORMAT,
+            "stage_timer": DataStageTimer(cls.STAGES) if is_train and cfg.DATALOADER.STAGE_TIMING else None,
         }
         return ret
 
+    def _timed(self, stage):
+        if self.stage_timer is None:
+            return contextlib.nullcontext()
+        return self.stage_timer.time(stage)
+
     def __call__(self, dataset_dict):
         """
         Args:
@@ -126,17 +153,24 @@ class COCOTaskDatasetMapper:
             dict: a format that builtin models in detectron2 accept
         """
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
-        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+        with self._timed("read_image"):
+            if "image_bytes" in dataset_dict:
+                # streamed from a tar shard by TarShardDataset
+                image = read_image_bytes(dataset_dict.pop("image_bytes"), format=self.img_format)
+            else:
+                image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
         utils.check_image_size(dataset_dict, image)
 
         # TODO: get padding mask
         # by feeding a "segmentation mask" to the same transforms
         padding_mask = np.ones(image.shape[:2])
 
-        image, transforms = T.apply_transform_gens(self.tfm_gens, image)
-        # the crop transformation has default padding value 0 for segmentation
-        padding_mask = transforms.apply_segmentation(padding_mask)
-        padding_mask = ~ padding_mask.astype(bool)
+        with self._timed("transform_image"):
+            image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+        with self._timed("padding_mask"):
+            # the crop transformation has default padding value 0 for segmentation
+            padding_mask = transforms.apply_segmentation(padding_mask)
+            padding_mask = ~ padding_mask.astype(bool)
 
         image_shape = image.shape[:2]  # h, w
 
@@ -146,44 +180,62 @@ class COCOTaskDatasetMapper:
         dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
         dataset_dict["padding_mask"] = torch.as_tensor(np.ascontiguousarray(padding_mask))
 
+        if "task_annotations" in dataset_dict:
+            # multi-task record: one image shared by the annotations of several tasks
+            task_annotations = dataset_dict.pop("task_annotations")
+            if self.is_train:
+                # every task group reuses the same decoded and augmented image
+                dataset_dict["task_instances"] = [
+                    (group["task_id"], self._transform_annotations(group["annotations"], transforms, image_shape))
+                    for group in task_annotations
+                ]
+            return dataset_dict
+
         if not self.is_train:
             # USER: Modify this if you want to keep them for some reason.
             dataset_dict.pop("annotations", None)
             return dataset_dict
 
         if "annotations" in dataset_dict:
-            # USER: Modify this if you want to keep them for some reason.
-            for anno in dataset_dict["annotations"]:
-                # Let's always keep mask
-                # if not self.mask_on:
-                #     anno.pop("segmentation", None)
-                anno.pop("keypoints", None)
+            dataset_dict["instances"] = self._transform_annotations(
+                dataset_dict.pop("annotations"), transforms, image_shape
+            )
+
+        return dataset_dict
+
+    def _transform_annotations(self, annotations, transforms, image_shape):
+        # USER: Modify this if you want to keep them for some reason.
+        for anno in annotations:
+            # Let's always keep mask
+            # if not self.mask_on:
+            #     anno.pop("segmentation", None)
+            anno.pop("keypoints", None)
 
-            # USER: Implement additional transformations if you have other types of data
+        # USER: Implement additional transformations if you have other types of data
+        with self._timed("transform_annotations"):
             annos = [
                 utils.transform_instance_annotations(obj, transforms, image_shape)
-                for obj in dataset_dict.pop("annotations")
+                for obj in annotations
                 if obj.get("iscrowd", 0) == 0
             ]
-            # NOTE: does not support BitMask due to augmentation
-            # Current BitMask cannot handle empty objects
+        # NOTE: does not support BitMask due to augmentation
+        # Current BitMask cannot handle empty objects
+        with self._timed("annotations_to_instances"):
             instances = utils.annotations_to_instances(annos, image_shape)
-            # After transforms such as cropping are applied, the bounding box may no longer
-            # tightly bound the object. As an example, imagine a triangle object
-            # [(0,0), (2,0), (0,2)] cropped by a box [(1,0),(2,2)] (XYXY format). The tight
-            # bounding box of the cropped triangle should be [(1,0),(2,1)], which is not equal to
-            # the intersection of original bounding box and the cropping box.
-            instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
-            # Need to filter empty instances first (due to augmentation)
-            instances = utils.filter_empty_instances(instances)
-            # Generate masks from polygon
-            h, w = instances.image_size
-            # image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float)
-            if hasattr(instances, 'gt_masks'):
-                gt_masks = instances.gt_masks
+        # After transforms such as cropping are applied, the bounding box may no longer
+        # tightly bound the object. As an example, imagine a triangle object
+        # [(0,0), (2,0), (0,2)] cropped by a box [(1,0),(2,2)] (XYXY format). The tight
+        # bounding box of the cropped triangle should be [(1,0),(2,1)], which is not equal to
+        # the intersection of original bounding box and the cropping box.
+        instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+        # Need to filter empty instances first (due to augmentation)
+        instances = utils.filter_empty_instances(instances)
+        # Generate masks from polygon
+        h, w = instances.image_size
+        # image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float)
+        if hasattr(instances, 'gt_masks'):
+            gt_masks = instances.gt_masks
+            with self._timed("poly_to_mask"):
                 gt_masks = convert_coco_poly_to_mask(gt_masks.polygons, h, w)
-                instances.gt_masks = gt_masks
-
-            dataset_dict["instances"] = instances
-
-        return dataset_dict
+            instances.gt_masks = gt_masks
+        return instances
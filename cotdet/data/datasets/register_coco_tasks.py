@@ -21,7 +21,14 @@ This file contains functions to parse COCO-format annotations into dicts in "Det
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["load_coco_json", "load_sem_seg", "convert_to_coco_json", "register_coco_instances"]
+__all__ = [
+    "load_coco_json",
+    "load_coco_tasks_multi_json",
+    "load_sem_seg",
+    "convert_to_coco_json",
+    "register_coco_instances",
+    "register_coco_tasks_multi",
+]
 
 
 def load_coco_json(json_file, image_root, dataset_name=None, extra_annotation_keys=None):
@@ -223,6 +230,58 @@ Category ids in annotations are not in [1, #categories]! We'll apply a mapping f
     return dataset_dicts
 
 
+def load_coco_tasks_multi_json(json_files, image_root, dataset_name=None):
+    """
+    Load several single-task coco-tasks json files and merge them into one record per
+    unique image. Each task file stores the same image as a separate record, so decoding,
+    augmenting and running the backbone on it once per task repeats the same work.
+    Args:
+        json_files (list[str]): paths of the single-task json files to merge.
+        image_root (str or path-like): the directory where the images exist.
+        dataset_name (str or None): the name of the merged dataset, see :func:`load_coco_json`.
+    Returns:
+        list[dict]: records without the "annotations" and "task_id" fields. Instead each
+        record has a "task_annotations" field: a list of dicts with keys
+        "task_id", "image_id" (the id of the image in the task's json) and "annotations",
+        sorted by task id, as well as the matching "task_ids" and "task_image_ids" lists.
+    """
+    merged = {}
+    for json_file in json_files:
+        for record in load_coco_json(json_file, image_root, dataset_name):
+            # the same image may be stored under different ids in different files,
+            # so use the file on disk to identify it
+            key = record["file_name"]
+            if key not in merged:
+                merged[key] = {
+                    "file_name": record["file_name"],
+                    "height": record["height"],
+                    "width": record["width"],
+                    "image_id": record["image_id"],
+                    "task_annotations": {},
+                }
+            groups = merged[key]["task_annotations"]
+            for obj in record["annotations"]:
+                task_id = obj["category_id"]
+                if task_id not in groups:
+                    groups[task_id] = {"task_id": task_id, "image_id": record["image_id"], "annotations": []}
+                groups[task_id]["annotations"].append(obj)
+
+    dataset_dicts = []
+    for record in merged.values():
+        record["task_annotations"] = [record["task_annotations"][k] for k in sorted(record["task_annotations"])]
+        # kept outside "task_annotations" so that they survive test-time mappers
+        record["task_ids"] = [group["task_id"] for group in record["task_annotations"]]
+        record["task_image_ids"] = [group["image_id"] for group in record["task_annotations"]]
+        dataset_dicts.append(record)
+    num_pairs = sum(len(x["task_annotations"]) for x in dataset_dicts)
+    logger.info(
+        "Merged {} (image, task) pairs into {} unique images from {} files".format(
+            num_pairs, len(dataset_dicts), len(json_files)
+        )
+    )
+    return dataset_dicts
+
+
 def load_sem_seg(gt_root, image_root, gt_ext="png", image_ext="jpg"):
     """
     Load semantic segmentation datasets. All files under "gt_root" with "gt_ext" extension are
@@ -492,6 +551,32 @@ def register_coco_instances(name, metadata, json_file, image_root):
         json_file=json_file, image_root=image_root, evaluator_type="coco_task", **metadata
     )
 
+def register_coco_tasks_multi(name, metadata, json_files, image_root, task_dataset_names=None):
+    """
+    Register a multi-task view of several coco-tasks json files, which yields
+    each image once with all of its task annotations. See :func:`load_coco_tasks_multi_json`.
+    Args:
+        name (str): the name that identifies the merged dataset, e.g. "coco_task_test_multi".
+        metadata (dict): extra metadata associated with this dataset.
+        json_files (list[str]): paths of the single-task json files to merge.
+        image_root (str or path-like): directory which contains all the images.
+        task_dataset_names (dict[int, str] or None): the registered single-task dataset
+            that holds the annotations of each task id; used by the evaluator to score
+            every task against its own split.
+    """
+    assert isinstance(name, str), name
+    assert isinstance(image_root, (str, os.PathLike)), image_root
+    json_files = list(json_files)
+    DatasetCatalog.register(name, lambda: load_coco_tasks_multi_json(json_files, image_root, name))
+
+    MetadataCatalog.get(name).set(
+        json_files=json_files,
+        image_root=image_root,
+        evaluator_type="coco_task_multi",
+        task_dataset_names=task_dataset_names,
+        **metadata
+    )
+
 ret = {}
 
 def register_coco_tasks(root):
@@ -507,6 +592,14 @@ def register_coco_tasks(root):
         json_file,
         image_root,
     )
+    register_coco_tasks_multi(
+        'coco_task_train_multi',
+        ret,
+        [json_file],
+        image_root,
+    )
+    test_json_files = []
+    task_dataset_names = {}
     for i in range(14):
         name = 'coco_task_test{}'.format(i+1)
         json_file = os.path.join(root, 'annotations', name+'.json')
@@ -516,5 +609,15 @@ def register_coco_tasks(root):
             json_file,
             image_root,
         )
+        test_json_files.append(json_file)
+        # test split i+1 only holds annotations of task i
+        task_dataset_names[i] = name
+    register_coco_tasks_multi(
+        'coco_task_test_multi',
+        ret,
+        test_json_files,
+        image_root,
+        task_dataset_names=task_dataset_names,
+    )
 _root = os.getenv("DETECTRON2_DATASETS", "datasets")
 register_coco_tasks(_root)
\ No newline at end of file
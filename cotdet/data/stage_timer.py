@@ -0,0 +1,118 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.utils.data as torchdata
+
+from detectron2.engine import HookBase
+
+__all__ = ["DataStageTimer", "DataStageTimingHook"]
+
+
+class DataStageTimer:
+    """
+    Accumulate the time spent in the stages of a dataset mapper, across dataloader workers.
+
+    The totals live in a shared-memory block created in the main process, with one row per
+    worker, so that workers never write to the same counters. The main process reads the sums
+    with :meth:`totals`. With `record_samples`, every duration is also kept in the current
+    process, which :meth:`percentiles` uses.
+    """
+
+    def __init__(self, stages, max_workers=64, record_samples=False):
+        """
+        Args:
+            stages (list[str]): names of the stages.
+            max_workers (int): number of rows for workers. Workers beyond it share rows.
+            record_samples (bool): whether to keep every duration in the current process.
+        """
+        self.stages = list(stages)
+        self._index = {s: i for i, s in enumerate(self.stages)}
+        # [worker, stage, (seconds, count)]; row 0 is used outside of dataloader workers
+        self._block = torch.zeros((max_workers + 1, len(self.stages), 2), dtype=torch.float64).share_memory_()
+        self._samples = defaultdict(list) if record_samples else None
+        self._view = None
+        self._view_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = state["_view_pid"] = None
+        return state
+
+    def _row(self):
+        if self._view_pid != os.getpid():
+            # numpy view of the shared block, much cheaper than indexing the tensor
+            self._view = self._block.numpy()
+            self._view_pid = os.getpid()
+        worker_info = torchdata.get_worker_info()
+        slot = 0 if worker_info is None else worker_info.id % (self._view.shape[0] - 1) + 1
+        return self._view[slot]
+
+    def add(self, stage, seconds):
+        row = self._row()[self._index[stage]]
+        row[0] += seconds
+        row[1] += 1
+        if self._samples is not None:
+            self._samples[stage].append(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - start)
+
+    def totals(self):
+        """
+        Returns:
+            ndarray: of shape (#stages, 2), the total seconds and number of calls of each stage
+            over all workers.
+        """
+        return self._block.numpy().sum(axis=0)
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        Returns:
+            dict[str, ndarray]: the `q` percentiles in seconds of each stage, from the durations
+            recorded in the current process.
+        """
+        assert self._samples is not None, "DataStageTimer was created without record_samples!"
+        return {s: np.percentile(self._samples[s], q) for s in self.stages if self._samples[s]}
+
+
+class DataStageTimingHook(HookBase):
+    """
+    Put the mean time of each stage of a :class:`DataStageTimer` in the EventStorage, next to
+    "data_time", as "data_time/<stage>" in seconds per call.
+    """
+
+    def __init__(self, timer, period=20):
+        """
+        Args:
+            timer (DataStageTimer): the timer of the training mapper.
+            period (int): number of iterations between two reports.
+        """
+        self._timer = timer
+        self._period = period
+        self._last = None
+
+    def before_train(self):
+        self._last = self._timer.totals()
+
+    def after_step(self):
+        if (self.trainer.iter + 1) % self._period != 0:
+            return
+        totals = self._timer.totals()
+        seconds, count = (totals - self._last).T
+        self._last = totals
+        self.trainer.storage.put_scalars(
+            **{
+                "data_time/" + stage: s / c
+                for stage, s, c in zip(self._timer.stages, seconds, count)
+                if c > 0
+            },
+            smoothing_hint=False,
+        )
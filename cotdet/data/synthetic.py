@@ -0,0 +1,83 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Random data in the formats read by CoTDet, to run it without the datasets and the knowledge base.
+"""
+import os
+import pickle
+
+import numpy as np
+import torch
+from PIL import Image
+
+from detectron2.structures import BoxMode
+
+from ..modeling.transformer_decoder.conditional_decoder import TASK_CAPTIONS
+
+__all__ = ["write_synthetic_knowledge", "write_synthetic_records"]
+
+# length of the knowledge sequences expected by the knowledge pooling of CoTDetDecoder
+KNOWLEDGE_LENGTH = 42
+TEXT_DIM = 768
+
+
+def write_synthetic_knowledge(directory, knowledge_size, seed=0):
+    """
+    Write random task prompts and a random knowledge base in the format read by
+    :class:`CoTDetDecoder`, and return their paths.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    prompts = {c: torch.randn(TEXT_DIM, generator=generator) for c in TASK_CAPTIONS.values()}
+    knowledge = {
+        c: (
+            torch.randn(knowledge_size, KNOWLEDGE_LENGTH, TEXT_DIM, generator=generator),
+            torch.randn(knowledge_size, TEXT_DIM, generator=generator),
+        )
+        for c in TASK_CAPTIONS.values()
+    }
+    task_name = os.path.join(directory, "task_name.pkl")
+    knowledge_base = os.path.join(directory, "knowledge_base.pkl")
+    with open(task_name, "wb") as f:
+        pickle.dump(prompts, f)
+    with open(knowledge_base, "wb") as f:
+        pickle.dump(knowledge, f)
+    return task_name, knowledge_base
+
+
+def write_synthetic_records(directory, num_images, image_size, num_classes, max_objects=4, seed=0):
+    """
+    Write random jpg images and return dataset dicts with random polygon annotations.
+    """
+    rng = np.random.RandomState(seed)
+    records = []
+    for i in range(num_images):
+        h, w = image_size, int(image_size * rng.uniform(0.75, 1.33))
+        file_name = os.path.join(directory, "{:06d}.jpg".format(i))
+        Image.fromarray(rng.randint(0, 256, (h, w, 3), dtype=np.uint8)).save(file_name)
+        annotations = []
+        for _ in range(rng.randint(1, max_objects + 1)):
+            x0, y0 = rng.uniform(0, w * 0.6), rng.uniform(0, h * 0.6)
+            bw, bh = rng.uniform(w * 0.1, w - x0), rng.uniform(h * 0.1, h - y0)
+            # a hexagon inscribed in the box
+            angles = np.linspace(0, 2 * np.pi, 6, endpoint=False)
+            xs = x0 + bw / 2 * (1 + np.cos(angles))
+            ys = y0 + bh / 2 * (1 + np.sin(angles))
+            annotations.append(
+                {
+                    "bbox": [x0, y0, bw, bh],
+                    "bbox_mode": BoxMode.XYWH_ABS,
+                    "segmentation": [np.stack([xs, ys], axis=1).flatten().tolist()],
+                    "category_id": int(rng.randint(num_classes)),
+                    "iscrowd": 0,
+                }
+            )
+        records.append(
+            {
+                "file_name": file_name,
+                "height": h,
+                "width": w,
+                "image_id": i,
+                "task_id": int(rng.randint(len(TASK_CAPTIONS))),
+                "annotations": annotations,
+            }
+        )
+    return records
@@ -0,0 +1,181 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import glob
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import tarfile
+
+import torch.utils.data as torchdata
+from PIL import Image
+
+from detectron2.data.detection_utils import _apply_exif_orientation, convert_PIL_to_numpy
+from detectron2.structures import BoxMode
+from detectron2.utils import comm
+
+__all__ = ["TarShardDataset", "read_image_bytes", "write_tar_shards"]
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def read_image_bytes(data, format=None):
+    """
+    Same as :func:`detection_utils.read_image`, for an encoded image already in memory.
+    """
+    image = Image.open(io.BytesIO(data))
+    image = _apply_exif_orientation(image)
+    return convert_PIL_to_numpy(image, format)
+
+
+def _iter_tar_samples(path):
+    """
+    Stream the samples of one shard. A sample is an image and a json file that share the same
+    name up to the extension and are stored next to each other in the archive.
+    """
+    key, sample = None, {}
+    with tarfile.open(path, "r|*") as stream:
+        for member in stream:
+            if not member.isfile():
+                continue
+            name, ext = os.path.splitext(member.name)
+            if name != key:
+                if sample:
+                    yield key, sample
+                key, sample = name, {}
+            sample[ext.lower()] = stream.extractfile(member).read()
+    if sample:
+        yield key, sample
+
+
+def _sample_to_record(path, key, sample):
+    image_ext = [ext for ext in sample if ext in IMAGE_EXTENSIONS]
+    if ".json" not in sample or not image_ext:
+        logger.warning("Skip incomplete sample '{}' in {}".format(key, path))
+        return None
+    record = json.loads(sample[".json"])
+    record["file_name"] = os.path.join(path, key + image_ext[0])
+    record["image_bytes"] = sample[image_ext[0]]
+    for anno in record.get("annotations", []):
+        anno["bbox_mode"] = BoxMode(anno.get("bbox_mode", BoxMode.XYWH_ABS))
+    return record
+
+
+class TarShardDataset(torchdata.IterableDataset):
+    """
+    Stream training records from sharded tar archives with sequential reads only, for datasets
+    that do not fit in memory.
+
+    Each sample of a shard is an image and a json with its record in Detectron2 Dataset format
+    (e.g. "height", "width", "task_id" and "annotations" as produced by `load_coco_json`), see
+    :func:`write_tar_shards`. The record gets the encoded image under "image_bytes", which
+    :class:`COCOTaskDatasetMapper` decodes instead of reading "file_name".
+
+    Each epoch, the shards are shuffled with a seed shared by all ranks and split among the
+    ranks and dataloader workers; samples go through a bounded shuffle buffer. If there are
+    fewer shards than readers, every reader reads all shards and keeps its share of samples.
+    The dataset is infinite, like :class:`TrainingSampler`, and can be given to
+    `build_detection_train_loader` through its `dataset` argument.
+    """
+
+    def __init__(self, shards, shuffle_buffer_size=1000, seed=None):
+        """
+        Args:
+            shards (list[str]): paths or glob patterns of the tar archives.
+            shuffle_buffer_size (int): number of records kept in memory for shuffling.
+                0 disables the shuffling of samples.
+            seed (int): the seed of the shuffling. It must be the same on all ranks.
+                If None, a random seed shared among ranks is used.
+        """
+        self._shards = sorted(itertools.chain.from_iterable(glob.glob(p) or [p] for p in shards))
+        assert len(self._shards) > 0, "No tar shard found in {}".format(shards)
+        self._shuffle_buffer_size = shuffle_buffer_size
+        if seed is None:
+            seed = comm.shared_random_seed()
+        self._seed = int(seed)
+        self._rank = comm.get_rank()
+        self._world_size = comm.get_world_size()
+        logger.info("TarShardDataset: {} shards".format(len(self._shards)))
+
+    def _reader_info(self):
+        worker_info = torchdata.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        return self._rank * num_workers + worker_id, self._world_size * num_workers
+
+    def _iter_records(self, epoch, reader_id, num_readers):
+        shards = list(self._shards)
+        random.Random(self._seed + epoch).shuffle(shards)
+        if len(shards) >= num_readers:
+            for path in shards[reader_id::num_readers]:
+                for key, sample in _iter_tar_samples(path):
+                    yield _sample_to_record(path, key, sample)
+        else:
+            idx = 0
+            for path in shards:
+                for key, sample in _iter_tar_samples(path):
+                    if idx % num_readers == reader_id:
+                        yield _sample_to_record(path, key, sample)
+                    idx += 1
+
+    def __iter__(self):
+        reader_id, num_readers = self._reader_info()
+        rng = random.Random(self._seed + reader_id)
+        buffer = []
+        for epoch in itertools.count():
+            for record in self._iter_records(epoch, reader_id, num_readers):
+                if record is None:
+                    continue
+                if len(buffer) < self._shuffle_buffer_size:
+                    buffer.append(record)
+                    continue
+                if buffer:
+                    idx = rng.randrange(len(buffer))
+                    buffer[idx], record = record, buffer[idx]
+                yield record
+
+
+def write_tar_shards(dataset_dicts, output_pattern, samples_per_shard=1000):
+    """
+    Write records in Detectron2 Dataset format into tar shards readable by
+    :class:`TarShardDataset`.
+
+    Args:
+        dataset_dicts (list[dict]): records with "file_name" and the annotations.
+        output_pattern (str): path of the shards with a format field for the shard index,
+            e.g. "shards/coco-task-%06d.tar".
+        samples_per_shard (int): number of samples in each shard.
+
+    Returns:
+        list[str]: paths of the written shards.
+    """
+    paths = []
+    tar = None
+    for idx, record in enumerate(dataset_dicts):
+        if idx % samples_per_shard == 0:
+            if tar is not None:
+                tar.close()
+            paths.append(output_pattern % len(paths))
+            tar = tarfile.open(paths[-1], "w")
+        record = dict(record)
+        file_name = record.pop("file_name")
+        record.pop("image_bytes", None)
+        if "annotations" in record:
+            record["annotations"] = [
+                dict(anno, bbox_mode=int(anno["bbox_mode"])) if "bbox_mode" in anno else anno
+                for anno in record["annotations"]
+            ]
+        key = "{:09d}".format(idx)
+        with open(file_name, "rb") as f:
+            image = f.read()
+        ext = os.path.splitext(file_name)[1].lower()
+        for name, data in [(key + ext, image), (key + ".json", json.dumps(record).encode())]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    if tar is not None:
+        tar.close()
+    return paths
@@ -0,0 +1,245 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import hashlib
+import logging
+import os
+
+import torch
+from torch.nn import functional as F
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.events import get_event_storage
+
+from .config import add_maskformer2_config
+from .utils import box_ops
+
+__all__ = ["CoTDetDistiller", "TeacherOutputCache", "is_deterministic_augmentation"]
+
+logger = logging.getLogger(__name__)
+
+
+def is_deterministic_augmentation(cfg):
+    """
+    Whether the training augmentation of :class:`COCOTaskDatasetMapper` maps a record to the same
+    image every time: no flip, and a fixed scale that fits the image in the crop, which only pads it.
+    """
+    return cfg.INPUT.RANDOM_FLIP == "none" and cfg.INPUT.MIN_SCALE == cfg.INPUT.MAX_SCALE <= 1.0
+
+
+class TeacherOutputCache:
+    """
+    The outputs of the teacher of every sample saved to a directory, one file per sample keyed by its
+    record, its image size, the padded size of its batch and its task, so that the teacher only runs
+    on the samples it has not seen. It must only be used with a deterministic training augmentation,
+    see :func:`is_deterministic_augmentation`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # the number of samples found in the cache or not
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(record, padded_size, task_id):
+        """
+        Args:
+            record (dict): the input of the sample, with its "file_name" and mapped "image"
+        """
+        key = "{}_{}_{}_{}".format(record["file_name"], tuple(record["image"].shape), tuple(padded_size), int(task_id))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pth")
+
+    def load(self, keys):
+        """
+        Returns:
+            list[dict] or None: the outputs of every sample, None unless all of them are cached
+        """
+        paths = [self._path(k) for k in keys]
+        if not all(os.path.exists(p) for p in paths):
+            self.misses += len(keys)
+            return None
+        self.hits += len(keys)
+        return [torch.load(p, map_location="cpu") for p in paths]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def save(self, keys, outputs):
+        for key, output in zip(keys, outputs):
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written to a temporary file first, the other processes may read it
+            torch.save(output, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+
+class CoTDetDistiller:
+    """
+    Distillation of a frozen teacher CoTDet into the `CoTDet` it is attached to as `model.distiller`,
+    see MODEL.CoTDet.DISTILLATION. The teacher runs on the images of the student and the student is
+    trained with the losses of its targets and:
+
+    * "loss_distill_logits": the binary cross-entropy of the class logits of the queries of the
+      student with the class probabilities of the queries of the teacher matched to the same object,
+      at TEMPERATURE. Both models are matched to the targets by the matcher of the student, so they
+      can have different numbers of queries.
+    * "loss_distill_bbox" and "loss_distill_giou": the L1 and GIoU losses of the boxes of the same
+      pairs of queries.
+    * "loss_distill_knowledge": the KL divergence of the distributions over the knowledge entries of
+      the task of every token, the similarity maps of the knowledge retrieval, at
+      KNOWLEDGE_TEMPERATURE. The pixel encoders of both models must have the same tokens.
+
+    The teacher is not a module of the student, it is neither trained nor saved in its checkpoints.
+    Its inference options that depend on the data, the relevance gate, the early exit and the query
+    schedule, are turned off so that it has outputs for every sample, of all its queries.
+    """
+
+    def __init__(self, cfg, model):
+        """
+        Args:
+            cfg (CfgNode): the config of the student
+            model (CoTDet): the student, its criterion gets the weights of the distillation losses
+        """
+        distillation = cfg.MODEL.CoTDet.DISTILLATION
+        teacher_cfg = get_cfg()
+        add_deeplab_config(teacher_cfg)
+        add_maskformer2_config(teacher_cfg)
+        teacher_cfg.merge_from_file(distillation.TEACHER_CONFIG)
+        teacher_cfg.MODEL.DEVICE = cfg.MODEL.DEVICE
+        # the outputs of the teacher are paired with the samples and the queries of the student
+        teacher_test = teacher_cfg.MODEL.CoTDet.TEST
+        if teacher_test.RELEVANCE_THRESHOLD > 0 or teacher_test.EARLY_EXIT.ENABLED or teacher_test.QUERY_SCHEDULE:
+            logger.warning("Turning off the relevance gate, the early exit and the query schedule of the teacher")
+        teacher_test.RELEVANCE_THRESHOLD = 0.0
+        teacher_test.EARLY_EXIT.ENABLED = False
+        teacher_test.QUERY_SCHEDULE = []
+        teacher = build_model(teacher_cfg)
+        DetectionCheckpointer(teacher).load(distillation.TEACHER_WEIGHTS)
+        teacher.eval().requires_grad_(False)
+        assert teacher.pixel_mean.equal(model.pixel_mean) and teacher.pixel_std.equal(model.pixel_std), \
+            "the teacher and the student must normalize the images the same way"
+        assert teacher.sem_seg_head.num_classes == model.sem_seg_head.num_classes
+        teacher.sem_seg_head.predictor.output_knowledge_similarity = True
+        model.sem_seg_head.predictor.output_knowledge_similarity = True
+
+        self.teacher = teacher
+        self.temperature = distillation.TEMPERATURE
+        self.knowledge_temperature = distillation.KNOWLEDGE_TEMPERATURE
+        self.cache = None
+        if distillation.CACHE_DIR:
+            assert model.batched_augmentation is None, \
+                "the teacher outputs can not be cached with the batched augmentation, it runs after the cache keys"
+            if is_deterministic_augmentation(cfg):
+                self.cache = TeacherOutputCache(distillation.CACHE_DIR)
+            else:
+                logger.warning(
+                    "Not caching the teacher outputs: the training augmentation is random, the samples would "
+                    "never hit MODEL.CoTDet.DISTILLATION.CACHE_DIR"
+                )
+        self.weight_dict = {
+            "loss_distill_logits": distillation.LOGIT_WEIGHT,
+            "loss_distill_bbox": distillation.BOX_WEIGHT,
+            "loss_distill_giou": distillation.GIOU_WEIGHT,
+            "loss_distill_knowledge": distillation.KNOWLEDGE_WEIGHT,
+        }
+        model.criterion.weight_dict.update(self.weight_dict)
+
+    @torch.no_grad()
+    def teacher_outputs(self, batched_inputs, images, task_ids, image_index):
+        """
+        Returns:
+            list[dict]: the "pred_logits", "pred_boxes" and "knowledge_similarity" of the final layer
+            of the teacher for every sample, from the cache if all of them are in it
+        """
+        keys = None
+        if self.cache is not None:
+            sample_images = range(len(task_ids)) if image_index is None else image_index.tolist()
+            keys = [
+                self.cache.key(batched_inputs[i], images.tensor.shape[-2:], t)
+                for i, t in zip(sample_images, task_ids.tolist())
+            ]
+            outputs = self.cache.load(keys)
+            get_event_storage().put_scalar("distill_cache_hit_rate", self.cache.hit_rate(), smoothing_hint=False)
+            if outputs is not None:
+                device = images.tensor.device
+                return [{k: v.to(device).float() for k, v in x.items()} for x in outputs]
+
+        features = self.teacher.backbone(images.tensor)
+        outputs, _ = self.teacher.sem_seg_head(features, task_ids=task_ids, image_index=image_index)
+        assert "kept" not in outputs, "the teacher skipped samples"
+        outputs = [
+            {"pred_logits": logits, "pred_boxes": boxes, "knowledge_similarity": similarity}
+            for logits, boxes, similarity in zip(
+                outputs["pred_logits"], outputs["pred_boxes"], outputs["knowledge_similarity"]
+            )
+        ]
+        if keys is not None:
+            # the boxes are regressed to the sub-pixel, the rest is saved in half precision
+            self.cache.save(keys, [
+                {k: v.cpu() if k == "pred_boxes" else v.half().cpu() for k, v in x.items()} for x in outputs
+            ])
+        return outputs
+
+    def losses(self, batched_inputs, images, task_ids, image_index, outputs, targets, matcher):
+        """
+        Args:
+            batched_inputs, images, task_ids, image_index: the inputs of the student, see `CoTDet.forward`
+            outputs (dict): the outputs of the head of the student
+            targets (list[dict]): the targets of every sample
+            matcher (HungarianMatcher): the matcher of the student
+
+        Returns:
+            dict[str, Tensor]: the distillation losses, unweighted
+        """
+        teacher_outputs = self.teacher_outputs(batched_inputs, images, task_ids, image_index)
+        teacher_batch = {k: torch.stack([x[k] for x in teacher_outputs]) for k in ("pred_logits", "pred_boxes")}
+        student_batch = {k: outputs[k].detach() for k in ("pred_logits", "pred_boxes")}
+        student_indices = matcher(student_batch, targets, cost=["cls", "box"])
+        teacher_indices = matcher(teacher_batch, targets, cost=["cls", "box"])
+
+        # the queries of the student and of the teacher matched to the same targets
+        student_idx, teacher_idx = [], []
+        for b, ((s, s_tgt), (t, t_tgt), target) in enumerate(zip(student_indices, teacher_indices, targets)):
+            teacher_query = torch.full((len(target["labels"]),), -1, dtype=torch.int64)
+            teacher_query[t_tgt] = t
+            t = teacher_query[s_tgt]
+            matched = t >= 0
+            s, t = s[matched], t[matched]
+            student_idx.append(torch.stack([torch.full_like(s, b), s]))
+            teacher_idx.append(torch.stack([torch.full_like(t, b), t]))
+        student_idx, teacher_idx = torch.cat(student_idx, 1), torch.cat(teacher_idx, 1)
+        num_matches = max(student_idx.shape[1], 1)
+
+        src_logits = outputs["pred_logits"][tuple(student_idx)]
+        teacher_probs = (teacher_batch["pred_logits"][tuple(teacher_idx)] / self.temperature).sigmoid()
+        loss_logits = F.binary_cross_entropy_with_logits(src_logits / self.temperature, teacher_probs, reduction="sum")
+        src_boxes = outputs["pred_boxes"][tuple(student_idx)]
+        teacher_boxes = teacher_batch["pred_boxes"][tuple(teacher_idx)]
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
+            box_ops.box_cxcywh_to_xyxy(src_boxes), box_ops.box_cxcywh_to_xyxy(teacher_boxes)
+        )
+        losses = {
+            "loss_distill_logits": loss_logits * self.temperature ** 2 / num_matches,
+            "loss_distill_bbox": F.l1_loss(src_boxes, teacher_boxes, reduction="sum") / num_matches,
+            "loss_distill_giou": loss_giou.sum() / num_matches,
+        }
+
+        similarity = outputs["knowledge_similarity"]
+        teacher_similarity = torch.stack([x["knowledge_similarity"] for x in teacher_outputs])
+        assert similarity.shape == teacher_similarity.shape, \
+            "the pixel encoders of the teacher and the student have different tokens, {} and {}".format(
+                tuple(teacher_similarity.shape), tuple(similarity.shape))
+        # the padding of the knowledge is -inf in both
+        valid = torch.isfinite(teacher_similarity)
+        log_p = F.log_softmax(similarity.float() / self.knowledge_temperature, dim=-1).masked_fill(~valid, 0)
+        log_q = F.log_softmax(teacher_similarity.float() / self.knowledge_temperature, dim=-1).masked_fill(~valid, 0)
+        kl = (log_q.exp() * (log_q - log_p)).masked_fill(~valid, 0).sum(-1)
+        losses["loss_distill_knowledge"] = kl.mean() * self.knowledge_temperature ** 2
+        return losses
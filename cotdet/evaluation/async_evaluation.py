@@ -0,0 +1,173 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.multiprocessing as mp
+
+from detectron2.engine import HookBase
+from detectron2.engine.hooks import BestCheckpointer
+from detectron2.evaluation.testing import flatten_results_dict
+from detectron2.utils.file_io import PathManager
+
+__all__ = ["AsyncEvalHook", "SnapshotBestCheckpointer"]
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotBestCheckpointer(BestCheckpointer):
+    """
+    :class:`BestCheckpointer` for the snapshots evaluated in the background by :class:`AsyncEvalHook`:
+    the weights have moved on when the results of a snapshot arrive, so the best snapshot file is
+    copied to "{file_prefix}.pth" instead of saving the current weights. It is its own checkpointer
+    and is run by the AsyncEvalHook, not registered as a hook.
+    """
+
+    def __init__(self, output_dir, val_metric, mode="max", file_prefix="model_best"):
+        super().__init__(0, self, val_metric, mode=mode, file_prefix=file_prefix)
+        self._output_dir = output_dir
+        self._snapshot = None
+
+    def save(self, name, **kwargs):
+        # the checkpointer interface used by BestCheckpointer
+        path = os.path.join(self._output_dir, name + ".pth")
+        PathManager.copy(self._snapshot, path, overwrite=True)
+        logger.info("Copied {} to {}".format(self._snapshot, path))
+
+    def check(self, trainer, snapshot):
+        """
+        Keep `snapshot` if the metric its results just put in the storage of `trainer` is the best.
+        """
+        self.trainer = trainer
+        self._snapshot = snapshot
+        self._best_checking()
+
+
+class AsyncEvalHook(HookBase):
+    """
+    Like :class:`EvalHook`, but the evaluation runs in background processes while training
+    goes on.
+
+    Every `eval_period` iterations, the weights are saved to a snapshot file that is
+    evaluated by `eval_function` in a pool of `max_in_flight` processes. The results are put
+    in the EventStorage at the iteration they arrive, with "eval_iter" set to the iteration of
+    the snapshot. With `val_metric`, the best snapshot is kept as "model_best.pth" by a
+    :class:`SnapshotBestCheckpointer`.
+
+    Register it in the main process only, it does not synchronize the ranks.
+    """
+
+    def __init__(
+        self,
+        eval_period,
+        eval_function,
+        cfg,
+        output_dir,
+        max_in_flight=1,
+        val_metric="",
+        mode="max",
+        eval_after_train=True,
+    ):
+        """
+        Args:
+            eval_period (int): the period to evaluate. Set to 0 to only evaluate after the
+                last iteration if `eval_after_train` is True.
+            eval_function (callable): a picklable function that takes `cfg` and the path of the
+                snapshot, and returns a nested dict of evaluation metrics.
+            cfg (CfgNode): given to `eval_function`.
+            output_dir (str): where the snapshots and the best model are saved.
+            max_in_flight (int): maximum number of evaluations running at once. The snapshots
+                taken while it is reached are not evaluated, except the last one.
+            val_metric (str): metric to keep the best snapshot, e.g. "bbox/AP". Empty to disable.
+            mode (str): "max" or "min", whether `val_metric` should be maximized or minimized.
+            eval_after_train (bool): whether to evaluate after the last iteration. The running
+                evaluations are waited for in any case.
+        """
+        self._period = eval_period
+        self._func = eval_function
+        self._cfg = cfg
+        self._output_dir = output_dir
+        self._max_in_flight = max_in_flight
+        self._best_checkpointer = SnapshotBestCheckpointer(output_dir, val_metric, mode) if val_metric else None
+        self._eval_after_train = eval_after_train
+        self._executor = None
+        # (iteration, snapshot path, future) of the running evaluations
+        self._in_flight = []
+
+    def before_train(self):
+        # CUDA can not be used in forked processes
+        self._executor = ProcessPoolExecutor(self._max_in_flight, mp_context=mp.get_context("spawn"))
+
+    def _save_snapshot(self, iteration):
+        model = self.trainer.checkpointer.model
+        state_dict = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+        path = os.path.join(self._output_dir, "async_eval", "model_{:07d}.pth".format(iteration))
+        PathManager.mkdirs(os.path.dirname(path))
+        with PathManager.open(path, "wb") as f:
+            torch.save({"model": state_dict, "iteration": iteration}, f)
+        return path
+
+    def _submit(self, iteration, force=False):
+        if len(self._in_flight) >= self._max_in_flight and not force:
+            logger.warning(
+                "Skip the evaluation of iteration {}, {} evaluations are still running.".format(
+                    iteration, len(self._in_flight)
+                )
+            )
+            return
+        path = self._save_snapshot(iteration)
+        self._in_flight.append((iteration, path, self._executor.submit(self._func, self._cfg, path)))
+        logger.info("Started the evaluation of iteration {} in the background.".format(iteration))
+
+    def _collect(self, wait=False):
+        running = []
+        for iteration, path, future in self._in_flight:
+            if not wait and not future.done():
+                running.append((iteration, path, future))
+                continue
+            try:
+                results = future.result()
+            except Exception:
+                logger.exception("The evaluation of iteration {} failed.".format(iteration))
+                results = None
+            if results:
+                self._put_results(iteration, path, results)
+            PathManager.rm(path)
+        self._in_flight = running
+
+    def _put_results(self, iteration, path, results):
+        assert isinstance(results, dict), "Eval function must return a dict. Got {} instead.".format(
+            results
+        )
+        flattened_results = flatten_results_dict(results)
+        for k, v in flattened_results.items():
+            try:
+                flattened_results[k] = float(v)
+            except Exception as e:
+                raise ValueError(
+                    "[AsyncEvalHook] eval_function should return a nested dict of float. "
+                    "Got '{}: {}' instead.".format(k, v)
+                ) from e
+        self.trainer.storage.put_scalars(eval_iter=iteration, **flattened_results, smoothing_hint=False)
+        self.trainer._last_eval_results = results
+        logger.info("Got the evaluation results of iteration {}.".format(iteration))
+
+        if self._best_checkpointer is not None:
+            self._best_checkpointer.check(self.trainer, path)
+
+    def after_step(self):
+        self._collect()
+        next_iter = self.trainer.iter + 1
+        if self._period > 0 and next_iter % self._period == 0:
+            # do the last eval in after_train
+            if next_iter != self.trainer.max_iter:
+                self._submit(next_iter)
+
+    def after_train(self):
+        # This condition is to prevent the eval from running after a failed training
+        if self._eval_after_train and self.trainer.iter + 1 >= self.trainer.max_iter:
+            self._submit(self.trainer.max_iter, force=True)
+        self._collect(wait=True)
+        self._executor.shutdown()
+        del self._func
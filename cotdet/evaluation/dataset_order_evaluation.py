@@ -0,0 +1,49 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+from detectron2.data import DatasetCatalog
+from detectron2.evaluation import DatasetEvaluator
+
+
+class DatasetOrderEvaluator(DatasetEvaluator):
+    """
+    Wrap an evaluator fed by a loader that does not follow the dataset order, such as
+    :func:`build_bucketed_test_loader`.
+
+    Batches are forwarded as they come, so no model output is held back. Before evaluation,
+    the predictions collected by the wrapped evaluators (:class:`COCOEvaluator` and the ones
+    nested in :class:`DatasetEvaluators` or :class:`MultiTaskEvaluator`) are put back in the
+    order of the dataset. As every rank runs a contiguous shard, the gathered results are then
+    in dataset order as well.
+    """
+
+    def __init__(self, evaluator, dataset_name):
+        """
+        Args:
+            evaluator (DatasetEvaluator): the evaluator to wrap.
+            dataset_name (str): name of the evaluated dataset.
+        """
+        self._evaluator = evaluator
+        self._order = {}
+        for idx, d in enumerate(DatasetCatalog.get(dataset_name)):
+            # the multi-task records are known under another image id in each task split
+            for image_id in [d["image_id"]] + list(d.get("task_image_ids", [])):
+                self._order.setdefault(image_id, idx)
+
+    def reset(self):
+        self._evaluator.reset()
+
+    def process(self, inputs, outputs):
+        self._evaluator.process(inputs, outputs)
+
+    def _sort_predictions(self, evaluator):
+        predictions = getattr(evaluator, "_predictions", None)
+        if isinstance(predictions, list):
+            predictions.sort(key=lambda p: self._order.get(p.get("image_id"), len(self._order)))
+        children = getattr(evaluator, "_evaluators", [])
+        if isinstance(children, dict):
+            children = children.values()
+        for child in children:
+            self._sort_predictions(child)
+
+    def evaluate(self):
+        self._sort_predictions(self._evaluator)
+        return self._evaluator.evaluate()
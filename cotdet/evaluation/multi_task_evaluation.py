@@ -0,0 +1,63 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+import os
+from collections import OrderedDict
+
+import detectron2.utils.comm as comm
+from detectron2.data import MetadataCatalog
+from detectron2.evaluation import COCOEvaluator, DatasetEvaluator
+
+
+class MultiTaskEvaluator(DatasetEvaluator):
+    """
+    Evaluate a multi-task dataset registered by `register_coco_tasks_multi`.
+
+    The model returns the results of every task of an image under "task_results".
+    Each of them is routed to the :class:`COCOEvaluator` of the single-task split that
+    holds the annotations of that task, so the reported AP is the same as evaluating
+    the splits one by one, while every image is decoded and encoded only once.
+    """
+
+    def __init__(self, dataset_name, output_dir=None, **kwargs):
+        """
+        Args:
+            dataset_name (str): name of the multi-task dataset. Its metadata must contain
+                "task_dataset_names", a dict mapping task id to the single-task dataset name.
+            output_dir (str): optional, an output directory. The results of each task
+                are written to a sub-directory named after its single-task dataset.
+            kwargs: passed to each :class:`COCOEvaluator`.
+        """
+        task_dataset_names = MetadataCatalog.get(dataset_name).get("task_dataset_names", None)
+        assert task_dataset_names, f"Dataset '{dataset_name}' does not map tasks to single-task datasets!"
+        self._task_dataset_names = task_dataset_names
+        self._evaluators = OrderedDict()
+        for task_id in sorted(task_dataset_names):
+            name = task_dataset_names[task_id]
+            task_output_dir = os.path.join(output_dir, name) if output_dir else None
+            self._evaluators[task_id] = COCOEvaluator(name, output_dir=task_output_dir, **kwargs)
+
+    def reset(self):
+        for evaluator in self._evaluators.values():
+            evaluator.reset()
+
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            image_ids = dict(zip(input["task_ids"], input["task_image_ids"]))
+            for result in output["task_results"]:
+                task_id = result["task_id"]
+                # the image may be stored under a different id in the split of this task
+                task_input = {"image_id": image_ids[task_id]}
+                self._evaluators[task_id].process([task_input], [{"instances": result["instances"]}])
+
+    def evaluate(self):
+        results = OrderedDict()
+        # every rank has to evaluate the tasks in the same order because of the gather inside
+        for task_id, evaluator in self._evaluators.items():
+            task_results = evaluator.evaluate()
+            if not task_results:
+                continue
+            name = self._task_dataset_names[task_id]
+            for k, v in task_results.items():
+                results[f"{name}/{k}"] = v
+        if not comm.is_main_process():
+            return {}
+        return results
@@ -0,0 +1,153 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Deployment of CoTDet through `torch.jit.trace`, :class:`detectron2.export.TracingAdapter` and
+`torch.onnx.export`, see tools/export_model.py.
+"""
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from detectron2.modeling.postprocessing import sem_seg_postprocess
+from detectron2.structures import Boxes, ImageList, Instances
+
+from .modeling.pixel_encoder.ops.modules import MSDeformAttn
+from .utils import box_ops
+
+__all__ = ["CoTDetDeployModel", "OUTPUT_NAMES", "pytorch_deformable_attention"]
+
+# the outputs of CoTDetDeployModel, in order
+OUTPUT_NAMES = ("scores", "pred_classes", "pred_boxes", "pred_masks")
+
+
+@contextmanager
+def pytorch_deformable_attention(model):
+    """
+    Run the deformable attention of `model` with its PyTorch implementation within the context, to
+    trace or export it: the compiled op can not be exported. The model is restored on exit.
+    """
+    modules = [m for m in model.modules() if isinstance(m, MSDeformAttn)]
+    use_msda = [m.use_msda for m in modules]
+    for m in modules:
+        m.use_msda = False
+    try:
+        yield
+    finally:
+        for m, use in zip(modules, use_msda):
+            m.use_msda = use
+
+
+class CoTDetDeployModel(nn.Module):
+    """
+    The instance inference of :class:`CoTDet` split into three stages, the middle one exportable:
+
+    1. :meth:`preprocess` normalizes and pads the images and stacks the task ids, in Python.
+    2. :meth:`forward` runs the model on tensors only: the task ids index the knowledge buffers of the
+       decoder, there is no host synchronization and it returns the top-k predictions of every image,
+       with the masks at the padded input resolution.
+    3. :meth:`postprocess` resizes the masks and the boxes to the output resolution and builds the
+       `Instances`, in Python.
+
+    Together they return the same instances as `CoTDet`, up to their order. Trace or export
+    :meth:`forward` within :func:`pytorch_deformable_attention`.
+    """
+
+    def __init__(self, model):
+        """
+        Args:
+            model (CoTDet): in eval mode, with instance inference only. The relevance gate and the early
+                exit of the decoder depend on the data and must be disabled.
+        """
+        super().__init__()
+        assert model.instance_on and not model.semantic_on and not model.panoptic_on
+        predictor = model.sem_seg_head.predictor
+        assert predictor.relevance_threshold <= 0, "MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD is not exportable"
+        assert predictor.decoder.early_exit is None, "MODEL.CoTDet.TEST.EARLY_EXIT is not exportable"
+        self.model = model
+        self.topk = model.test_topk_per_image
+
+    def preprocess(self, batched_inputs):
+        """
+        Args:
+            batched_inputs: single-task records in the format of :class:`CoTDet`, with a "task_id".
+
+        Returns:
+            Tensor: the normalized images padded to the size divisibility, (B, 3, H, W)
+            Tensor: the task id of every image, (B,)
+            list[tuple]: the size of every image before padding
+        """
+        model = self.model
+        assert all("task_id" in x for x in batched_inputs), "only the single-task records are supported"
+        images = [(x["image"].to(model.device) - model.pixel_mean) / model.pixel_std for x in batched_inputs]
+        images = ImageList.from_tensors(images, model.size_divisibility)
+        task_ids, _ = model.prepare_task_ids(batched_inputs)
+        return images.tensor, task_ids, images.image_sizes
+
+    def forward(self, images, task_ids):
+        """
+        Args:
+            images, task_ids: see :meth:`preprocess`
+
+        Returns:
+            tuple[Tensor]: see `OUTPUT_NAMES`, for the top-k predictions of every image: the scores of
+            the classes (B, K), the classes (B, K), the boxes in normalized cxcywh (B, K, 4) and the
+            mask logits at the resolution of `images` (B, K, H, W).
+        """
+        features = self.model.backbone(images)
+        outputs, _ = self.model.sem_seg_head(features, task_ids=task_ids)
+        mask_cls, mask_pred, mask_box = outputs["pred_logits"], outputs["pred_masks"], outputs["pred_boxes"]
+
+        # as CoTDet.instance_inference, batched
+        num_classes = self.model.sem_seg_head.num_classes
+        scores, topk_indices = mask_cls.sigmoid().flatten(1).topk(self.topk, dim=1, sorted=False)
+        labels = topk_indices % num_classes
+        query_indices = torch.div(topk_indices, num_classes, rounding_mode="floor")
+        boxes = torch.gather(mask_box, 1, query_indices[..., None].expand(-1, -1, 4))
+        masks = torch.gather(
+            mask_pred, 1, query_indices[..., None, None].expand(-1, -1, mask_pred.shape[-2], mask_pred.shape[-1])
+        )
+        # only the masks of the top-k queries are upsampled
+        masks = F.interpolate(masks, size=images.shape[-2:], mode="bilinear", align_corners=False)
+        return scores, labels, boxes, masks
+
+    def postprocess(self, outputs, batched_inputs, image_sizes):
+        """
+        Args:
+            outputs: the outputs of :meth:`forward`
+            batched_inputs: the records given to :meth:`preprocess`, for their "height" and "width"
+            image_sizes: returned by :meth:`preprocess`
+
+        Returns:
+            list[dict]: the "instances" of every image, as returned by `CoTDet`.
+        """
+        scores, labels, boxes, masks = outputs
+        padded_size = masks.shape[-2:]
+        processed_results = []
+        for i, (x, image_size) in enumerate(zip(batched_inputs, image_sizes)):
+            height = x.get("height", image_size[0])
+            width = x.get("width", image_size[1])
+            mask_pred = sem_seg_postprocess(masks[i], image_size, height, width)
+            result = Instances(mask_pred.shape[-2:])
+            result.pred_masks = (mask_pred > 0).float()
+            # the boxes are normalized by the padded size
+            scale = [padded_size[1] / image_size[1] * width, padded_size[0] / image_size[0] * height] * 2
+            box = box_ops.box_cxcywh_to_xyxy(boxes[i])
+            result.pred_boxes = Boxes(box * torch.as_tensor(scale).to(box))
+            pred_masks = result.pred_masks.flatten(1)
+            mask_scores = (mask_pred.sigmoid().flatten(1) * pred_masks).sum(1) / (pred_masks.sum(1) + 1e-6)
+            if self.model.focus_on_box:
+                mask_scores = 1.0
+            result.scores = scores[i] * mask_scores
+            result.pred_classes = labels[i]
+            processed_results.append({"instances": result})
+        return processed_results
+
+    def inference(self, batched_inputs, exported=None):
+        """
+        Run the three stages on `batched_inputs`, with `exported`, the traced or exported :meth:`forward`
+        that takes the images and the task ids, instead of :meth:`forward` if given.
+        """
+        images, task_ids, image_sizes = self.preprocess(batched_inputs)
+        outputs = (exported or self)(images, task_ids)
+        return self.postprocess(outputs, batched_inputs, image_sizes)
@@ -14,6 +14,7 @@ from detectron2.modeling.postprocessing import sem_seg_postprocess
 from detectron2.structures import Boxes, ImageList, Instances, BitMasks
 from detectron2.utils.memory import retry_if_cuda_oom
 
+from .data.batched_augmentation import BatchedLSJAugmentation
 from .modeling.criterion import SetCriterion
 from .modeling.matcher import HungarianMatcher
 from .utils import box_ops
@@ -49,6 +50,7 @@ class CoTDet(nn.Module):
         focus_on_box: bool = False,
         transform_eval: bool = False,
         semantic_ce_loss: bool = False,
+        batched_augmentation=None,
     ):
         """
         Args:
@@ -75,6 +77,8 @@ class CoTDet(nn.Module):
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
             transform_eval: transform sigmoid score into softmax score to make score sharper
             semantic_ce_loss: whether use cross-entroy loss in classification
+            batched_augmentation: optional callable that augments the uint8 training batch on
+                the device of the model, see :class:`BatchedLSJAugmentation`
         """
         super().__init__()
         self.backbone = backbone
@@ -103,6 +107,9 @@ class CoTDet(nn.Module):
         self.focus_on_box = focus_on_box
         self.transform_eval = transform_eval
         self.semantic_ce_loss = semantic_ce_loss
+        self.batched_augmentation = batched_augmentation
+        # a CoTDetDistiller that adds the distillation losses of a teacher in training, see train_net.py
+        self.distiller = None
         if not self.semantic_on:
             assert self.sem_seg_postprocess_before_inference
 
@@ -180,7 +187,12 @@ class CoTDet(nn.Module):
             dn_losses=dn_losses,
             panoptic_on=(cfg.MODEL.CoTDet.TEST.PANOPTIC_ON or cfg.MODEL.CoTDet.TEST.SEMANTIC_ON) and ~cfg.MODEL.CoTDet.PANO_BOX_LOSS,
             semantic_ce_loss=cfg.MODEL.CoTDet.TEST.SEMANTIC_ON and cfg.MODEL.CoTDet.SEMANTIC_CE_LOSS and ~cfg.MODEL.CoTDet.TEST.PANOPTIC_ON,
+            fused=cfg.MODEL.CoTDet.FUSED_CRITERION,
         )
+        # the samples skipped by the relevance gate only get empty instances
+        assert cfg.MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD <= 0 or not (
+            cfg.MODEL.CoTDet.TEST.SEMANTIC_ON or cfg.MODEL.CoTDet.TEST.PANOPTIC_ON
+        ), "MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD only supports instance inference"
 
         return {
             "backbone": backbone,
@@ -207,7 +219,8 @@ class CoTDet(nn.Module):
             "focus_on_box": cfg.MODEL.CoTDet.TEST.TEST_FOUCUS_ON_BOX,
             "transform_eval": cfg.MODEL.CoTDet.TEST.PANO_TRANSFORM_EVAL,
             "pano_temp": cfg.MODEL.CoTDet.TEST.PANO_TEMPERATURE,
-            "semantic_ce_loss": cfg.MODEL.CoTDet.TEST.SEMANTIC_ON and cfg.MODEL.CoTDet.SEMANTIC_CE_LOSS and ~cfg.MODEL.CoTDet.TEST.PANOPTIC_ON
+            "semantic_ce_loss": cfg.MODEL.CoTDet.TEST.SEMANTIC_ON and cfg.MODEL.CoTDet.SEMANTIC_CE_LOSS and ~cfg.MODEL.CoTDet.TEST.PANOPTIC_ON,
+            "batched_augmentation": BatchedLSJAugmentation(cfg) if cfg.INPUT.BATCHED_AUG.ENABLED else None,
         }
 
     @property
@@ -240,27 +253,44 @@ class CoTDet(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
-        images = [x["image"].to(self.device) for x in batched_inputs]
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
-        task_ids = [torch.tensor(x["task_id"], device=self.device, dtype=torch.int64) for x in batched_inputs]
+        task_ids, image_index = self.prepare_task_ids(batched_inputs)
+        gt_instances = None
+        if self.training:
+            # mask classification target
+            if "instances" in batched_inputs[0]:
+                gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+            elif "task_instances" in batched_inputs[0]:
+                gt_instances = [inst.to(self.device) for x in batched_inputs for _, inst in x["task_instances"]]
+
+        if self.training and self.batched_augmentation is not None and gt_instances is not None:
+            # the mapper left the images un-augmented, scale/crop/flip and normalize them as a batch
+            images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
+            images, gt_instances = self.batched_augmentation(
+                images, gt_instances, self.pixel_mean, self.pixel_std, self.size_divisibility, image_index
+            )
+        else:
+            images = [x["image"].to(self.device) for x in batched_inputs]
+            images = [(x - self.pixel_mean) / self.pixel_std for x in images]
+            images = ImageList.from_tensors(images, self.size_divisibility)
 
         features = self.backbone(images.tensor)
 
         if self.training:
             # dn_args={"scalar":30,"noise_scale":0.4}
-            # mask classification target
-            if "instances" in batched_inputs[0]:
-                gt_instances = [x["instances"].to(self.device) for x in batched_inputs]
+            if gt_instances is not None:
                 if 'detr' in self.data_loader:
                     targets = self.prepare_targets_detr(gt_instances, images)
                 else:
                     targets = self.prepare_targets(gt_instances, images)
             else:
                 targets = None
-            outputs,mask_dict = self.sem_seg_head(features, task_ids=task_ids ,targets=targets)
+            outputs,mask_dict = self.sem_seg_head(features, task_ids=task_ids ,targets=targets, image_index=image_index)
             # bipartite matching-based loss
             losses = self.criterion(outputs, targets,mask_dict)
+            if self.distiller is not None:
+                losses.update(self.distiller.losses(
+                    batched_inputs, images, task_ids, image_index, outputs, targets, self.criterion.matcher
+                ))
 
             for k in list(losses.keys()):
                 if k in self.criterion.weight_dict:
@@ -270,62 +300,148 @@ class CoTDet(nn.Module):
                     losses.pop(k)
             return losses
         else:
-            outputs, _ = self.sem_seg_head(features, task_ids=task_ids)
-            mask_cls_results = outputs["pred_logits"]
-            mask_pred_results = outputs["pred_masks"]
-            mask_box_results = outputs["pred_boxes"]
-            # upsample masks
+            outputs, _ = self.sem_seg_head(features, task_ids=task_ids, image_index=image_index)
+            return self.postprocess(outputs, batched_inputs, images, task_ids, image_index)
+
+    def postprocess(self, outputs, batched_inputs, images, task_ids, image_index):
+        """
+        Turn the outputs of the head at inference into the results of every image, see :meth:`forward`.
+        """
+        mask_cls_results = outputs["pred_logits"]
+        mask_pred_results = outputs["pred_masks"]
+        mask_box_results = outputs["pred_boxes"]
+        # upsample masks
+        if len(mask_pred_results):
             mask_pred_results = F.interpolate(
                 mask_pred_results,
                 size=(images.tensor.shape[-2], images.tensor.shape[-1]),
                 mode="bilinear",
                 align_corners=False,
             )
+        # the samples that were decoded, the relevance gate of the decoder skips the others
+        kept = outputs["kept"].tolist() if "kept" in outputs else None
+        relevance = outputs.get("relevance")
 
-            del outputs
-
-            processed_results = []
-            for mask_cls_result, mask_pred_result, mask_box_result, input_per_image, image_size in zip(
-                mask_cls_results, mask_pred_results, mask_box_results, batched_inputs, images.image_sizes
-            ):  # image_size is augmented size, not divisible to 32
-                height = input_per_image.get("height", image_size[0])  # real size
-                width = input_per_image.get("width", image_size[1])
-                processed_results.append({})
-                new_size = mask_pred_result.shape[-2:]  # padded size (divisible to 32)
-
-
-                if self.sem_seg_postprocess_before_inference:
-                    mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
-                        mask_pred_result, image_size, height, width
-                    )
-                    mask_cls_result = mask_cls_result.to(mask_pred_result)
-                    # mask_box_result = mask_box_result.to(mask_pred_result)
-                    # mask_box_result = self.box_postprocess(mask_box_result, height, width)
-
-                # semantic segmentation inference
-                if self.semantic_on:
-                    r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
-                    if not self.sem_seg_postprocess_before_inference:
-                        r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
-                    processed_results[-1]["sem_seg"] = r
-
-                # panoptic segmentation inference
-                if self.panoptic_on:
-                    panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
-                    processed_results[-1]["panoptic_seg"] = panoptic_r
-
-                # instance segmentation inference
+        del outputs
 
-                if self.instance_on:
-                    mask_box_result = mask_box_result.to(mask_pred_result)
-                    height = new_size[0]/image_size[0]*height
-                    width = new_size[1]/image_size[1]*width
-                    mask_box_result = self.box_postprocess(mask_box_result, height, width)
+        if image_index is None:
+            sample_inputs = batched_inputs
+            sample_sizes = images.image_sizes
+        else:
+            sample_inputs = [batched_inputs[i] for i in image_index.tolist()]
+            sample_sizes = [images.image_sizes[i] for i in image_index.tolist()]
+        decoded = range(len(sample_inputs)) if kept is None else kept
+
+        processed_results = []
+        for mask_cls_result, mask_pred_result, mask_box_result, j in zip(
+            mask_cls_results, mask_pred_results, mask_box_results, decoded
+        ):  # image_size is augmented size, not divisible to 32
+            input_per_image, image_size = sample_inputs[j], sample_sizes[j]
+            height = input_per_image.get("height", image_size[0])  # real size
+            width = input_per_image.get("width", image_size[1])
+            processed_results.append({})
+            new_size = mask_pred_result.shape[-2:]  # padded size (divisible to 32)
+
+
+            if self.sem_seg_postprocess_before_inference:
+                mask_pred_result = retry_if_cuda_oom(sem_seg_postprocess)(
+                    mask_pred_result, image_size, height, width
+                )
+                mask_cls_result = mask_cls_result.to(mask_pred_result)
+                # mask_box_result = mask_box_result.to(mask_pred_result)
+                # mask_box_result = self.box_postprocess(mask_box_result, height, width)
+
+            # semantic segmentation inference
+            if self.semantic_on:
+                r = retry_if_cuda_oom(self.semantic_inference)(mask_cls_result, mask_pred_result)
+                if not self.sem_seg_postprocess_before_inference:
+                    r = retry_if_cuda_oom(sem_seg_postprocess)(r, image_size, height, width)
+                processed_results[-1]["sem_seg"] = r
+
+            # panoptic segmentation inference
+            if self.panoptic_on:
+                panoptic_r = retry_if_cuda_oom(self.panoptic_inference)(mask_cls_result, mask_pred_result)
+                processed_results[-1]["panoptic_seg"] = panoptic_r
+
+            # instance segmentation inference
+
+            if self.instance_on:
+                mask_box_result = mask_box_result.to(mask_pred_result)
+                height = new_size[0]/image_size[0]*height
+                width = new_size[1]/image_size[1]*width
+                mask_box_result = self.box_postprocess(mask_box_result, height, width)
+
+                instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result, mask_box_result)
+                processed_results[-1]["instances"] = instance_r
+
+        if kept is not None:
+            processed_results = self.fill_skipped_results(
+                sample_inputs, sample_sizes, images.tensor.shape[-2:], kept, processed_results
+            )
+        if relevance is not None:
+            for r, score in zip(processed_results, relevance.tolist()):
+                r["relevance"] = score
+        if image_index is not None:
+            processed_results = self.group_task_results(batched_inputs, task_ids, image_index, processed_results)
+        return processed_results
+
+    def fill_skipped_results(self, sample_inputs, sample_sizes, padded_size, kept, decoded_results):
+        """
+        Put the results of the decoded samples back in the order of all the samples, the ones
+        skipped by the relevance gate get no instances.
+        """
+        processed_results = [None] * len(sample_inputs)
+        for j, r in zip(kept, decoded_results):
+            processed_results[j] = r
+        for j, (x, image_size) in enumerate(zip(sample_inputs, sample_sizes)):
+            if processed_results[j] is not None:
+                continue
+            # the size of the masks of the decoded samples
+            if self.sem_seg_postprocess_before_inference:
+                mask_size = (x.get("height", image_size[0]), x.get("width", image_size[1]))
+            else:
+                mask_size = tuple(padded_size)
+            processed_results[j] = {"instances": self.empty_instances(mask_size)}
+        return processed_results
 
-                    instance_r = retry_if_cuda_oom(self.instance_inference)(mask_cls_result, mask_pred_result, mask_box_result)
-                    processed_results[-1]["instances"] = instance_r
+    def empty_instances(self, image_size):
+        result = Instances(image_size)
+        result.pred_masks = torch.zeros((0,) + tuple(image_size), device=self.device)
+        result.pred_boxes = Boxes(torch.zeros((0, 4), device=self.device))
+        result.scores = torch.zeros((0,), device=self.device)
+        result.pred_classes = torch.zeros((0,), dtype=torch.int64, device=self.device)
+        return result
 
-            return processed_results
+    def prepare_task_ids(self, batched_inputs):
+        """
+        Flatten the task ids of a batch into one (image, task) sample per entry.
+        Records of the multi-task datasets carry a "task_ids" list and are expanded into
+        one sample per task; `image_index` maps every sample back to its image and is None
+        for single-task records. The task ids are an int64 tensor, which indexes the knowledge
+        of the decoder.
+        """
+        if not any("task_ids" in x for x in batched_inputs):
+            task_ids = [x["task_id"] for x in batched_inputs]
+            return torch.as_tensor(task_ids, dtype=torch.int64).to(self.device), None
+        task_ids = []
+        image_index = []
+        for i, x in enumerate(batched_inputs):
+            ids = x["task_ids"] if "task_ids" in x else [x["task_id"]]
+            task_ids += ids
+            image_index += [i] * len(ids)
+        task_ids = torch.as_tensor(task_ids, dtype=torch.int64).to(self.device)
+        return task_ids, torch.as_tensor(image_index, dtype=torch.int64).to(self.device)
+
+    def group_task_results(self, batched_inputs, task_ids, image_index, sample_results):
+        """
+        Gather the per-sample results of a multi-task batch back to one dict per image,
+        with a "task_results" list of dicts that hold the "task_id" and the results of the task.
+        """
+        processed_results = [{"task_results": []} for _ in batched_inputs]
+        for task_id, i, r in zip(task_ids.tolist(), image_index.tolist(), sample_results):
+            r["task_id"] = task_id
+            processed_results[i]["task_results"].append(r)
+        return processed_results
 
     def prepare_targets(self, targets, images):
         h_pad, w_pad = images.tensor.shape[-2:]
@@ -456,7 +572,7 @@ class CoTDet(nn.Module):
         # mask_pred is already processed to have the same shape as original input
         image_size = mask_pred.shape[-2:]
         scores = mask_cls.sigmoid()  # [100, 80]
-        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(self.num_queries, 1).flatten(0, 1)
+        labels = torch.arange(self.sem_seg_head.num_classes, device=self.device).unsqueeze(0).repeat(scores.shape[0], 1).flatten(0, 1)
         scores_per_image, topk_indices = scores.flatten(0, 1).topk(self.test_topk_per_image, sorted=False)  # select 100
         labels_per_image = labels[topk_indices]
         #############################################################
@@ -37,6 +37,17 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
     Returns:
         Loss tensor
     """
+    loss = sigmoid_focal_loss_elementwise(inputs, targets, alpha, gamma)
+
+    return loss.mean(1).sum() / num_boxes
+
+
+def sigmoid_focal_loss_elementwise(inputs, targets, alpha: float = 0.25, gamma: float = 2):
+    """
+    Same as sigmoid_focal_loss, without the reduction.
+    Returns:
+        Loss tensor with the same shape as inputs
+    """
     prob = inputs.sigmoid()
     ce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
     p_t = prob * targets + (1 - prob) * (1 - targets)
@@ -46,8 +57,7 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
         alpha_t = alpha * targets + (1 - alpha) * (1 - targets)
         loss = alpha_t * loss
 
-
-    return loss.mean(1).sum() / num_boxes
+    return loss
 
 def dice_loss(
         inputs: torch.Tensor,
@@ -126,7 +136,8 @@ class SetCriterion(nn.Module):
     """
 
     def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses,
-                 num_points, oversample_ratio, importance_sample_ratio,dn="no",dn_losses=[], panoptic_on=False, semantic_ce_loss=False):
+                 num_points, oversample_ratio, importance_sample_ratio,dn="no",dn_losses=[], panoptic_on=False, semantic_ce_loss=False,
+                 fused=False):
         """Create the criterion.
         Parameters:
             num_classes: number of object categories, omitting the special no-object category
@@ -134,6 +145,7 @@ class SetCriterion(nn.Module):
             weight_dict: dict containing as key the names of the losses and as values their relative weight.
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses.
+            fused: compute each loss for all the layers at once, see forward_fused.
         """
         super().__init__()
         self.num_classes = num_classes
@@ -155,6 +167,12 @@ class SetCriterion(nn.Module):
 
         self.panoptic_on = panoptic_on
         self.semantic_ce_loss = semantic_ce_loss
+        if fused and (panoptic_on or semantic_ce_loss):
+            logging.getLogger(__name__).warning(
+                "The fused criterion only supports the focal and box losses, it is disabled."
+            )
+            fused = False
+        self.fused = fused
 
     def loss_labels_ce(self, outputs, targets, indices, num_masks):
         """Classification loss (NLL)
@@ -211,9 +229,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
 
         return losses
@@ -236,9 +254,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
 
         return losses
@@ -318,6 +336,41 @@ class SetCriterion(nn.Module):
         tgt_idx = torch.cat([tgt for (_, tgt) in indices])
         return batch_idx, tgt_idx
 
+    def _get_dn_indices(self, targets, scalar, single_pad):
+        exc_idx = []
+        for i in range(len(targets)):
+            device = targets[i]['labels'].device
+            if len(targets[i]['labels']) > 0:
+                t = torch.arange(0, len(targets[i]['labels']), device=device).long()
+                t = t.unsqueeze(0).repeat(scalar, 1)
+                tgt_idx = t.flatten()
+                output_idx = (torch.arange(scalar, device=device) * single_pad).long().unsqueeze(1) + t
+                output_idx = output_idx.flatten()
+            else:
+                output_idx = tgt_idx = torch.tensor([], device=device).long()
+            exc_idx.append((output_idx, tgt_idx))
+        return exc_idx
+
+    def _get_num_masks(self, outputs, targets):
+        # Compute the average number of target boxes accross all nodes, for normalization purposes
+        num_masks = sum(len(t["labels"]) for t in targets)
+        num_masks = torch.as_tensor(
+            [num_masks], dtype=torch.float, device=next(iter(outputs.values())).device
+        )
+        if is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(num_masks)
+        return torch.clamp(num_masks / get_world_size(), min=1).item()
+
+    def _get_zero_dn_losses(self, suffix, device):
+        l_dict = dict()
+        l_dict['loss_bbox' + suffix] = torch.as_tensor(0., device=device)
+        l_dict['loss_giou' + suffix] = torch.as_tensor(0., device=device)
+        l_dict['loss_ce' + suffix] = torch.as_tensor(0., device=device)
+        if self.dn == "seg":
+            l_dict['loss_mask' + suffix] = torch.as_tensor(0., device=device)
+            l_dict['loss_dice' + suffix] = torch.as_tensor(0., device=device)
+        return l_dict
+
     def get_loss(self, loss, outputs, targets, indices, num_masks):
         loss_map = {
             'labels': self.loss_labels_ce if self.semantic_ce_loss else self.loss_labels,
@@ -334,31 +387,16 @@ class SetCriterion(nn.Module):
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
         """
+        if self.fused:
+            return self.forward_fused(outputs, targets, mask_dict)
         outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
 
         # Retrieve the matching between the outputs of the last layer and the targets
-        if self.dn is not "no" and mask_dict is not None:
+        if self.dn != "no" and mask_dict is not None:
             output_known_lbs_bboxes,num_tgt,single_pad,scalar = self.prep_for_dn(mask_dict)
-            exc_idx = []
-            for i in range(len(targets)):
-                if len(targets[i]['labels']) > 0:
-                    t = torch.arange(0, len(targets[i]['labels'])).long().cuda()
-                    t = t.unsqueeze(0).repeat(scalar, 1)
-                    tgt_idx = t.flatten()
-                    output_idx = (torch.tensor(range(scalar)) * single_pad).long().cuda().unsqueeze(1) + t
-                    output_idx = output_idx.flatten()
-                else:
-                    output_idx = tgt_idx = torch.tensor([]).long().cuda()
-                exc_idx.append((output_idx, tgt_idx))
+            exc_idx = self._get_dn_indices(targets, scalar, single_pad)
         indices = self.matcher(outputs_without_aux, targets)
-        # Compute the average number of target boxes accross all nodes, for normalization purposes
-        num_masks = sum(len(t["labels"]) for t in targets)
-        num_masks = torch.as_tensor(
-            [num_masks], dtype=torch.float, device=next(iter(outputs.values())).device
-        )
-        if is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_masks)
-        num_masks = torch.clamp(num_masks / get_world_size(), min=1).item()
+        num_masks = self._get_num_masks(outputs, targets)
 
         # Compute all the requested losses
         losses = {}
@@ -373,14 +411,7 @@ class SetCriterion(nn.Module):
             losses.update(l_dict)
             # import pdb;pdb.set_trace()
         elif self.dn != "no":
-            l_dict = dict()
-            l_dict['loss_bbox_dn'] = torch.as_tensor(0.).to('cuda')
-            l_dict['loss_giou_dn'] = torch.as_tensor(0.).to('cuda')
-            l_dict['loss_ce_dn'] = torch.as_tensor(0.).to('cuda')
-            if self.dn == "seg":
-                l_dict['loss_mask_dn'] = torch.as_tensor(0.).to('cuda')
-                l_dict['loss_dice_dn'] = torch.as_tensor(0.).to('cuda')
-            losses.update(l_dict)
+            losses.update(self._get_zero_dn_losses('_dn', outputs['pred_logits'].device))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if "aux_outputs" in outputs:
@@ -406,14 +437,7 @@ class SetCriterion(nn.Module):
                         losses.update(l_dict)
                         # import pdb;pdb.set_trace()
                     elif self.dn != "no":
-                        l_dict = dict()
-                        l_dict[f'loss_bbox_dn_{i}'] = torch.as_tensor(0.).to('cuda')
-                        l_dict[f'loss_giou_dn_{i}'] = torch.as_tensor(0.).to('cuda')
-                        l_dict[f'loss_ce_dn_{i}'] = torch.as_tensor(0.).to('cuda')
-                        if self.dn == "seg":
-                            l_dict[f'loss_mask_dn_{i}'] = torch.as_tensor(0.).to('cuda')
-                            l_dict[f'loss_dice_dn_{i}'] = torch.as_tensor(0.).to('cuda')
-                        losses.update(l_dict)
+                        losses.update(self._get_zero_dn_losses(f'_dn_{i}', outputs['pred_logits'].device))
         # interm_outputs loss
         if 'interm_outputs' in outputs:
             interm_outputs = outputs['interm_outputs']
@@ -425,6 +449,178 @@ class SetCriterion(nn.Module):
 
         return losses
 
+    def forward_fused(self, outputs, targets, mask_dict=None):
+        """Same losses as forward, but each loss is computed for the main output, the auxiliary
+        outputs and the intermediate outputs in one batched call, then again for all the DN
+        outputs, see fused_losses. The matching is still done layer by layer.
+        """
+        outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
+        aux_outputs = outputs.get("aux_outputs", [])
+        num_masks = self._get_num_masks(outputs, targets)
+
+        layers = [("", outputs_without_aux)] + [(f"_{i}", out) for i, out in enumerate(aux_outputs)]
+        if 'interm_outputs' in outputs:
+            layers.append(("_interm", outputs['interm_outputs']))
+        layer_outputs = [out for _, out in layers]
+        layer_indices = [self.matcher(out, targets) for out in layer_outputs]
+        losses = self._split_fused_losses(
+            self.fused_losses(layer_outputs, targets, layer_indices, self.losses, num_masks),
+            [suffix for suffix, _ in layers],
+        )
+
+        if self.dn != "no":
+            start = 0 if 'interm_outputs' in outputs else 1
+            suffixes = ["_dn"] + [f"_dn_{i}" for i in range(start, len(aux_outputs))]
+            if mask_dict is not None:
+                output_known_lbs_bboxes, num_tgt, single_pad, scalar = self.prep_for_dn(mask_dict)
+                exc_idx = self._get_dn_indices(targets, scalar, single_pad)
+                dn_outputs = [output_known_lbs_bboxes] + output_known_lbs_bboxes['aux_outputs'][start:len(aux_outputs)]
+                losses.update(self._split_fused_losses(
+                    self.fused_losses(dn_outputs, targets, [exc_idx] * len(dn_outputs), self.dn_losses, num_masks * scalar),
+                    suffixes,
+                ))
+            else:
+                for suffix in suffixes:
+                    losses.update(self._get_zero_dn_losses(suffix, outputs['pred_logits'].device))
+
+        return losses
+
+    def _split_fused_losses(self, fused_losses, suffixes):
+        losses = {}
+        for k, v in fused_losses.items():
+            losses.update({k + suffix: loss for suffix, loss in zip(suffixes, v.unbind(0))})
+        return losses
+
+    def fused_losses(self, layer_outputs, targets, layer_indices, losses, num_masks):
+        """Compute the losses of several layers with one call per loss.
+        Parameters:
+            layer_outputs: list of the outputs of L layers, whose predictions have the same shapes
+            layer_indices: list of the L matchings between the predictions and the targets
+        Returns:
+            dict of each loss name to a tensor of shape [L], the losses of get_loss for each layer
+        """
+        device = layer_outputs[0]["pred_logits"].device
+        # concatenate the matched indices of all layers once
+        batch_idx, src_idx, tgt_idx, counts = [], [], [], []
+        for indices in layer_indices:
+            batch, src = self._get_src_permutation_idx(indices)
+            batch_idx.append(batch.to(device))
+            src_idx.append(src.to(device))
+            tgt_idx.append(self._get_tgt_permutation_idx(indices)[1].to(device))
+            counts.append(len(src))
+        batch_idx, src_idx, tgt_idx = torch.cat(batch_idx), torch.cat(src_idx), torch.cat(tgt_idx)
+        layer_idx = torch.repeat_interleave(
+            torch.arange(len(layer_outputs), device=device),
+            torch.as_tensor(counts, device=device),
+            output_size=len(src_idx),
+        )
+        # index of the targets in the concatenation of the targets of all images
+        sizes = [len(t["labels"]) for t in targets]
+        offsets = torch.as_tensor([sum(sizes[:i]) for i in range(len(sizes))], dtype=torch.int64, device=device)
+        tgt_idx = offsets[batch_idx] + tgt_idx
+        idx = (layer_idx, batch_idx, src_idx, tgt_idx)
+
+        loss_map = {
+            'labels': self.fused_loss_labels,
+            'masks': self.fused_loss_masks,
+            'boxes': self.fused_loss_boxes,
+        }
+        fused_losses = {}
+        for loss in losses:
+            assert loss in loss_map, f"do you really want to compute {loss} loss?"
+            fused_losses.update(loss_map[loss](layer_outputs, targets, idx, counts, num_masks))
+        return fused_losses
+
+    def _sum_per_layer(self, values, layer_idx, num_layers):
+        return values.new_zeros(num_layers).index_add(0, layer_idx, values)
+
+    def fused_loss_labels(self, layer_outputs, targets, idx, counts, num_boxes):
+        """loss_labels of all layers at once"""
+        layer_idx, batch_idx, src_idx, tgt_idx = idx
+        src_logits = torch.stack([out['pred_logits'] for out in layer_outputs])  # L x B x Q x C
+
+        target_classes = torch.full(src_logits.shape[:3], self.num_classes,
+                                    dtype=torch.int64, device=src_logits.device)
+        target_classes[layer_idx, batch_idx, src_idx] = torch.cat([t["labels"] for t in targets])[tgt_idx]
+        target_classes_onehot = F.one_hot(target_classes, self.num_classes + 1)[..., :-1].to(src_logits.dtype)
+
+        loss_ce = sigmoid_focal_loss_elementwise(src_logits, target_classes_onehot, alpha=self.focal_alpha, gamma=2)
+        # same as loss.mean(1).sum() * num_queries in loss_labels
+        return {'loss_ce': loss_ce.flatten(1).sum(1) / num_boxes}
+
+    def fused_loss_boxes(self, layer_outputs, targets, idx, counts, num_boxes):
+        """loss_boxes of all layers at once, with the GIoU of the matched pairs only"""
+        layer_idx, batch_idx, src_idx, tgt_idx = idx
+        src_boxes = torch.stack([out['pred_boxes'] for out in layer_outputs])[layer_idx, batch_idx, src_idx]
+        target_boxes = torch.cat([t['boxes'] for t in targets])[tgt_idx]
+
+        loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none').sum(1)
+        loss_giou = 1 - box_ops.generalized_box_iou_pairwise(
+            box_ops.box_cxcywh_to_xyxy(src_boxes),
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
+        return {
+            'loss_bbox': self._sum_per_layer(loss_bbox, layer_idx, len(layer_outputs)) / num_boxes,
+            'loss_giou': self._sum_per_layer(loss_giou, layer_idx, len(layer_outputs)) / num_boxes,
+        }
+
+    def fused_loss_masks(self, layer_outputs, targets, idx, counts, num_masks):
+        """loss_masks of all layers at once"""
+        layer_idx, batch_idx, src_idx, tgt_idx = idx
+        # the mask predictions are too large to be stacked, only the matched ones are gathered
+        src_masks = torch.cat([
+            out["pred_masks"][batch, src]
+            for out, batch, src in zip(layer_outputs, batch_idx.split(counts), src_idx.split(counts))
+        ])[:, None]
+        target_masks = torch.cat([t["masks"] for t in targets])
+
+        with torch.no_grad():
+            point_coords = get_uncertain_point_coords_with_randomness(
+                src_masks,
+                lambda logits: calculate_uncertainty(logits),
+                self.num_points,
+                self.oversample_ratio,
+                self.importance_sample_ratio,
+            )
+            point_labels = self._sample_target_points(target_masks.to(src_masks), tgt_idx, point_coords)
+
+        point_logits = point_sample(
+            src_masks,
+            point_coords,
+            align_corners=False,
+        ).squeeze(1)
+
+        loss_mask = F.binary_cross_entropy_with_logits(point_logits, point_labels, reduction="none").mean(1)
+        point_probs = point_logits.sigmoid()
+        numerator = 2 * (point_probs * point_labels).sum(-1)
+        denominator = point_probs.sum(-1) + point_labels.sum(-1)
+        loss_dice = 1 - (numerator + 1) / (denominator + 1)
+        return {
+            "loss_mask": self._sum_per_layer(loss_mask, layer_idx, len(layer_outputs)) / num_masks,
+            "loss_dice": self._sum_per_layer(loss_dice, layer_idx, len(layer_outputs)) / num_masks,
+        }
+
+    def _sample_target_points(self, target_masks, tgt_idx, point_coords):
+        """Sample the target mask of every matched pair at its points, without a copy of the
+        target masks per pair.
+        """
+        num_targets, num_points = len(target_masks), point_coords.shape[1]
+        repeats = len(tgt_idx) // max(num_targets, 1)
+        # each target is usually matched once per layer (or `scalar` times per DN layer), then
+        # the points of all its pairs are sampled in one row of its mask
+        if num_targets > 0 and bool((torch.bincount(tgt_idx, minlength=num_targets) == repeats).all()):
+            order = torch.argsort(tgt_idx, stable=True)
+            point_labels = point_sample(
+                target_masks[:, None],
+                point_coords[order].reshape(num_targets, repeats * num_points, 2),
+                align_corners=False,
+            ).reshape(-1, num_points)
+            return torch.empty_like(point_labels).index_copy_(0, order, point_labels)
+        return point_sample(
+            target_masks[tgt_idx][:, None],
+            point_coords,
+            align_corners=False,
+        ).squeeze(1)
+
     def __repr__(self):
         head = "Criterion " + self.__class__.__name__
         body = [
@@ -2,6 +2,7 @@
 # Modified from Mask2Former https://github.com/facebookresearch/Mask2Former by Feng Li and Hao Zhang.
 # ------------------------------------------------------------------------------
 import logging
+from functools import partial
 from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from torch import nn
@@ -94,12 +95,32 @@ class DetHead(nn.Module):
             ),
         }
 
-    def forward(self, features, mask=None, task_ids=None, targets=None):
-        return self.layers(features, mask, task_ids, targets=targets)
-
-    def layers(self, features, mask=None, task_ids=None, targets=None):
-        mask_features, transformer_encoder_features, multi_scale_features = self.pixel_decoder.forward_features(features, mask)
+    def forward(self, features, mask=None, task_ids=None, targets=None, image_index=None):
+        return self.layers(features, mask, task_ids, targets=targets, image_index=image_index)
 
+    def layers(self, features, mask=None, task_ids=None, targets=None, image_index=None):
+        mask_features, multi_scale_features = self.encode(features, mask, task_ids, image_index=image_index)
         predictions = self.predictor(multi_scale_features, mask_features, mask, task_ids, targets=targets)
 
         return predictions
+
+    def encode(self, features, mask=None, task_ids=None, image_index=None):
+        """
+        Run the pixel encoder, the part of the head before the decoder.
+
+        Returns:
+            mask_features, multi_scale_features: the inputs of the decoder, of every sample
+        """
+        token_scorer = None
+        if self.pixel_decoder.sparse_ratio < 1:
+            # the encoder only refines the tokens that are relevant to the tasks of the image
+            token_scorer = partial(self.predictor.score_tokens, task_ids=task_ids, image_index=image_index)
+        mask_features, transformer_encoder_features, multi_scale_features = self.pixel_decoder.forward_features(
+            features, mask, token_scorer=token_scorer
+        )
+        if image_index is not None:
+            # the pixel encoder does not depend on the task, so it runs once per image
+            # and its outputs are repeated for every (image, task) sample
+            mask_features = mask_features[image_index]
+            multi_scale_features = [f[image_index] for f in multi_scale_features]
+        return mask_features, multi_scale_features
@@ -21,37 +21,57 @@ from torch.autograd.function import once_differentiable
 try:
     import MultiScaleDeformableAttention as MSDA
 except ModuleNotFoundError as e:
-    info_string = (
-        "\n\nPlease compile MultiScaleDeformableAttention CUDA op with the following commands:\n"
-        "\t`cd maskdino/modeling/pixel_decoder/ops`\n"
-        "\t`sh make.sh`\n"
-    )
-    raise ModuleNotFoundError(info_string)
+    if torch.cuda.is_available():
+        info_string = (
+            "\n\nPlease compile MultiScaleDeformableAttention CUDA op with the following commands:\n"
+            "\t`cd maskdino/modeling/pixel_decoder/ops`\n"
+            "\t`sh make.sh`\n"
+        )
+        raise ModuleNotFoundError(info_string)
+    # CPU only: MSDeformAttn falls back to ms_deform_attn_core_pytorch
+    MSDA = None
+
+
+def _compute_dtype(dtype):
+    # half and bfloat16 inputs are sampled and accumulated in fp32
+    return torch.float32 if dtype in (torch.float16, torch.bfloat16) else dtype
 
 
 class MSDeformAttnFunction(Function):
     @staticmethod
     def forward(ctx, value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, im2col_step):
         ctx.im2col_step = im2col_step
+        dtype = _compute_dtype(value.dtype)
         output = MSDA.ms_deform_attn_forward(
-            value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, ctx.im2col_step)
+            value.to(dtype), value_spatial_shapes, value_level_start_index,
+            sampling_locations.to(dtype), attention_weights.to(dtype), ctx.im2col_step)
+        # saved in their own precision, the fp32 copies are only alive during the kernels
         ctx.save_for_backward(value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights)
-        return output
+        return output.to(value.dtype)
 
     @staticmethod
     @once_differentiable
     def backward(ctx, grad_output):
         value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights = ctx.saved_tensors
+        dtype = _compute_dtype(value.dtype)
         grad_value, grad_sampling_loc, grad_attn_weight = \
             MSDA.ms_deform_attn_backward(
-                value, value_spatial_shapes, value_level_start_index, sampling_locations, attention_weights, grad_output, ctx.im2col_step)
+                value.to(dtype), value_spatial_shapes, value_level_start_index, sampling_locations.to(dtype),
+                attention_weights.to(dtype), grad_output.to(dtype).contiguous(), ctx.im2col_step)
 
-        return grad_value, None, None, grad_sampling_loc, grad_attn_weight, None
+        return grad_value.to(value.dtype), None, None, grad_sampling_loc.to(sampling_locations.dtype), \
+            grad_attn_weight.to(attention_weights.dtype), None
 
 
 def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights):
     # for debug and test only,
     # need to use cuda version instead
+    # half and bfloat16 are sampled and accumulated in fp32, e.g. bfloat16 on CPU where
+    # grid_sample does not support it, the output has the dtype of value
+    out_dtype = value.dtype
+    dtype = _compute_dtype(value.dtype)
+    value, sampling_locations, attention_weights = \
+        value.to(dtype), sampling_locations.to(dtype), attention_weights.to(dtype)
     N_, S_, M_, D_ = value.shape
     _, Lq_, M_, L_, P_, _ = sampling_locations.shape
     value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
@@ -69,4 +89,4 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     # (N_, Lq_, M_, L_, P_) -> (N_, M_, Lq_, L_, P_) -> (N_, M_, 1, Lq_, L_*P_)
     attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
     output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
-    return output.transpose(1, 2).contiguous()
+    return output.transpose(1, 2).contiguous().to(out_dtype)
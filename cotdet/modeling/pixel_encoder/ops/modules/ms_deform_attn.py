@@ -22,7 +22,7 @@ import torch.nn.functional as F
 from torch.nn.init import xavier_uniform_, constant_
 
 from ..functions import MSDeformAttnFunction
-from ..functions.ms_deform_attn_func import ms_deform_attn_core_pytorch
+from ..functions.ms_deform_attn_func import MSDA, ms_deform_attn_core_pytorch
 
 
 def _is_power_of_2(n):
@@ -50,6 +50,8 @@ class MSDeformAttn(nn.Module):
                           "which is more efficient in our CUDA implementation.")
 
         self.im2col_step = 128
+        # the compiled op can not be exported, cotdet.export.pytorch_deformable_attention turns it off
+        self.use_msda = True
 
         self.d_model = d_model
         self.n_levels = n_levels
@@ -99,7 +101,12 @@ class MSDeformAttn(nn.Module):
         if input_padding_mask is not None:
             value = value.masked_fill(input_padding_mask[..., None], float(0))
         value = value.view(N, Len_in, self.n_heads, self.d_model // self.n_heads)
+        # the sampling locations are kept in fp32 with AMP, float16 and bfloat16 would round them
+        # to 1/2048 and 1/256 of the feature map
         sampling_offsets = self.sampling_offsets(query).view(N, Len_q, self.n_heads, self.n_levels, self.n_points, 2)
+        if sampling_offsets.dtype in (torch.float16, torch.bfloat16):
+            sampling_offsets = sampling_offsets.float()
+            reference_points = reference_points.float()
         attention_weights = self.attention_weights(query).view(N, Len_q, self.n_heads, self.n_levels * self.n_points)
         attention_weights = F.softmax(attention_weights, -1).view(N, Len_q, self.n_heads, self.n_levels, self.n_points)
         # N, Len_q, n_heads, n_levels, n_points, 2
@@ -113,13 +120,12 @@ class MSDeformAttn(nn.Module):
         else:
             raise ValueError(
                 'Last dim of reference_points must be 2 or 4, but get {} instead.'.format(reference_points.shape[-1]))
-        try:
+        if self.use_msda and MSDA is not None and value.is_cuda:
             output = MSDeformAttnFunction.apply(
                 value, input_spatial_shapes, input_level_start_index, sampling_locations, attention_weights, self.im2col_step)
-        except:
+        else:
             # CPU
             output = ms_deform_attn_core_pytorch(value, input_spatial_shapes, sampling_locations, attention_weights)
-        # # For FLOPs calculation only
-        # output = ms_deform_attn_core_pytorch(value, input_spatial_shapes, sampling_locations, attention_weights)
+        # FLOPs of both paths are counted by cotdet.utils.analysis
         output = self.output_proj(output)
         return output
@@ -1,6 +1,7 @@
 # Copyright (c) IDEA, Inc. and its affiliates.
 # Modified from Mask2Former https://github.com/facebookresearch/Mask2Former by Feng Li and Hao Zhang.
 import logging
+import math
 import numpy as np
 from typing import Callable, Dict, List, Optional, Tuple, Union
 import fvcore.nn.weight_init as weight_init
@@ -9,7 +10,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.nn.init import xavier_uniform_, constant_, uniform_, normal_
-from torch.cuda.amp import autocast
+from torch.utils.checkpoint import checkpoint
 
 from detectron2.config import configurable
 from detectron2.layers import Conv2d, ShapeSpec, get_norm
@@ -18,6 +19,7 @@ from detectron2.modeling import SEM_SEG_HEADS_REGISTRY
 from .position_encoding import PositionEmbeddingSine
 from ...utils.utils import _get_clones, _get_activation_fn
 from .ops.modules import MSDeformAttn
+from ...utils.shape_cache import SHAPE_CACHE
 
 def build_pixel_decoder(cfg, input_shape):
     """
@@ -38,16 +40,19 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
     def __init__(self, d_model=256, nhead=8,
                  num_encoder_layers=6, dim_feedforward=1024, dropout=0.1,
                  activation="relu",
-                 num_feature_levels=4, enc_n_points=4,):
+                 num_feature_levels=4, enc_n_points=4,
+                 checkpoint_layers=(), sparse_ratio=1.0):
         super().__init__()
 
         self.d_model = d_model
         self.nhead = nhead
+        # fraction of the tokens refined by the encoder layers when they are scored
+        self.sparse_ratio = sparse_ratio
 
         encoder_layer = MSDeformAttnTransformerEncoderLayer(d_model, dim_feedforward,
                                                             dropout, activation,
                                                             num_feature_levels, nhead, enc_n_points)
-        self.encoder = MSDeformAttnTransformerEncoder(encoder_layer, num_encoder_layers)
+        self.encoder = MSDeformAttnTransformerEncoder(encoder_layer, num_encoder_layers, checkpoint_layers)
 
         self.level_embed = nn.Parameter(torch.Tensor(num_feature_levels, d_model))
 
@@ -71,40 +76,72 @@ class MSDeformAttnTransformerEncoderOnly(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
-    def forward(self, srcs, masks, pos_embeds):
+    def get_levels(self, masks, spatial_shapes):
+        """
+        Returns:
+            the flattened padding mask, the spatial shapes, the start index of every level and
+            the valid ratios of the levels
+        """
+        device = masks[0].device
+        mask_flatten = torch.cat([mask.flatten(1) for mask in masks], 1)
+        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=device)
+        level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
+        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        return mask_flatten, spatial_shapes, level_start_index, valid_ratios
+
+    def select_tokens(self, src_flatten, mask_flatten, token_scorer):
+        """
+        Returns:
+            the indices of the `sparse_ratio` fraction of the tokens with the highest scores,
+            bs, num_tokens, or None to refine all the tokens
+        """
+        if token_scorer is None or self.sparse_ratio >= 1:
+            return None
+        num_tokens = max(1, int(math.ceil(src_flatten.shape[1] * self.sparse_ratio)))
+        with torch.no_grad():
+            scores = token_scorer(src_flatten).masked_fill(mask_flatten, float("-inf"))
+            return torch.topk(scores, num_tokens, dim=1)[1]
+
+    def forward(self, srcs, masks, pos_embeds, token_scorer=None):
 
         enable_mask=0
         if masks is not None:
             for src in srcs:
                 if src.size(2)%32 or src.size(3)%32:
                     enable_mask = 1
+        # without padding, the masks and what is computed from them only depend on the shapes
+        shape_key = None
         if enable_mask==0:
-            masks = [torch.zeros((x.size(0), x.size(2), x.size(3)), device=x.device, dtype=torch.bool) for x in srcs]
+            shape_key = (tuple(x.shape[-2:] for x in srcs), srcs[0].size(0), srcs[0].device)
+            masks = SHAPE_CACHE.get(("encoder_masks",) + shape_key, lambda: [
+                torch.zeros((x.size(0), x.size(2), x.size(3)), device=x.device, dtype=torch.bool) for x in srcs
+            ])
         # prepare input for encoder
         src_flatten = []
-        mask_flatten = []
         lvl_pos_embed_flatten = []
         spatial_shapes = []
-        for lvl, (src, mask, pos_embed) in enumerate(zip(srcs, masks, pos_embeds)):
+        for lvl, (src, pos_embed) in enumerate(zip(srcs, pos_embeds)):
             bs, c, h, w = src.shape
             spatial_shape = (h, w)
             spatial_shapes.append(spatial_shape)
             src = src.flatten(2).transpose(1, 2)
-            mask = mask.flatten(1)
             pos_embed = pos_embed.flatten(2).transpose(1, 2)
             lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)
             lvl_pos_embed_flatten.append(lvl_pos_embed)
             src_flatten.append(src)
-            mask_flatten.append(mask)
         src_flatten = torch.cat(src_flatten, 1)
-        mask_flatten = torch.cat(mask_flatten, 1)
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
-        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
-        level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        if shape_key is None:
+            mask_flatten, spatial_shapes, level_start_index, valid_ratios = self.get_levels(masks, spatial_shapes)
+        else:
+            mask_flatten, spatial_shapes, level_start_index, valid_ratios = SHAPE_CACHE.get(
+                ("encoder_levels",) + shape_key, lambda: self.get_levels(masks, spatial_shapes)
+            )
 
         # encoder
-        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten,
+                              mask_flatten, shape_key=shape_key,
+                              token_indices=self.select_tokens(src_flatten, mask_flatten, token_scorer))
 
         return memory, spatial_shapes, level_start_index
 
@@ -139,9 +176,13 @@ class MSDeformAttnTransformerEncoderLayer(nn.Module):
         src = self.norm2(src)
         return src
 
-    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask=None):
+    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask=None, value=None):
+        """
+        value: the tokens attended to, if only some of them are refined as `src`
+        """
         # self attention
-        src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, level_start_index, padding_mask)
+        value = src if value is None else value
+        src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, value, spatial_shapes, level_start_index, padding_mask)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
 
@@ -152,10 +193,12 @@ class MSDeformAttnTransformerEncoderLayer(nn.Module):
 
 
 class MSDeformAttnTransformerEncoder(nn.Module):
-    def __init__(self, encoder_layer, num_layers):
+    def __init__(self, encoder_layer, num_layers, checkpoint_layers=()):
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
+        # indices of the layers whose activations are recomputed in backward
+        self.checkpoint_layers = set(checkpoint_layers)
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
@@ -172,11 +215,51 @@ class MSDeformAttnTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None, shape_key=None,
+                token_indices=None):
+        """
+        shape_key: the key of the reference points in SHAPE_CACHE, None to compute them
+        token_indices: bs, num_tokens, the tokens refined by the layers, None for all. The others
+            are attended to and passed through unchanged
+        """
         output = src
-        reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
-        for _, layer in enumerate(self.layers):
-            output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
+        if shape_key is None:
+            reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
+        else:
+            reference_points = SHAPE_CACHE.get(
+                ("encoder_reference_points",) + shape_key,
+                lambda: self.get_reference_points(spatial_shapes, valid_ratios, device=src.device),
+            )
+        if token_indices is not None:
+            return self.forward_sparse(output, spatial_shapes, level_start_index, pos, padding_mask, reference_points,
+                                       token_indices)
+        for layer_id, layer in enumerate(self.layers):
+            if layer_id in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                output = checkpoint(layer, output, pos, reference_points, spatial_shapes, level_start_index,
+                                    padding_mask, use_reentrant=False)
+            else:
+                output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
+
+        return output
+
+    def forward_sparse(self, output, spatial_shapes, level_start_index, pos, padding_mask, reference_points,
+                       token_indices):
+        # the selected tokens attend to all the tokens and are scattered back after every layer
+        bs, num_tokens = token_indices.shape
+        indices = token_indices[..., None].expand(-1, -1, output.shape[-1])
+        pos = torch.gather(pos, 1, indices) if pos is not None else None
+        reference_points = torch.gather(
+            reference_points.expand(bs, -1, -1, -1), 1,
+            token_indices[..., None, None].expand(-1, -1, *reference_points.shape[-2:])
+        )
+        for layer_id, layer in enumerate(self.layers):
+            tokens = torch.gather(output, 1, indices)
+            if layer_id in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                tokens = checkpoint(layer, tokens, pos, reference_points, spatial_shapes, level_start_index,
+                                    padding_mask, output, use_reentrant=False)
+            else:
+                tokens = layer(tokens, pos, reference_points, spatial_shapes, level_start_index, padding_mask, output)
+            output = output.scatter(1, indices, tokens.to(output.dtype))
 
         return output
 
@@ -204,6 +287,9 @@ class CoTDetEncoder(nn.Module):
         num_feature_levels: int,
         total_num_feature_levels: int,
         feature_order: str,
+        checkpoint_enc_layers: Tuple[int] = (),
+        amp: bool = True,
+        sparse_ratio: float = 1.0,
     ):
         """
         NOTE: this interface is experimental.
@@ -219,6 +305,10 @@ class CoTDetEncoder(nn.Module):
             num_feature_levels: feature scales used
             total_num_feature_levels: total feautre scales used (include the downsampled features)
             feature_order: 'low2high' or 'high2low', i.e., 'low2high' means low-resolution features are put in the first.
+            checkpoint_enc_layers: indices of the encoder layers that use activation checkpointing in training
+            amp: whether the encoder runs under autocast when it is enabled, or always in fp32
+            sparse_ratio: fraction of the tokens refined by the encoder layers, the most relevant to the
+                tasks according to the `token_scorer` of `forward_features`. The others are passed through
         """
         super().__init__()
         transformer_input_shape = {
@@ -230,6 +320,7 @@ class CoTDetEncoder(nn.Module):
         self.feature_strides = [v.stride for k, v in input_shape]
         self.feature_channels = [v.channels for k, v in input_shape]
         self.feature_order = feature_order
+        self.amp = amp
 
         if feature_order == "low2high":
             transformer_input_shape = sorted(transformer_input_shape.items(), key=lambda x: -x[1].stride)
@@ -280,6 +371,8 @@ class CoTDetEncoder(nn.Module):
             dim_feedforward=transformer_dim_feedforward,
             num_encoder_layers=transformer_enc_layers,
             num_feature_levels=self.total_num_feature_levels,
+            checkpoint_layers=checkpoint_enc_layers,
+            sparse_ratio=sparse_ratio,
         )
         N_steps = conv_dim // 2
         self.pe_layer = PositionEmbeddingSine(N_steps, normalize=True)
@@ -351,15 +444,32 @@ class CoTDetEncoder(nn.Module):
         ret["total_num_feature_levels"] = cfg.MODEL.SEM_SEG_HEAD.TOTAL_NUM_FEATURE_LEVELS
         ret["num_feature_levels"] = cfg.MODEL.SEM_SEG_HEAD.NUM_FEATURE_LEVELS
         ret["feature_order"] = cfg.MODEL.SEM_SEG_HEAD.FEATURE_ORDER
+        ret["checkpoint_enc_layers"] = tuple(cfg.MODEL.CoTDet.CHECKPOINT.ENC_LAYERS)
+        ret["amp"] = cfg.MODEL.SEM_SEG_HEAD.ENCODER_AMP
+        ret["sparse_ratio"] = cfg.MODEL.SEM_SEG_HEAD.ENCODER_SPARSE_RATIO
         return ret
 
-    @autocast(enabled=False)
-    def forward_features(self, features, masks):
+    @property
+    def sparse_ratio(self):
+        return self.transformer.sparse_ratio
+
+    def forward_features(self, features, masks, token_scorer=None):
         """
         :param features: multi-scale features from the backbone
         :param masks: image mask
+        :param token_scorer: a function returning the relevance of the flattened tokens of the encoder
+            (bs, \sum{hxw}, c) as a bs, \sum{hxw} tensor, used when `sparse_ratio` is below 1
         :return: enhanced multi-scale features and mask feature (1/4 resolution) for the decoder to produce binary mask
         """
+        if self.amp:
+            # the deformable attention samples half precision inputs in fp32
+            return self._forward_features(features, masks, token_scorer)
+        # the autocast of the device of the features, not only of CUDA
+        device_type = next(iter(features.values())).device.type
+        with torch.autocast(device_type=device_type, enabled=False):
+            return self._forward_features({k: v.float() for k, v in features.items()}, masks, token_scorer)
+
+    def _forward_features(self, features, masks, token_scorer=None):
         # backbone features
         srcs = []
         pos = []
@@ -367,7 +477,7 @@ class CoTDetEncoder(nn.Module):
         srcsl = []
         posl = []
         if self.total_num_feature_levels > self.transformer_num_feature_levels:
-            smallest_feat = features[self.transformer_in_features[self.low_resolution_index]].float()
+            smallest_feat = features[self.transformer_in_features[self.low_resolution_index]]
             _len_srcs = self.transformer_num_feature_levels
             for l in range(_len_srcs, self.total_num_feature_levels):
                 if l == _len_srcs:
@@ -379,7 +489,7 @@ class CoTDetEncoder(nn.Module):
         srcsl = srcsl[::-1]
         # Reverse feature maps
         for idx, f in enumerate(self.transformer_in_features[::-1]):
-            x = features[f].float()  # deformable detr does not support half precision
+            x = features[f]
             srcs.append(self.input_proj[idx](x))
             pos.append(self.pe_layer(x))
         srcs.extend(srcsl) if self.feature_order == 'low2high' else srcsl.extend(srcs)
@@ -387,7 +497,7 @@ class CoTDetEncoder(nn.Module):
         if self.feature_order != 'low2high':
             srcs = srcsl
             pos = posl
-        y, spatial_shapes, level_start_index = self.transformer(srcs, masks, pos)
+        y, spatial_shapes, level_start_index = self.transformer(srcs, masks, pos, token_scorer=token_scorer)
         bs = y.shape[0]
 
         split_size_or_sections = [None] * self.total_num_feature_levels
@@ -407,7 +517,7 @@ class CoTDetEncoder(nn.Module):
         # append `out` with extra FPN levels
         # Reverse feature maps into top-down order (from low to high resolution)
         for idx, f in enumerate(self.in_features[:self.num_fpn_levels][::-1]):
-            x = features[f].float()
+            x = features[f]
             lateral_conv = self.lateral_convs[idx]
             output_conv = self.output_convs[idx]
             cur_fpn = lateral_conv(x)
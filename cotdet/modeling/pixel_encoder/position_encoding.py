@@ -8,6 +8,8 @@ import math
 import torch
 from torch import nn
 
+from ...utils.shape_cache import SHAPE_CACHE
+
 
 class PositionEmbeddingSine(nn.Module):
     """
@@ -28,7 +30,16 @@ class PositionEmbeddingSine(nn.Module):
 
     def forward(self, x, mask=None):
         if mask is None:
-            mask = torch.zeros((x.size(0), x.size(2), x.size(3)), device=x.device, dtype=torch.bool)
+            # without padding, the embedding is the same for all the images of the batch
+            key = ("position_embedding_sine", self.num_pos_feats, self.temperature, self.normalize, self.scale,
+                   x.size(2), x.size(3), x.device)
+            pos = SHAPE_CACHE.get(
+                key, lambda: self.embed(torch.zeros((1, x.size(2), x.size(3)), device=x.device, dtype=torch.bool))
+            )
+            return pos.expand(x.size(0), -1, -1, -1)
+        return self.embed(mask)
+
+    def embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -37,7 +48,7 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=mask.device)
         dim_t = self.temperature ** (2 * torch.div(dim_t, 2, rounding_mode='trunc') / self.num_pos_feats)
 
         pos_x = x_embed[:, :, :, None] / dim_t
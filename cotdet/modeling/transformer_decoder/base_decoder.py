@@ -3,10 +3,13 @@
 # Modified from DINO https://github.com/IDEA-Research/DINO by Feng Li and Hao Zhang.
 # ------------------------------------------------------------------------
 
+from collections import Counter
+from functools import partial
 from typing import Optional, List, Union
 import torch
 from torch import nn, Tensor
 from torch.cuda.amp import autocast
+from torch.utils.checkpoint import checkpoint
 
 from ...utils.utils import MLP, _get_clones, _get_activation_fn, gen_sineembed_for_position, inverse_sigmoid
 from ..pixel_encoder.ops.modules import MSDeformAttn
@@ -25,7 +28,14 @@ class TransformerDecoder(nn.Module):
                  rm_dec_query_scale=True,
                  dec_layer_share=False,
                  dec_layer_dropout_prob=None,
+                 checkpoint_layers=(),
+                 early_exit=None,
                  ):
+        """
+        early_exit: None, or a dict with the keys min_layers, topk, score_delta, box_delta and
+            score_cutoff to stop decoding at inference, see `is_stable`. The exit is decided for the
+            whole batch, which runs the layers until all its images are stable
+        """
         super().__init__()
         if num_layers > 0:
             self.layers = _get_clones(decoder_layer, num_layers, layer_share=dec_layer_share)
@@ -71,6 +81,12 @@ class TransformerDecoder(nn.Module):
             assert len(dec_layer_number) == num_layers
             # assert dec_layer_number[0] ==
 
+        # indices of the layers whose activations are recomputed in backward
+        self.checkpoint_layers = set(checkpoint_layers)
+        self.early_exit = early_exit
+        # number of batches per number of decoder layers run at inference, with early exit
+        self.batch_exit_depths = Counter()
+
         self.dec_layer_dropout_prob = dec_layer_dropout_prob
         if dec_layer_dropout_prob is not None:
             assert isinstance(dec_layer_dropout_prob, list)
@@ -110,6 +126,8 @@ class TransformerDecoder(nn.Module):
             - valid_ratios/spatial_shapes: bs, nlevel, 2
         """
         output = tgt
+        # class scores of the queries at the previous layer, for the early exit
+        prev_scores = None
 
         intermediate = []
         reference_points = refpoints_unsigmoid.sigmoid()
@@ -122,13 +140,16 @@ class TransformerDecoder(nn.Module):
 
             reference_points_input = reference_points[:, :, None] \
                                          * torch.cat([valid_ratios, valid_ratios], -1)[None, :]  # nq, bs, nlevel, 4
-            query_sine_embed = gen_sineembed_for_position(reference_points_input[:, :, 0, :]) # nq, bs, 256*2
+            query_sine_embed = gen_sineembed_for_position(reference_points_input[:, :, 0, :], self.d_model) # nq, bs, d_model*2
 
-            raw_query_pos = self.ref_point_head(query_sine_embed)  # nq, bs, 256
+            raw_query_pos = self.ref_point_head(query_sine_embed)  # nq, bs, d_model
             pos_scale = self.query_scale(output) if self.query_scale is not None else 1
             query_pos = pos_scale * raw_query_pos
 
-            output = layer(
+            layer_forward = layer
+            if layer_id in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                layer_forward = partial(checkpoint, layer, use_reentrant=False)
+            output = layer_forward(
                 tgt=output,
                 tgt_query_pos=query_pos,
                 tgt_query_sine_embed=query_sine_embed,
@@ -157,13 +178,63 @@ class TransformerDecoder(nn.Module):
                 ref_points.append(new_reference_points)
 
             intermediate.append(self.norm(output))
-
+            if self.training or layer_id == self.num_layers - 1:
+                continue
+
+            early_exit = self.early_exit is not None and self.bbox_embed is not None and not torch.jit.is_tracing()
+            if self.dec_layer_number is None and not early_exit:
+                continue
+            layer_scores = self.class_embed(intermediate[-1]).max(-1)[0]  # nq, bs
+            if early_exit:
+                if layer_id + 1 >= self.early_exit["min_layers"] and \
+                        self.is_stable(layer_scores.sigmoid(), prev_scores, ref_points[-2], ref_points[-1]):
+                    break
+                prev_scores = layer_scores.sigmoid()
+
+            # keep the dec_layer_number[layer_id + 1] queries with the highest class scores for the next layer
+            if self.dec_layer_number is not None:
+                select_number = self.dec_layer_number[layer_id + 1]
+                if select_number < output.shape[0]:
+                    topk_proposals = torch.topk(layer_scores, select_number, dim=0)[1]  # new_nq, bs
+                    output = torch.gather(output, 0, topk_proposals.unsqueeze(-1).repeat(1, 1, output.shape[-1]))
+                    reference_points = torch.gather(
+                        reference_points, 0, topk_proposals.unsqueeze(-1).repeat(1, 1, reference_points.shape[-1])
+                    )
+                    if self.bbox_embed is not None:
+                        ref_points[-1] = reference_points
+                    if early_exit:
+                        prev_scores = torch.gather(prev_scores, 0, topk_proposals)
+
+        if self.early_exit is not None and not self.training:
+            self.batch_exit_depths[len(intermediate)] += 1
         return [
             [itm_out.transpose(0, 1) for itm_out in intermediate],
             [itm_refpoint.transpose(0, 1) for itm_refpoint in ref_points]
         ]
 
 
+    def is_stable(self, scores, prev_scores, prev_boxes, boxes):
+        """
+        Whether the predictions of all the images of the batch stopped changing, for the early exit
+        of the batch: the class scores and boxes of the `topk` best queries changed less than
+        `score_delta` and `box_delta` (max over the normalized cxcywh coordinates) since the previous
+        layer, or the best score is above `score_cutoff`.
+
+        Input:
+            - scores, prev_scores: nq, bs, the class scores after the sigmoid
+            - prev_boxes, boxes: nq, bs, 4, the boxes before and after the layer
+        """
+        # the cutoff does not need the previous layer, e.g. for the first one
+        confident = scores.max(0)[0] > self.early_exit["score_cutoff"]
+        if prev_scores is None:
+            return bool(confident.all())
+        topk = torch.topk(scores, min(self.early_exit["topk"], scores.shape[0]), dim=0)[1]  # k, bs
+        score_delta = (scores - prev_scores).abs().gather(0, topk).max(0)[0]
+        box_delta = (boxes - prev_boxes).abs().max(-1)[0].gather(0, topk).max(0)[0]
+        stable = (score_delta < self.early_exit["score_delta"]) & (box_delta < self.early_exit["box_delta"])
+        return bool((stable | confident).all())
+
+
 class DeformableTransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model=256, d_ffn=1024,
@@ -238,6 +309,8 @@ class DeformableTransformerDecoderLayer(nn.Module):
             - tgt/tgt_query_pos: nq, bs, d_model
             -
         """
+        # the layer runs in fp32, the memory is in half precision when the encoder runs under AMP
+        tgt, memory = tgt.float(), memory.float()
         # self attention
         if self.self_attn is not None:
             q = k = self.with_pos_embed(tgt, tgt_query_pos)
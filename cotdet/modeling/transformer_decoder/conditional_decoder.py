@@ -4,10 +4,12 @@ import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 import logging
+from functools import partial
 import fvcore.nn.weight_init as weight_init
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import pickle
 from detectron2.config import configurable
 from detectron2.layers import Conv2d
@@ -15,6 +17,7 @@ from detectron2.utils.registry import Registry
 from detectron2.structures import BitMasks
 from .base_decoder import TransformerDecoder, DeformableTransformerDecoderLayer
 from ...utils.utils import MLP, gen_encoder_output_proposals, inverse_sigmoid
+from ...utils.shape_cache import SHAPE_CACHE
 from ...utils import box_ops
 
 TRANSFORMER_DECODER_REGISTRY = Registry("TRANSFORMER_MODULE")
@@ -22,6 +25,25 @@ TRANSFORMER_DECODER_REGISTRY.__doc__ = """
 Registry for transformer module in CoTDet.
 """
 
+# the keys of the task prompts and of the knowledge base, by task id
+TASK_CAPTIONS = {
+    0:"step on",
+    1:"sit comfortably",
+    2:"place flowers",
+    3:"get potatoes out of fire",
+    4:"water plant",
+    5:"get lemon out of tea",
+    6:"dig hole",
+    7:"open bottle of beer",
+    8:"open parcel",
+    9:"serve wine",
+    10:"pour sugar",
+    11:"smear butter",
+    12:"extinguish fire",
+    13:"pound carpet"
+}
+
+
 def build_transformer_decoder(cfg, in_channels, mask_classification=True):
     """
     Build a instance embedding branch from `cfg.MODEL.INS_EMBED_HEAD.NAME`.
@@ -87,6 +109,11 @@ class CoTDetDecoder(nn.Module):
             query_dim: int = 4,
             dec_layer_share: bool = False,
             semantic_ce_loss: bool = False,
+            checkpoint_dec_layers: tuple = (),
+            checkpoint_pred_heads: tuple = (),
+            query_schedule: tuple = (),
+            early_exit: dict = None,
+            relevance_threshold: float = 0.0,
     ):
         """
         NOTE: this interface is experimental.
@@ -109,10 +136,19 @@ class CoTDetDecoder(nn.Module):
             activation: activation function
             nhead: num heads in multi-head attention
             dec_n_points: number of sampling points in decoder
+            query_schedule: number of queries of every decoder layer at inference, the queries with the
+                lowest class scores are dropped before the layers that have fewer. Empty to keep all of them
+            early_exit: None to run all the decoder layers at inference, or the criterion to stop after
+                a layer, see `TransformerDecoder.is_stable`
+            relevance_threshold: at inference, the samples whose best token score is below it are not
+                decoded and have no predictions. 0 decodes all of them
             return_intermediate_dec: return the intermediate results of decoder
             query_dim: 4 -> (x, y, w, h)
             dec_layer_share: whether to share each decoder layer
             semantic_ce_loss: use ce loss for semantic segmentation
+            checkpoint_dec_layers: indices of the decoder layers that use activation checkpointing in training
+            checkpoint_pred_heads: indices of the decoder layers whose prediction heads use activation
+                checkpointing in training
         """
         super().__init__()
 
@@ -131,6 +167,10 @@ class CoTDetDecoder(nn.Module):
         self.total_num_feature_levels = total_num_feature_levels
         self.num_queries = num_queries
         self.semantic_ce_loss = semantic_ce_loss
+        self.checkpoint_pred_heads = set(checkpoint_pred_heads)
+        self.relevance_threshold = relevance_threshold
+        # add the similarity maps of the knowledge retrieval to the outputs, for the distillation
+        self.output_knowledge_similarity = False
         # learnable query features
         if not two_stage or self.learn_tgt:
             self.query_feat = nn.Embedding(num_queries, hidden_dim)
@@ -169,6 +209,9 @@ class CoTDetDecoder(nn.Module):
                                           d_model=hidden_dim, query_dim=query_dim,
                                           num_feature_levels=self.num_feature_levels,
                                           dec_layer_share=dec_layer_share,
+                                          checkpoint_layers=checkpoint_dec_layers,
+                                          dec_layer_number=self.check_query_schedule(query_schedule),
+                                          early_exit=early_exit,
                                           )
 
         self.hidden_dim = hidden_dim
@@ -178,32 +221,16 @@ class CoTDetDecoder(nn.Module):
         box_embed_layerlist = [_bbox_embed for i in range(self.num_layers)]  # share box prediction each layer
         self.bbox_embed = nn.ModuleList(box_embed_layerlist)
         self.decoder.bbox_embed = self.bbox_embed
-        self.query_prompts = pickle.load(open(task_name, 'rb'))
+        self.decoder.class_embed = self.class_embed
         self.prompts_poj = MLP(768, hidden_dim, hidden_dim, 3)
-        self.knowledge = pickle.load(open(knowledge_base, 'rb'))
+        self.task_captions = TASK_CAPTIONS
+        self.load_knowledge(pickle.load(open(task_name, 'rb')), pickle.load(open(knowledge_base, 'rb')))
 
         self.know_proj = nn.Linear(768, hidden_dim)
         self.pro_src = MLP(hidden_dim, hidden_dim, hidden_dim, 3)
         self.out_proj = MLP(hidden_dim, hidden_dim, hidden_dim, 3)
         self.know_pool = AttentionPool1d(hidden_dim, 768, 8, 42, hidden_dim)
 
-        self.task_captions = {
-            0:"step on",
-            1:"sit comfortably",
-            2:"place flowers",
-            3:"get potatoes out of fire",
-            4:"water plant",
-            5:"get lemon out of tea",
-            6:"dig hole",
-            7:"open bottle of beer",
-            8:"open parcel",
-            9:"serve wine",
-            10:"pour sugar",
-            11:"smear butter",
-            12:"extinguish fire",
-            13:"pound carpet"
-        }
-
     @classmethod
     def from_config(cls, cfg, in_channels, mask_classification):
         ret = {}
@@ -230,6 +257,19 @@ class CoTDetDecoder(nn.Module):
         ret["semantic_ce_loss"] = cfg.MODEL.CoTDet.TEST.SEMANTIC_ON and cfg.MODEL.CoTDet.SEMANTIC_CE_LOSS and ~cfg.MODEL.CoTDet.TEST.PANOPTIC_ON
         ret['task_name'] = cfg.MODEL.CoTDet.KNOWLEDGE.TASK_NAME
         ret['knowledge_base'] = cfg.MODEL.CoTDet.KNOWLEDGE.KNOWLEDGE_BASE
+        ret["checkpoint_dec_layers"] = tuple(cfg.MODEL.CoTDet.CHECKPOINT.DEC_LAYERS)
+        ret["checkpoint_pred_heads"] = tuple(cfg.MODEL.CoTDet.CHECKPOINT.PRED_HEADS)
+        ret["query_schedule"] = tuple(cfg.MODEL.CoTDet.TEST.QUERY_SCHEDULE)
+        ret["relevance_threshold"] = cfg.MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD
+        early_exit = cfg.MODEL.CoTDet.TEST.EARLY_EXIT
+        if early_exit.ENABLED:
+            ret["early_exit"] = {
+                "min_layers": early_exit.MIN_LAYERS,
+                "topk": early_exit.TOPK,
+                "score_delta": early_exit.SCORE_DELTA,
+                "box_delta": early_exit.BOX_DELTA,
+                "score_cutoff": early_exit.SCORE_CUTOFF,
+            }
 
         return ret
 
@@ -243,8 +283,9 @@ class CoTDetDecoder(nn.Module):
             """
         if self.training:
             scalar, noise_scale = self.dn_num,self.noise_scale
+            device = knw_srcs.device
 
-            known = [(torch.ones_like(t['labels'])).cuda() for t in targets]
+            known = [torch.ones_like(t['labels']) for t in targets]
             know_idx = [torch.nonzero(t) for t in known]
             known_num = [sum(k) for k in known]
 
@@ -288,18 +329,18 @@ class CoTDetDecoder(nn.Module):
                 diff[:, :2] = known_bbox_expand[:, 2:] / 2
                 diff[:, 2:] = known_bbox_expand[:, 2:]
                 known_bbox_expand += torch.mul((torch.rand_like(known_bbox_expand) * 2 - 1.0),
-                                               diff).cuda() * noise_scale
+                                               diff) * noise_scale
                 known_bbox_expand = known_bbox_expand.clamp(min=0.0, max=1.0)
 
-            m = known_labels_expaned.long().to('cuda')
+            m = known_labels_expaned.long()
             input_label_embed = self.label_enc(m)
 
             input_bbox_embed = inverse_sigmoid(known_bbox_expand)
             single_pad = int(max(known_num))
             pad_size = int(single_pad * scalar)
 
-            padding_label = torch.zeros(pad_size, self.hidden_dim).cuda()
-            padding_bbox = torch.zeros(pad_size, 4).cuda()
+            padding_label = torch.zeros(pad_size, self.hidden_dim, device=device)
+            padding_bbox = torch.zeros(pad_size, 4, device=device)
 
             if not refpoint_emb is None:
                 input_query_label = torch.cat([padding_label, tgt], dim=0).repeat(batch_size, 1, 1)
@@ -308,19 +349,19 @@ class CoTDetDecoder(nn.Module):
                 input_query_label=padding_label.repeat(batch_size, 1, 1)
                 input_query_bbox = padding_bbox.repeat(batch_size, 1, 1)
 
-            random_knw = torch.index_select(knw_srcs, 1, torch.randperm(input_query_label.shape[1]).cuda())
+            random_knw = torch.index_select(knw_srcs, 1, torch.randperm(input_query_label.shape[1], device=device))
             input_query_label = input_query_label + random_knw
             # map
-            map_known_indice = torch.tensor([]).to('cuda')
+            map_known_indice = torch.tensor([], device=device)
             if len(known_num):
-                map_known_indice = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
+                map_known_indice = torch.cat([torch.arange(num, device=device) for num in known_num])  # [1,2, 1,2,3]
                 map_known_indice = torch.cat([map_known_indice + single_pad * i for i in range(scalar)]).long()
             if len(known_bid):
                 input_query_label[(known_bid.long(), map_known_indice)] = input_label_embed
                 input_query_bbox[(known_bid.long(), map_known_indice)] = input_bbox_embed
 
             tgt_size = pad_size + self.num_queries
-            attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
+            attn_mask = torch.ones(tgt_size, tgt_size, device=device) < 0
             # match query cannot see the reconstruct
             attn_mask[pad_size:, :pad_size] = True
             # reconstruct cannot see each other
@@ -386,6 +427,29 @@ class CoTDetDecoder(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    def get_levels(self, masks, spatial_shapes):
+        """
+        Returns:
+            the flattened padding mask, the spatial shapes, the start index of every level and
+            the valid ratios of the levels
+        """
+        device = masks[0].device
+        mask_flatten = torch.cat([mask.flatten(1) for mask in masks], 1)  # bs, \sum{hxw}
+        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=device)
+        level_start_index = torch.cat((spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1]))
+        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        return mask_flatten, spatial_shapes, level_start_index, valid_ratios
+
+    def check_query_schedule(self, query_schedule):
+        if not query_schedule:
+            return None
+        query_schedule = list(query_schedule)
+        assert len(query_schedule) == self.num_layers, \
+            "QUERY_SCHEDULE needs one number of queries per decoder layer, got {}".format(query_schedule)
+        assert query_schedule[0] == self.num_queries and query_schedule == sorted(query_schedule, reverse=True), \
+            "QUERY_SCHEDULE must start with NUM_OBJECT_QUERIES and not increase, got {}".format(query_schedule)
+        return query_schedule
+
     def pred_box(self, reference, hs, ref0=None):
         """
         :param reference: reference box coordinates from each decoder layer
@@ -401,16 +465,108 @@ class CoTDetDecoder(nn.Module):
             layer_outputs_unsig = layer_delta_unsig + inverse_sigmoid(layer_ref_sig)
             layer_outputs_unsig = layer_outputs_unsig.sigmoid()
             outputs_coord_list.append(layer_outputs_unsig)
+        if len({x.shape for x in outputs_coord_list}) > 1:
+            # the layers have different numbers of queries with the query schedule
+            return outputs_coord_list
         outputs_coord_list = torch.stack(outputs_coord_list)
         return outputs_coord_list
     
-    def forward(self, x, mask_features, masks, task_ids, targets=None):
+    def load_knowledge(self, query_prompts, knowledge):
+        """
+        Keep the task prompts and the knowledge base, dicts keyed by the captions of `self.task_captions`,
+        as buffers indexed by task id, so that the task ids of the samples index them on the device. The
+        knowledge of the tasks is padded to the largest one, `knowledge_mask` marks the valid entries.
+        The buffers are not saved in the checkpoints.
+        """
+        num_tasks = max(self.task_captions) + 1
+        captions = [self.task_captions[i] for i in range(num_tasks)]
+        num_entries = [len(knowledge[c][1]) for c in captions]
+        values, keys = knowledge[captions[0]]
+        task_prompts = torch.stack([torch.as_tensor(query_prompts[c]).reshape(-1) for c in captions])
+        knowledge_values = values.new_zeros((num_tasks, max(num_entries)) + values.shape[1:])
+        knowledge_keys = keys.new_zeros((num_tasks, max(num_entries)) + keys.shape[1:])
+        knowledge_mask = torch.zeros((num_tasks, max(num_entries)), dtype=torch.bool)
+        for i, (c, n) in enumerate(zip(captions, num_entries)):
+            knowledge_values[i, :n], knowledge_keys[i, :n] = knowledge[c]
+            knowledge_mask[i, :n] = True
+        self.register_buffer("task_prompts", task_prompts.float(), persistent=False)
+        self.register_buffer("knowledge_values", knowledge_values.float(), persistent=False)
+        self.register_buffer("knowledge_keys", knowledge_keys.float(), persistent=False)
+        self.register_buffer("knowledge_mask", knowledge_mask, persistent=False)
+
+    def task_id_tensor(self, task_ids):
+        # the model passes a tensor, a list of 0-d tensors is accepted as well
+        if not isinstance(task_ids, torch.Tensor):
+            task_ids = torch.stack(list(task_ids))
+        return task_ids.to(self.task_prompts.device)
+
+    def knowledge_similarity(self, src, task_ids):
+        """
+        :param src: the tokens of the samples modulated by their task prompt, bs, n, c
+        :param task_ids: the task of each sample, bs
+        :return: the similarity of the tokens to the knowledge keys of their task, -inf for the padding
+            of the knowledge, bs, n, k
+        """
+        knw_keys = self.know_proj(self.knowledge_keys[task_ids])  # bs k c
+        scr_knw_sim = l2norm(src) @ l2norm(knw_keys).transpose(1, 2)
+        return scr_knw_sim.masked_fill(~self.knowledge_mask[task_ids][:, None], float("-inf"))
+
+    def retrieve_knowledge(self, src_flatten, task_ids, return_similarity=False):
+        """
+        :param src_flatten: flattened multi-scale features, bs, \sum{hxw}, c
+        :param task_ids: the task of each image
+        :param return_similarity: also return the similarity of the tokens to the knowledge keys
+        :return: the knowledge embedding of the top-k tokens of each image, bs, num_queries, c
+        """
+        task_ids = self.task_id_tensor(task_ids)
+        task = self.prompts_poj(self.task_prompts[task_ids])[:, None]  # bs 1 c
+        fused_src = self.pro_src(src_flatten * task + src_flatten)
+        scr_knw_sim = self.knowledge_similarity(fused_src, task_ids)
+        scr_scores, sl_knw_indices = torch.max(scr_knw_sim, dim=-1)  # bs n
+
+        _, topk_scr_indices = torch.topk(scr_scores, self.num_queries)  # bs q
+        topk_src = torch.gather(
+            src_flatten, 1, topk_scr_indices.unsqueeze(-1).repeat(1, 1, src_flatten.shape[-1])
+        )
+        topk_knw_indices = torch.gather(sl_knw_indices, 1, topk_scr_indices)
+        topk_knw_src = self.knowledge_values[task_ids[:, None], topk_knw_indices]  # bs q l c
+
+        # pool the knowledge of every top-k token of all the images at once
+        knw_src = self.know_pool(topk_knw_src.flatten(0, 1), token=topk_src.flatten(0, 1)[:, None])
+        knw_src = self.out_proj(knw_src).view(topk_src.shape)
+        if return_similarity:
+            return knw_src, scr_knw_sim
+        return knw_src
+
+    def score_tokens(self, src_flatten, task_ids, image_index=None):
+        """
+        Score the relevance of the tokens of the pixel encoder to the tasks cheaply: the best similarity
+        to the knowledge keys of the tokens modulated by the task prompt, as in `retrieve_knowledge`
+        without its token projection.
+        :param src_flatten: flattened multi-scale tokens of the images, bs_images, \sum{hxw}, c
+        :param task_ids: the task of each sample
+        :param image_index: the image of each sample, None for one sample per image
+        :return: the best score of each token over the tasks of its image, bs_images, \sum{hxw}
+        """
+        task_ids = self.task_id_tensor(task_ids)
+        src = src_flatten if image_index is None else src_flatten[image_index]
+        task = self.prompts_poj(self.task_prompts[task_ids])[:, None]
+        scr_knw_sim = self.knowledge_similarity(src * task + src, task_ids)
+        sample_scores = scr_knw_sim.max(-1)[0].float()
+        if image_index is None:
+            return sample_scores
+        scores = sample_scores.new_full(src_flatten.shape[:2], float("-inf"))
+        return scores.index_reduce_(0, image_index, sample_scores, "amax")
+
+    def forward(self, x, mask_features, masks, task_ids, targets=None, query_prior=None):
         """
         :param x: input, a list of multi-scale feature
         :param mask_features: is the per-pixel embeddings with resolution 1/4 of the original image,
         obtained by fusing backbone encoder encoded features. This is used to produce binary masks.
         :param masks: mask in the original image
         :param targets: used for denoising training
+        :param query_prior: at inference, the "query_state" of the outputs of a previous call, the content
+        and unsigmoid reference boxes of its queries, used instead of the two-stage query selection
         """
         assert len(x) == self.num_feature_levels
         size_list = []
@@ -420,10 +576,14 @@ class CoTDetDecoder(nn.Module):
             for src in x:
                 if src.size(2) % 32 or src.size(3) % 32:
                     enable_mask = 1
+        # without padding, the masks and what is computed from them only depend on the shapes
+        shape_key = None
         if enable_mask == 0:
-            masks = [torch.zeros((src.size(0), src.size(2), src.size(3)), device=src.device, dtype=torch.bool) for src in x]
+            shape_key = (tuple(src.shape[-2:] for src in x), x[0].size(0), x[0].device)
+            masks = SHAPE_CACHE.get(("decoder_masks",) + shape_key, lambda: [
+                torch.zeros((src.size(0), src.size(2), src.size(3)), device=src.device, dtype=torch.bool) for src in x
+            ])
         src_flatten = []
-        mask_flatten = []
         spatial_shapes = []
         for i in range(self.num_feature_levels):
             idx=self.num_feature_levels-1-i
@@ -431,20 +591,48 @@ class CoTDetDecoder(nn.Module):
             size_list.append(x[i].shape[-2:])
             spatial_shapes.append(x[idx].shape[-2:])
             src_flatten.append(self.input_proj[idx](x[idx]).flatten(2).transpose(1, 2))
-            mask_flatten.append(masks[i].flatten(1))
         src_flatten = torch.cat(src_flatten, 1)  # bs, \sum{hxw}, c
-        mask_flatten = torch.cat(mask_flatten, 1)  # bs, \sum{hxw}
-        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
-        level_start_index = torch.cat((spatial_shapes.new_zeros((1,)), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        if shape_key is None:
+            mask_flatten, spatial_shapes, level_start_index, valid_ratios = self.get_levels(masks, spatial_shapes)
+        else:
+            mask_flatten, spatial_shapes, level_start_index, valid_ratios = SHAPE_CACHE.get(
+                ("decoder_levels",) + shape_key, lambda: self.get_levels(masks, spatial_shapes)
+            )
 
         predictions_class = []
         predictions_mask = []
 
-        if self.two_stage:
-            output_memory, output_proposals = gen_encoder_output_proposals(src_flatten, mask_flatten, spatial_shapes)
+        if query_prior is not None:
+            # the queries of the previous frame of a stream, their boxes refined by its decoder
+            assert self.two_stage and not self.learn_tgt and not self.training
+            tgt_undetach, refpoint_embed = query_prior
+            knw_srcs = self.retrieve_knowledge(src_flatten, task_ids)
+            tgt = tgt_undetach + knw_srcs
+        elif self.two_stage:
+            output_memory, output_proposals = gen_encoder_output_proposals(
+                src_flatten, mask_flatten, spatial_shapes, shape_key=shape_key
+            )
             output_memory = self.enc_output_norm(self.enc_output(output_memory))
             enc_outputs_class_unselected = self.class_embed(output_memory)
+            if not self.training:
+                # the best score of the tokens of every sample for its own task, the classes are the tasks:
+                # how likely it has an object for its task
+                task_logits = enc_outputs_class_unselected[torch.arange(bs), :, self.task_id_tensor(task_ids)]
+                relevance = task_logits.max(-1)[0].sigmoid()
+                if self.relevance_threshold > 0:
+                    # only decode the relevant samples
+                    kept = torch.nonzero(relevance >= self.relevance_threshold)[:, 0]
+                    if len(kept) == 0:
+                        return self.skipped_outputs(relevance, kept, mask_features), None
+                    if len(kept) < bs:
+                        output_memory, output_proposals, enc_outputs_class_unselected = [
+                            t[kept] for t in (output_memory, output_proposals, enc_outputs_class_unselected)
+                        ]
+                        src_flatten, mask_flatten, valid_ratios, mask_features = [
+                            t[kept] for t in (src_flatten, mask_flatten, valid_ratios, mask_features)
+                        ]
+                        task_ids = self.task_id_tensor(task_ids)[kept]
+                        bs = len(task_ids)
             enc_outputs_coord_unselected = self._bbox_embed(
                 output_memory) + output_proposals  # (bs, \sum{hw}, 4) unsigmoid
             topk = self.num_queries
@@ -456,26 +644,10 @@ class CoTDetDecoder(nn.Module):
 
             tgt_undetach = torch.gather(output_memory, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, self.hidden_dim))  # unsigmoid
             
-            knw_srcs = []
-            for tid, src_b in zip(task_ids, src_flatten): # b (word, sent)
-                task = self.prompts_poj(self.query_prompts[self.task_captions[tid.item()]].cuda())
-                knw_values, knw_keys = self.knowledge[self.task_captions[tid.item()]]
-                knw_values = knw_values.cuda() # k n c 
-                knw_keys = self.know_proj(knw_keys.cuda()) # k c
-                fused_src = self.pro_src(src_b*task+src_b)
-
-                scr_knw_sim = l2norm(fused_src) @ l2norm(knw_keys).t()
-                scr_scores, sl_knw_indices = torch.max(scr_knw_sim, dim=-1) # n k
-                knw_src = knw_values[sl_knw_indices]
-
-                _, topk_scr_indices = torch.topk(scr_scores, self.num_queries)
-                topk_src = src_b[topk_scr_indices]
-                topk_knw_src = knw_src[topk_scr_indices]
-                
-                knw_src = self.out_proj(self.know_pool(topk_knw_src, token=topk_src[:,None]))
-                knw_srcs.append(knw_src)
-
-            knw_srcs = torch.stack(knw_srcs)
+            if self.output_knowledge_similarity:
+                knw_srcs, knowledge_similarity = self.retrieve_knowledge(src_flatten, task_ids, return_similarity=True)
+            else:
+                knw_srcs = self.retrieve_knowledge(src_flatten, task_ids)
             tgt = tgt_undetach + knw_srcs
             outputs_class, outputs_mask = self.forward_prediction_heads(tgt_undetach.transpose(0, 1), mask_features)
             
@@ -495,13 +667,14 @@ class CoTDetDecoder(nn.Module):
                 flaten_mask = outputs_mask.detach().flatten(0, 1)
                 h, w = outputs_mask.shape[-2:]
                 if self.initialize_box_type == 'bitmask':  # slower, but more accurate
-                    refpoint_embed = BitMasks(flaten_mask > 0).get_bounding_boxes().tensor.cuda()
+                    refpoint_embed = BitMasks(flaten_mask > 0).get_bounding_boxes().tensor.to(flaten_mask.device)
                 elif self.initialize_box_type == 'mask2box':  # faster conversion
-                    refpoint_embed = box_ops.masks_to_boxes(flaten_mask > 0).cuda()
+                    refpoint_embed = box_ops.masks_to_boxes(flaten_mask > 0)
                 else:
                     assert NotImplementedError
                 refpoint_embed = box_ops.box_xyxy_to_cxcywh(refpoint_embed) / torch.as_tensor([w, h, w, h],
-                                                                                              dtype=torch.float).cuda()
+                                                                                              dtype=torch.float,
+                                                                                              device=flaten_mask.device)
                 refpoint_embed = refpoint_embed.reshape(outputs_mask.shape[0], outputs_mask.shape[1], 4)
                 refpoint_embed = inverse_sigmoid(refpoint_embed)
         elif not self.two_stage:
@@ -535,15 +708,20 @@ class CoTDetDecoder(nn.Module):
             valid_ratios=valid_ratios,
             tgt_mask=tgt_mask
         )
+        # a prediction for every decoded layer, fewer than num_layers with the early exit at inference
         for i, output in enumerate(hs):
-            outputs_class, outputs_mask = self.forward_prediction_heads(output.transpose(0, 1), mask_features, self.training or (i == len(hs)-1))
+            prediction_heads = self.forward_prediction_heads
+            if i in self.checkpoint_pred_heads and self.training and torch.is_grad_enabled():
+                # recompute the mask embedding of this layer in backward instead of storing it
+                prediction_heads = partial(checkpoint, self.forward_prediction_heads, use_reentrant=False)
+            outputs_class, outputs_mask = prediction_heads(output.transpose(0, 1), mask_features, self.training or (i == len(hs)-1))
             predictions_class.append(outputs_class)
             predictions_mask.append(outputs_mask)
 
         # iteratively box prediction
         if self.initial_pred:
             out_boxes = self.pred_box(references, hs, refpoint_embed.sigmoid())
-            assert len(predictions_class) == self.num_layers + 1
+            assert len(predictions_class) == len(hs) + 1
         else:
             out_boxes = self.pred_box(references, hs)
         if mask_dict is not None:
@@ -563,10 +741,32 @@ class CoTDetDecoder(nn.Module):
             )
         }
 
-        if self.two_stage:
+        if not self.training and self.two_stage and out_boxes[-1].shape[1] == tgt_undetach.shape[1]:
+            out['query_state'] = (tgt_undetach, inverse_sigmoid(out_boxes[-1]))
+        if self.output_knowledge_similarity and self.two_stage and query_prior is None:
+            out['knowledge_similarity'] = knowledge_similarity
+        if self.two_stage and query_prior is None:
             out['interm_outputs'] = interm_outputs
+            if not self.training:
+                out['relevance'] = relevance
+                if self.relevance_threshold > 0:
+                    out['kept'] = kept
         return out, mask_dict
 
+    def skipped_outputs(self, relevance, kept, mask_features):
+        """
+        The outputs when the relevance gate skips the decoding of all the samples: no predictions.
+        """
+        num_classes = self.class_embed.out_features
+        return {
+            'pred_logits': mask_features.new_zeros((0, self.num_queries, num_classes)),
+            'pred_masks': mask_features.new_zeros((0, self.num_queries) + mask_features.shape[-2:]),
+            'pred_boxes': mask_features.new_zeros((0, self.num_queries, 4)),
+            'aux_outputs': [],
+            'relevance': relevance,
+            'kept': kept,
+        }
+
     def forward_prediction_heads(self, output, mask_features, pred_mask=True):
         decoder_output = self.decoder_norm(output)
         decoder_output = decoder_output.transpose(0, 1)
@@ -671,6 +871,8 @@ class AttentionPool1d(nn.Module):
         x = x.permute(1,0,2)
         if self.positional_embedding is not None:
             x = x + self.positional_embedding[:, None, :].to(x.dtype)  # (HW+1)NC
+        if not isinstance(self.q_proj, nn.Linear):
+            return self.attention_with_modules(x).squeeze(0)
         x, _ = F.multi_head_attention_forward(
             query=x[:1], key=x, value=x,
             embed_dim_to_check=x.shape[-1],
@@ -690,4 +892,17 @@ class AttentionPool1d(nn.Module):
             training=self.training,
             need_weights=False
         )
-        return x.squeeze(0)
\ No newline at end of file
+        return x.squeeze(0)
+
+    def attention_with_modules(self, x):
+        """
+        The attention of the first token to all of them as in `forward`, calling the projections instead of
+        reading their weights, for their dynamic quantized replacements (see cotdet.utils.quantization).
+        """
+        L, N, C = x.shape
+        head_dim = C // self.num_heads
+        q = self.q_proj(x[:1]).reshape(1, N * self.num_heads, head_dim).transpose(0, 1)
+        k = self.k_proj(x).reshape(L, N * self.num_heads, head_dim).transpose(0, 1)
+        v = self.v_proj(x).reshape(L, N * self.num_heads, head_dim).transpose(0, 1)
+        x = F.scaled_dot_product_attention(q, k, v)  # N*num_heads, 1, head_dim
+        return self.c_proj(x.transpose(0, 1).reshape(1, N, C))
\ No newline at end of file
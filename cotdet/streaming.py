@@ -0,0 +1,141 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+from collections import Counter
+
+import torch
+from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
+
+from detectron2.structures import ImageList
+from detectron2.tracking import TRACKER_HEADS_REGISTRY
+
+__all__ = ["CoTDetStream"]
+
+# the frames are compared on their grayscale average pooled by it
+FRAME_DIFF_STRIDE = 8
+
+
+class CoTDetStream:
+    """
+    Inference of :class:`CoTDet` on the frames of a video stream, one frame at a time, which carries
+    state from a frame to the next to skip work on the frames that change little, see
+    MODEL.CoTDet.TEST.STREAMING:
+
+    1. The decoder is seeded with the queries and the refined boxes of the previous frame instead of
+       running the two-stage query selection, which is run again every QUERY_REFRESH_INTERVAL frames
+       so that new objects are found.
+    2. The features of the backbone and the pixel encoder are reused while the mean absolute
+       difference of the frames with the last encoded one is below FEATURE_REUSE_THRESHOLD.
+    3. The instances above SCORE_THRESHOLD are associated over time with a Hungarian tracker of
+       `detectron2.tracking`, which gives them an "ID".
+
+    A change of task or of image size starts a new stream, :meth:`reset` also does. Usage:
+
+    .. code-block:: python
+
+        stream = CoTDetStream(cfg, model)
+        for image in frames:
+            instances = stream({"image": image, "task_id": task_id})["instances"]
+    """
+
+    def __init__(self, cfg, model):
+        """
+        Args:
+            cfg (CfgNode):
+            model (CoTDet): in eval mode, with instance inference only, a two-stage decoder without
+                learned queries and without query schedule
+        """
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        assert model.instance_on and not model.semantic_on and not model.panoptic_on, \
+            "the streaming inference only supports instance inference"
+        predictor = model.sem_seg_head.predictor
+        assert predictor.two_stage and not predictor.learn_tgt, "the queries are reused with the two-stage decoder"
+        assert predictor.decoder.dec_layer_number is None, "MODEL.CoTDet.TEST.QUERY_SCHEDULE drops queries"
+        streaming = cfg.MODEL.CoTDet.TEST.STREAMING
+        self.model = model
+        self.query_refresh_interval = streaming.QUERY_REFRESH_INTERVAL
+        self.feature_reuse_threshold = streaming.FEATURE_REUSE_THRESHOLD
+        self.score_threshold = streaming.SCORE_THRESHOLD
+        self.tracker = streaming.TRACKER
+        self.tracker_args = {
+            "max_num_instances": streaming.MAX_NUM_INSTANCES,
+            "max_lost_frame_count": streaming.MAX_LOST_FRAME_COUNT,
+            "min_box_rel_dim": streaming.MIN_BOX_REL_DIM,
+            "min_instance_period": streaming.MIN_INSTANCE_PERIOD,
+            "track_iou_threshold": streaming.TRACK_IOU_THRESHOLD,
+        }
+        # the number of frames "encoded" or that reused the features, and that ran the query "selection"
+        # or reused the queries
+        self.stats = Counter()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous frames.
+        """
+        self._stream_key = None
+        self._keyframe = None
+        self._features = None
+        self._query_state = None
+        self._frames_since_selection = 0
+        self._tracker = None
+
+    def __call__(self, frame):
+        """
+        Args:
+            frame (dict): a single-task record in the format of :class:`CoTDet`, with an "image" and
+                a "task_id", and optionally the output "height" and "width".
+
+        Returns:
+            dict: the "instances" of the frame above SCORE_THRESHOLD, with their "ID" when tracking,
+            and its "relevance" when the query selection ran.
+        """
+        model = self.model
+        image = frame["image"].to(model.device)
+        stream_key = (frame["task_id"], tuple(image.shape))
+        if stream_key != self._stream_key:
+            self.reset()
+            self._stream_key = stream_key
+
+        with torch.no_grad():
+            task_ids, _ = model.prepare_task_ids([frame])
+            thumbnail = F.avg_pool2d(image.float().mean(0)[None, None], FRAME_DIFF_STRIDE, ceil_mode=True) / 255
+            if self._features is None or \
+                    (thumbnail - self._keyframe).abs().mean().item() >= self.feature_reuse_threshold:
+                images = ImageList.from_tensors([(image - model.pixel_mean) / model.pixel_std], model.size_divisibility)
+                features = model.backbone(images.tensor)
+                mask_features, multi_scale_features = model.sem_seg_head.encode(features, task_ids=task_ids)
+                self._features = (images, mask_features, multi_scale_features)
+                self._keyframe = thumbnail
+                self.stats["encoded"] += 1
+            else:
+                self.stats["reused_features"] += 1
+            images, mask_features, multi_scale_features = self._features
+
+            query_prior = None
+            if self._query_state is not None and self._frames_since_selection < self.query_refresh_interval:
+                query_prior = self._query_state
+                self._frames_since_selection += 1
+                self.stats["reused_queries"] += 1
+            else:
+                self._frames_since_selection = 1
+                self.stats["selection"] += 1
+            outputs, _ = model.sem_seg_head.predictor(
+                multi_scale_features, mask_features, None, task_ids, query_prior=query_prior
+            )
+            # none when the relevance gate skipped the frame, the next one runs the query selection
+            self._query_state = outputs.pop("query_state", None)
+            result = model.postprocess(outputs, [frame], images, task_ids, None)[0]
+
+        instances = result["instances"]
+        instances = instances[instances.scores > self.score_threshold]
+        if self.tracker:
+            if self._tracker is None:
+                height, width = instances.image_size
+                self._tracker = TRACKER_HEADS_REGISTRY.get(self.tracker)(
+                    video_height=height, video_width=width, **self.tracker_args
+                )
+            # the trackers keep the instances of the previous frame on the CPU
+            instances = self._tracker.update(instances.to("cpu"))
+        result["instances"] = instances
+        return result
@@ -0,0 +1,234 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import math
+
+import torch
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+
+from detectron2.structures import Boxes, Instances
+from detectron2.structures.boxes import pairwise_intersection
+
+__all__ = ["CoTDetWithTiling", "tile_windows", "merge_tile_instances"]
+
+# distance in pixels to an inner border of its tile under which an instance is considered cut by the tile
+TRUNCATION_MARGIN = 2
+
+
+def tile_windows(height, width, size, overlap):
+    """
+    Returns:
+        list[tuple]: the (y0, x0, y1, x1) windows of the tiles of at most `size` x `size` that cover an
+        image, evenly spaced so that neighbouring tiles overlap by at least `overlap` times `size`.
+    """
+
+    def starts(length):
+        if length <= size:
+            return [0]
+        n = math.ceil((length - size) / (size * (1 - overlap))) + 1
+        return [round(i * (length - size) / (n - 1)) for i in range(n)]
+
+    return [(y, x, min(y + size, height), min(x + size, width)) for y in starts(height) for x in starts(width)]
+
+
+def _truncated(boxes, window, image_size):
+    # the instances that touch a border of the tile which is not a border of the image
+    y0, x0, y1, x1 = window
+    h, w = image_size
+    b = boxes.tensor
+    cut = torch.zeros(len(b), dtype=torch.bool)
+    if x0 > 0:
+        cut |= b[:, 0] <= x0 + TRUNCATION_MARGIN
+    if y0 > 0:
+        cut |= b[:, 1] <= y0 + TRUNCATION_MARGIN
+    if x1 < w:
+        cut |= b[:, 2] >= x1 - TRUNCATION_MARGIN
+    if y1 < h:
+        cut |= b[:, 3] >= y1 - TRUNCATION_MARGIN
+    return cut
+
+
+def _pairwise_mask_intersection(tile_masks, windows):
+    # the intersection of the masks of every pair of instances on the intersection of their tiles, one
+    # matrix product per pair of overlapping tiles
+    offsets = [0]
+    for masks in tile_masks:
+        offsets.append(offsets[-1] + len(masks))
+    intersections = torch.zeros((offsets[-1], offsets[-1]))
+    for a, (ay0, ax0, ay1, ax1) in enumerate(windows):
+        for b in range(a, len(windows)):
+            by0, bx0, by1, bx1 = windows[b]
+            y0, x0, y1, x1 = max(ay0, by0), max(ax0, bx0), min(ay1, by1), min(ax1, bx1)
+            if y0 >= y1 or x0 >= x1 or not len(tile_masks[a]) or not len(tile_masks[b]):
+                continue
+            ma = tile_masks[a][:, y0 - ay0 : y1 - ay0, x0 - ax0 : x1 - ax0].flatten(1).float()
+            mb = tile_masks[b][:, y0 - by0 : y1 - by0, x0 - bx0 : x1 - bx0].flatten(1).float()
+            inter = ma @ mb.T
+            intersections[offsets[a] : offsets[a + 1], offsets[b] : offsets[b + 1]] = inter
+            intersections[offsets[b] : offsets[b + 1], offsets[a] : offsets[a + 1]] = inter.T
+    return intersections
+
+
+def merge_tile_instances(tile_instances, windows, image_size, method, threshold, max_detections):
+    """
+    Merge the instances predicted on the tiles of an image into the instances of the image.
+
+    The instances are visited by decreasing score, the ones cut by their tile last, and an instance is
+    dropped when it overlaps a kept instance of the same class by at least `threshold`: the IoU of their
+    boxes or their masks (`method` "box" or "mask"), or the intersection over the smaller area when one
+    of them is cut by its tile, so that the parts of an object seen by several tiles are merged into the
+    one that sees all of it.
+
+    Args:
+        tile_instances (list[Instances]): the instances of every tile on the CPU, with the boxes in image
+            coordinates and the boolean masks of the size of their tile
+        windows (list[tuple]): the (y0, x0, y1, x1) window of every tile in the image
+        image_size (tuple): the size of the image
+
+    Returns:
+        Instances: at most `max_detections` instances with boolean masks of the size of the image
+    """
+    h, w = image_size
+    tile_index = torch.cat([torch.full((len(x),), i, dtype=torch.int64) for i, x in enumerate(tile_instances)])
+    boxes = Boxes.cat([x.pred_boxes for x in tile_instances])
+    scores = torch.cat([x.scores for x in tile_instances])
+    classes = torch.cat([x.pred_classes for x in tile_instances])
+    truncated = torch.cat([_truncated(x.pred_boxes, wd, image_size) for x, wd in zip(tile_instances, windows)])
+
+    if method == "box":
+        areas = boxes.area()
+        intersections = pairwise_intersection(boxes, boxes)
+    else:
+        tile_masks = [x.pred_masks for x in tile_instances]
+        areas = torch.cat([m.flatten(1).sum(1) for m in tile_masks]).float()
+        intersections = _pairwise_mask_intersection(tile_masks, windows)
+    pair_truncated = truncated[:, None] | truncated[None, :]
+    denominators = torch.where(
+        pair_truncated,
+        torch.minimum(areas[:, None], areas[None, :]),
+        areas[:, None] + areas[None, :] - intersections,
+    )
+    overlaps = intersections / denominators.clamp(min=1e-6)
+    suppress = (overlaps >= threshold) & (classes[:, None] == classes[None, :])
+
+    # by decreasing score, the truncated instances last
+    order = torch.argsort(-scores, stable=True)
+    order = order[torch.argsort(truncated[order].to(torch.uint8), stable=True)]
+    suppress = suppress[order][:, order]
+    suppressed = torch.zeros(len(order), dtype=torch.bool)
+    keep = []
+    for k in range(len(order)):
+        if len(keep) == max_detections:
+            break
+        if suppressed[k]:
+            continue
+        keep.append(k)
+        suppressed |= suppress[k]
+    keep = order[torch.tensor(keep, dtype=torch.int64)]
+
+    result = Instances(image_size)
+    result.pred_boxes = boxes[keep]
+    result.scores = scores[keep]
+    result.pred_classes = classes[keep]
+    masks = [m for x in tile_instances for m in x.pred_masks]
+    pred_masks = torch.zeros((len(keep), h, w), dtype=torch.bool)
+    for k, i in enumerate(keep.tolist()):
+        y0, x0, y1, x1 = windows[tile_index[i]]
+        pred_masks[k, y0:y1, x0:x1] = masks[i]
+    result.pred_masks = pred_masks
+    return result
+
+
+class CoTDetWithTiling(nn.Module):
+    """
+    Tiled inference of :class:`CoTDet` on the images larger than its training crops: every image is split
+    into overlapping tiles of MODEL.CoTDet.TEST.TILING.SIZE, the tiles of all the images of a batch run
+    through the model TILING.BATCH_SIZE at a time with the task ids of their image, and the instances of
+    the tiles are merged back into the instances of the image by :func:`merge_tile_instances`. The masks of
+    the results are boolean.
+
+    The test mapper resizes the images with INPUT.MIN_SIZE_TEST, set it to 0 to keep their full resolution.
+    """
+
+    def __init__(self, cfg, model):
+        """
+        Args:
+            cfg (CfgNode):
+            model (CoTDet): with instance inference only
+        """
+        super().__init__()
+        if isinstance(model, DistributedDataParallel):
+            model = model.module
+        assert model.instance_on and not model.semantic_on and not model.panoptic_on, \
+            "the tiled inference only supports instance inference"
+        tiling = cfg.MODEL.CoTDet.TEST.TILING
+        assert tiling.MERGE in ("box", "mask"), tiling.MERGE
+        self.model = model
+        self.tile_size = tiling.SIZE or cfg.INPUT.IMAGE_SIZE
+        self.overlap = tiling.OVERLAP
+        self.batch_size = tiling.BATCH_SIZE
+        self.merge = tiling.MERGE
+        self.nms_threshold = tiling.NMS_THRESHOLD
+        self.score_threshold = tiling.SCORE_THRESHOLD
+        self.max_detections = cfg.TEST.DETECTIONS_PER_IMAGE
+
+    def forward(self, batched_inputs):
+        """
+        Same as :meth:`CoTDet.forward` in inference.
+        """
+        if all(max(x["image"].shape[-2:]) <= self.tile_size for x in batched_inputs):
+            return self.model(batched_inputs)
+        with torch.no_grad():
+            return self._tiled_inference(batched_inputs)
+
+    def _tiled_inference(self, batched_inputs):
+        tiles, tile_owners = [], []
+        for i, x in enumerate(batched_inputs):
+            h, w = x["image"].shape[-2:]
+            height, width = x.get("height", h), x.get("width", w)
+            for y0, x0, y1, x1 in tile_windows(h, w, self.tile_size, self.overlap):
+                # the window of the tile in the output resolution of the image
+                window = tuple(round(v) for v in (y0 * height / h, x0 * width / w, y1 * height / h, x1 * width / w))
+                tile = {k: v for k, v in x.items() if k in ("task_id", "task_ids")}
+                tile.update(image=x["image"][:, y0:y1, x0:x1], height=window[2] - window[0], width=window[3] - window[1])
+                tiles.append(tile)
+                tile_owners.append((i, window))
+
+        # the instances of every (image, task) and the windows of their tiles
+        tile_instances = [{} for _ in batched_inputs]
+        windows = [{} for _ in batched_inputs]
+        for k in range(0, len(tiles), self.batch_size):
+            results = self.model(tiles[k : k + self.batch_size])
+            for r, (i, window) in zip(results, tile_owners[k : k + self.batch_size]):
+                task_results = r["task_results"] if "task_results" in r else [dict(r, task_id=None)]
+                for task_r in task_results:
+                    instances = self._to_image_coordinates(task_r["instances"], window)
+                    tile_instances[i].setdefault(task_r["task_id"], []).append(instances)
+                    windows[i].setdefault(task_r["task_id"], []).append(window)
+
+        processed_results = []
+        for x, instances, wds in zip(batched_inputs, tile_instances, windows):
+            image_size = (x.get("height", x["image"].shape[-2]), x.get("width", x["image"].shape[-1]))
+            merged = {
+                task_id: merge_tile_instances(
+                    instances[task_id], wds[task_id], image_size, self.merge, self.nms_threshold, self.max_detections
+                )
+                for task_id in instances
+            }
+            if "task_ids" in x:
+                processed_results.append(
+                    {"task_results": [{"instances": merged[t], "task_id": t} for t in x["task_ids"]]}
+                )
+            else:
+                processed_results.append({"instances": merged[None]})
+        return processed_results
+
+    def _to_image_coordinates(self, instances, window):
+        # the instances of a tile above the score threshold on the CPU, with boolean masks to bound the memory
+        instances = instances[instances.scores > self.score_threshold].to("cpu")
+        y0, x0, y1, x1 = window
+        boxes = instances.pred_boxes.tensor.clone()
+        boxes[:, 0::2] = boxes[:, 0::2].clamp(min=0, max=x1 - x0) + x0
+        boxes[:, 1::2] = boxes[:, 1::2].clamp(min=0, max=y1 - y0) + y0
+        instances.pred_boxes = Boxes(boxes)
+        instances.pred_masks = instances.pred_masks > 0
+        return instances
@@ -0,0 +1,124 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+from collections import OrderedDict
+from math import prod
+
+import fvcore.nn
+from fvcore.nn.jit_handles import einsum_flop_jit, generic_activation_jit, get_shape
+
+from detectron2.export import TracingAdapter
+from detectron2.utils import analysis
+
+__all__ = [
+    "FlopCountAnalysis",
+    "ActivationCountAnalysis",
+    "COTDET_FLOP_HANDLES",
+    "COTDET_ACTIVATION_HANDLES",
+    "by_module_table",
+]
+
+
+def ms_deform_attn_flop_jit(inputs, outputs):
+    """
+    Count flops for `MSDeformAttnFunction`: every sampling point takes 4 multiply-adds for the
+    bilinear interpolation and 1 for the attention weight, for each channel of its head.
+    """
+    # value: (N, S, M, D), attention_weights: (N, Lq, M, L, P)
+    value_shape = get_shape(inputs[0])
+    weights_shape = get_shape(inputs[4])
+    return prod(weights_shape) * value_shape[-1] * 5
+
+
+def grid_sampler_flop_jit(inputs, outputs):
+    """
+    Count flops for `grid_sample`, which samples the deformable attention with
+    `ms_deform_attn_core_pytorch` when the compiled op is not used, e.g. on CPU: as for
+    `MSDeformAttnFunction`, 4 multiply-adds for the bilinear interpolation and 1 for the attention
+    weight of every sampled value, the weighting is elementwise and not counted by fvcore.
+    """
+    # output: (N * M, D, Lq, P), a channel of every sampling point
+    return prod(get_shape(outputs[0])) * 5
+
+
+def scaled_dot_product_attention_flop_jit(inputs, outputs):
+    """
+    Count flops for `scaled_dot_product_attention`, which `F.multi_head_attention_forward` uses
+    when the attention weights are not returned: the query-key and the attention-value products.
+    """
+    # query: (..., Lq, E), key: (..., Lk, E), value: (..., Lk, Ev)
+    query_shape, key_shape, value_shape = [get_shape(v) for v in inputs[:3]]
+    batch = prod(query_shape[:-2])
+    return batch * query_shape[-2] * key_shape[-2] * (query_shape[-1] + value_shape[-1])
+
+
+def baddbmm_flop_jit(inputs, outputs):
+    """
+    Count flops for `baddbmm(input, batch1, batch2)`, the product of batch1 and batch2.
+    """
+    n, c, t = get_shape(inputs[1])
+    d = get_shape(inputs[2])[-1]
+    return n * c * t * d
+
+
+def einsum_contraction_flop_jit(inputs, outputs):
+    """
+    Count flops for einsum with two operands, e.g. "bqc,bchw->bqhw" for the masks, as the
+    product of the sizes of all the indices. fvcore's handle allocates the operands with numpy
+    for the equations it does not know, which is slow for the mask features.
+    """
+    equation = inputs[0].toIValue().replace(" ", "")
+    input_shapes = [get_shape(v) for v in inputs[1].node().inputs()]
+    operands = equation.split("->")[0].split(",")
+    if len(operands) != 2 or "." in equation:
+        return einsum_flop_jit(inputs, outputs)
+    sizes = {}
+    for operand, shape in zip(operands, input_shapes):
+        sizes.update(zip(operand, shape))
+    return prod(sizes.values())
+
+
+COTDET_FLOP_HANDLES = {
+    "prim::PythonOp.MSDeformAttnFunction": ms_deform_attn_flop_jit,
+    "aten::grid_sampler": grid_sampler_flop_jit,
+    "aten::scaled_dot_product_attention": scaled_dot_product_attention_flop_jit,
+    "aten::baddbmm": baddbmm_flop_jit,
+    "aten::einsum": einsum_contraction_flop_jit,
+}
+COTDET_ACTIVATION_HANDLES = {
+    "prim::PythonOp.MSDeformAttnFunction": generic_activation_jit(),
+    "aten::scaled_dot_product_attention": generic_activation_jit(),
+    "aten::baddbmm": generic_activation_jit(),
+}
+
+
+class FlopCountAnalysis(analysis.FlopCountAnalysis):
+    """
+    Same as :class:`detectron2.utils.analysis.FlopCountAnalysis`, but also counts the deformable
+    attention, the attention pooling of the knowledge and the mask einsums of CoTDet.
+    """
+
+    def __init__(self, model, inputs):
+        super().__init__(model, inputs)
+        self.set_op_handle(**COTDET_FLOP_HANDLES)
+
+
+class ActivationCountAnalysis(fvcore.nn.ActivationCountAnalysis):
+    """
+    Same as :class:`fvcore.nn.ActivationCountAnalysis`, but supports detectron2 models and the
+    ops of CoTDet.
+    """
+
+    def __init__(self, model, inputs):
+        wrapper = TracingAdapter(model, inputs, allow_non_tensor=True)
+        super().__init__(wrapper, wrapper.flattened_inputs)
+        self.set_op_handle(**COTDET_ACTIVATION_HANDLES)
+
+
+def by_module_table(counts, modules):
+    """
+    Returns:
+        OrderedDict[str, float]: the counts of a :class:`FlopCountAnalysis` or
+        :class:`ActivationCountAnalysis` for the given module names, in the given order.
+        TracingAdapter prefixes the names with "model.".
+    """
+    by_module = counts.by_module()
+    return OrderedDict((m, by_module.get("model." + m, 0)) for m in modules)
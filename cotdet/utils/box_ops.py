@@ -63,8 +63,12 @@ def generalized_box_iou(boxes1, boxes2):
 
 
 
-# modified from torchvision to also return the union
+# element-wise version of box_iou, for matched pairs of boxes
 def box_iou_pairwise(boxes1, boxes2):
+    """
+    Returns the IoU and the union of boxes1[i] and boxes2[i], two [N] tensors.
+    Same as the diagonal of box_iou, in O(N) instead of O(N^2).
+    """
     area1 = box_area(boxes1)
     area2 = box_area(boxes2)
 
@@ -76,7 +80,7 @@ def box_iou_pairwise(boxes1, boxes2):
 
     union = area1 + area2 - inter
 
-    iou = inter / union
+    iou = inter / (union + 1e-6)
     return iou, union
 
 
@@ -84,17 +88,20 @@ def generalized_box_iou_pairwise(boxes1, boxes2):
     """
     Generalized IoU from https://giou.stanford.edu/
 
+    The boxes should be in [x0, y0, x1, y1] format
+
     Input:
         - boxes1, boxes2: N,4
     Output:
-        - giou: N, 4
+        - giou: N, the GIoU of boxes1[i] and boxes2[i], same as the diagonal of
+          generalized_box_iou(boxes1, boxes2)
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
     assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
     assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
     assert boxes1.shape == boxes2.shape
-    iou, union = box_iou_pairwise(boxes1, boxes2) # N, 4
+    iou, union = box_iou_pairwise(boxes1, boxes2)  # [N]
 
     lt = torch.min(boxes1[:, :2], boxes2[:, :2])
     rb = torch.max(boxes1[:, 2:], boxes2[:, 2:])
@@ -102,7 +109,7 @@ def generalized_box_iou_pairwise(boxes1, boxes2):
     wh = (rb - lt).clamp(min=0)  # [N,2]
     area = wh[:, 0] * wh[:, 1]
 
-    return iou - (area - union) / area
+    return iou - (area - union) / (area + 1e-6)
 
 def masks_to_boxes(masks):
     """Compute the bounding boxes around the provided masks
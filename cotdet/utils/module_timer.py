@@ -0,0 +1,239 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import time
+from functools import wraps
+
+import numpy as np
+import torch
+from torch.autograd.profiler import record_function
+from torch.nn.parallel import DistributedDataParallel
+
+from detectron2.engine import HookBase
+
+__all__ = ["ModuleTimer", "ModuleTimingHook", "instrument_cotdet"]
+
+
+class ModuleTimer:
+    """
+    Measure the wall time and the peak allocated memory of named regions of a model, e.g. its
+    submodules, by replacing their methods on the instances with :meth:`wrap`.
+
+    Regions can be nested: the time of a region excludes the time of the regions it calls, and
+    its peak memory includes them. Every region is also a `record_function` range, so it shows
+    in the traces of `torch.profiler`. The times of an iteration are summed and kept as one
+    sample when :meth:`step` is called.
+
+    Without `sync_cuda`, the time of a region is the time spent on the CPU, which does not
+    include the CUDA kernels still running when it ends. The peak memory is measured with
+    `torch.cuda.reset_peak_memory_stats`, so `torch.cuda.max_memory_allocated` only covers the
+    time since the last region while it is enabled, e.g. the "max_mem" printed by detectron2.
+    It is off by default for this reason.
+    """
+
+    def __init__(self, sync_cuda=False, track_memory=False):
+        """
+        Args:
+            sync_cuda (bool): synchronize CUDA around every region, to include its kernels.
+            track_memory (bool): measure the peak allocated CUDA memory of every region, it
+                resets the CUDA peak memory stats.
+        """
+        cuda = torch.cuda.is_available()
+        self.sync_cuda = sync_cuda and cuda
+        self.track_memory = track_memory and cuda
+        self.samples = {}
+        self.peak_memory = {}
+        self._current = {}
+        self._current_memory = {}
+        # [children seconds, peak memory] of the running regions
+        self._stack = []
+        self._backward_running = False
+
+    def wrap(self, obj, name, region):
+        """
+        Time every call of the method `name` of `obj` as `region`.
+
+        Args:
+            region (str or callable): name of the region, or a function returning it when called.
+        """
+        func = getattr(obj, name)
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with self.time(region() if callable(region) else region):
+                return func(*args, **kwargs)
+
+        setattr(obj, name, timed)
+
+    def time(self, region):
+        """
+        A context manager that times the code it runs as `region`.
+        """
+        timer = self
+
+        class _Region:
+            def __enter__(self):
+                self.start, self.range = timer._enter(region)
+
+            def __exit__(self, *exc):
+                timer._exit(region, self.start, self.range)
+
+        return _Region()
+
+    def _enter(self, region):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        if self.track_memory:
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        self._stack.append([0.0, 0])
+        profiler_range = record_function("cotdet/" + region)
+        profiler_range.__enter__()
+        return time.perf_counter(), profiler_range
+
+    def _exit(self, region, start, profiler_range):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        profiler_range.__exit__(None, None, None)
+        children, peak = self._stack.pop()
+        if self._stack:
+            self._stack[-1][0] += seconds
+        self._current[region] = self._current.get(region, 0.0) + seconds - children
+        if self.track_memory:
+            peak = max(peak, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            self._current_memory[region] = max(self._current_memory.get(region, 0), peak)
+
+    def time_backward(self, outputs, region="backward"):
+        """
+        Time the backward pass from the tensors in `outputs` as `region`: it starts when the
+        gradient of one of them is computed and ends with the backward pass.
+
+        Args:
+            outputs (dict[str, Tensor]): e.g. the losses of the model.
+        """
+        tensors = [x for x in outputs.values() if isinstance(x, torch.Tensor) and x.requires_grad]
+
+        def started(grad):
+            if self._backward_running:
+                return
+            self._backward_running = True
+            start, profiler_range = self._enter(region)
+
+            def finished():
+                self._backward_running = False
+                self._exit(region, start, profiler_range)
+
+            torch.autograd.Variable._execution_engine.queue_callback(finished)
+
+        for x in tensors:
+            x.register_hook(started)
+
+    def step(self):
+        """
+        End an iteration: the times of the regions in this iteration are summed into one sample.
+        """
+        for region, seconds in self._current.items():
+            self.samples.setdefault(region, []).append(seconds)
+        for region, peak in self._current_memory.items():
+            self.peak_memory[region] = max(self.peak_memory.get(region, 0), peak)
+        self.discard()
+
+    def discard(self):
+        """
+        Drop what was measured since the last :meth:`step`.
+        """
+        self._current = {}
+        self._current_memory = {}
+
+    def reset(self):
+        self.samples = {}
+        self.peak_memory = {}
+
+    def summary(self):
+        """
+        Returns:
+            dict[str, dict]: statistics in milliseconds of the samples of every region.
+        """
+        ret = {}
+        for region, samples in self.samples.items():
+            ms = np.asarray(samples) * 1e3
+            ret[region] = {
+                "median_ms": float(np.median(ms)),
+                "mean_ms": float(ms.mean()),
+                "p90_ms": float(np.percentile(ms, 90)),
+                "std_ms": float(ms.std()),
+                "count": len(samples),
+            }
+        return ret
+
+
+def instrument_cotdet(timer, model, time_backward=True):
+    """
+    Time the main regions of a :class:`CoTDet` model with `timer`:
+
+    * "preprocess" / "postprocess": the rest of the model in training / inference
+    * "backbone", "pixel_encoder": the backbone and the CoTDetEncoder
+    * "knowledge_retrieval": the selection and pooling of the task knowledge
+    * "decoder_layers": the deformable decoder layers
+    * "decoder": the rest of the CoTDetDecoder, query selection and prediction heads
+    * "matcher", "criterion": the Hungarian matching and the rest of the losses
+    * "backward": the backward pass from the losses, with `time_backward`
+    """
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    forward = model.forward
+
+    @wraps(forward)
+    def timed_forward(*args, **kwargs):
+        with timer.time("preprocess" if model.training else "postprocess"):
+            outputs = forward(*args, **kwargs)
+        if time_backward and model.training and torch.is_grad_enabled():
+            timer.time_backward(outputs)
+        return outputs
+
+    model.forward = timed_forward
+    timer.wrap(model.backbone, "forward", "backbone")
+    timer.wrap(model.sem_seg_head.pixel_decoder, "forward_features", "pixel_encoder")
+    predictor = model.sem_seg_head.predictor
+    timer.wrap(predictor, "forward", "decoder")
+    timer.wrap(predictor, "retrieve_knowledge", "knowledge_retrieval")
+    timer.wrap(predictor.decoder, "forward", "decoder_layers")
+    timer.wrap(model.criterion, "forward", "criterion")
+    timer.wrap(model.criterion.matcher, "forward", "matcher")
+    return model
+
+
+class ModuleTimingHook(HookBase):
+    """
+    Put the mean time per iteration of every region of a :class:`ModuleTimer` in the
+    EventStorage as "module_time/<region>" in seconds, and its peak allocated memory as
+    "module_mem/<region>" in MB when the timer tracks the memory.
+    """
+
+    def __init__(self, timer, period=20):
+        """
+        Args:
+            timer (ModuleTimer): the timer of the model, see :func:`instrument_cotdet`.
+            period (int): number of iterations between two reports.
+        """
+        self._timer = timer
+        self._period = period
+
+    def before_train(self):
+        self._timer.reset()
+
+    def before_step(self):
+        # e.g. the evaluation of the EvalHook after the previous step
+        self._timer.discard()
+
+    def after_step(self):
+        self._timer.step()
+        if (self.trainer.iter + 1) % self._period != 0:
+            return
+        scalars = {"module_time/" + r: float(np.mean(s)) for r, s in self._timer.samples.items()}
+        scalars.update({"module_mem/" + r: m / 1024**2 for r, m in self._timer.peak_memory.items()})
+        self.trainer.storage.put_scalars(**scalars, smoothing_hint=False)
+        self._timer.reset()
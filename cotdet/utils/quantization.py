@@ -0,0 +1,74 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import torch
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+__all__ = ["quantizable_linears", "quantize_cotdet", "linear_quantization_errors"]
+
+
+def quantizable_linears(model, prefixes, exclude=()):
+    """
+    Returns:
+        list[str]: the names of the `nn.Linear` layers of `model` under the module names `prefixes`,
+        except the ones whose name ends with one of `exclude`. A layer shared by several modules,
+        e.g. the box head of the decoder layers, appears under all its names. The output projections
+        of `nn.MultiheadAttention` are not `nn.Linear` layers and stay in fp32.
+    """
+    return [
+        name
+        for name, m in model.named_modules(remove_duplicate=False)
+        if type(m) is nn.Linear and name.startswith(tuple(prefixes)) and not name.endswith(tuple(exclude))
+    ]
+
+
+def quantize_cotdet(model, prefixes, exclude=()):
+    """
+    Replace in place the `nn.Linear` layers of :func:`quantizable_linears` with dynamic INT8 ones, for
+    the inference on CPU: their weights are quantized per tensor once, their inputs at every call, and
+    their outputs are fp32. The deformable sampling, the convolutions and the attention itself stay
+    in fp32. Load the weights before.
+
+    Returns:
+        the model
+    """
+    names = quantizable_linears(model, prefixes, exclude)
+    qconfig_spec = {name: default_dynamic_qconfig for name in names}
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def linear_quantization_errors(model, prefixes, batches, exclude=()):
+    """
+    Run the fp32 `model` on `batches` and measure the relative error of the output of every layer of
+    :func:`quantizable_linears` once quantized, on the same inputs: ||y_int8 - y|| / ||y||. The errors
+    show which layers to exclude from the quantization.
+
+    Returns:
+        dict[str, float]: the relative error of every layer, by name, over all the calls
+    """
+    layers = {}
+    for name in quantizable_linears(model, prefixes, exclude):
+        layers.setdefault(model.get_submodule(name), name)
+    errors = {name: [0.0, 0.0] for name in layers.values()}
+
+    def hook(module, inputs, output):
+        quantized = layers_int8[module]
+        error = errors[layers[module]]
+        error[0] += (quantized(inputs[0]) - output).float().square().sum().item()
+        error[1] += output.float().square().sum().item()
+
+    layers_int8 = {}
+    handles = []
+    for m in layers:
+        m.qconfig = default_dynamic_qconfig
+        layers_int8[m] = DynamicLinear.from_float(m)
+        del m.qconfig
+        handles.append(m.register_forward_hook(hook))
+    try:
+        with torch.no_grad():
+            for batch in batches:
+                model(batch)
+    finally:
+        for h in handles:
+            h.remove()
+    return {name: (e[0] / e[1]) ** 0.5 if e[1] > 0 else 0.0 for name, e in errors.items()}
@@ -0,0 +1,79 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import threading
+from collections import OrderedDict
+
+import torch
+
+__all__ = ["ShapeCache", "SHAPE_CACHE"]
+
+
+class ShapeCache:
+    """
+    A bounded LRU cache of the tensors that only depend on the shapes of the feature maps, e.g.
+    the position embeddings, the reference points of the encoder and the proposals of the
+    decoder. The key of an entry must contain everything the tensors depend on: the spatial
+    shapes, the batch size, the device and dtype, and the padding, which the callers only
+    cache without.
+
+    The tensors are computed without autograd and shared by all the calls with the same key,
+    they must not be modified in place. Nothing is cached while tracing, where the tensors
+    would become constants of the graph, and the tensors created in inference mode are kept
+    apart from the others, which autograd cannot use.
+    """
+
+    def __init__(self, max_size=64):
+        """
+        Args:
+            max_size (int): maximum number of entries, 0 disables the cache.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Returns:
+            the value of `key`, computed by calling `compute` if it is not in the cache.
+        """
+        if self.max_size <= 0 or torch.jit.is_tracing() or torch.jit.is_scripting():
+            return compute()
+        key = key + (torch.is_inference_mode_enabled(),)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        with torch.no_grad():
+            value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: the number of hits, misses and entries, and the hit rate.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# shared by the pixel encoder and the decoder
+SHAPE_CACHE = ShapeCache()
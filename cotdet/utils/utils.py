@@ -7,6 +7,8 @@ import math
 import torch.nn.functional as F
 from torch import nn
 
+from .shape_cache import SHAPE_CACHE
+
 
 class MLP(nn.Module):
     """ Very simple multi-layer perceptron (also called FFN)"""
@@ -30,17 +32,37 @@ def inverse_sigmoid(x, eps=1e-5):
     return torch.log(x1/x2)
 
 
-def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor):
+def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor, shape_key=None):
     """
     Input:
         - memory: bs, \sum{hw}, d_model
         - memory_padding_mask: bs, \sum{hw}
         - spatial_shapes: nlevel, 2
+        - shape_key: the key of the proposals in SHAPE_CACHE, None to compute them
     Output:
         - output_memory: bs, \sum{hw}, d_model
         - output_proposals: bs, \sum{hw}, 4
     """
-    N_, S_, C_ = memory.shape
+    if shape_key is None:
+        output_proposals, output_proposals_valid = gen_proposals(memory_padding_mask, spatial_shapes)
+    else:
+        output_proposals, output_proposals_valid = SHAPE_CACHE.get(
+            ("encoder_output_proposals",) + shape_key, lambda: gen_proposals(memory_padding_mask, spatial_shapes)
+        )
+
+    output_memory = memory
+    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
+    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
+    return output_memory, output_proposals
+
+
+def gen_proposals(memory_padding_mask:Tensor, spatial_shapes:Tensor):
+    """
+    Output:
+        - output_proposals: bs, \sum{hw}, 4, unsigmoided, inf where padded or invalid
+        - output_proposals_valid: bs, \sum{hw}, 1
+    """
+    N_, S_ = memory_padding_mask.shape
     base_scale = 4.0
     proposals = []
     _cur = 0
@@ -49,8 +71,8 @@ def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spat
         valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
         valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
 
-        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-                                        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device))
+        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory_padding_mask.device),
+                                        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory_padding_mask.device))
         grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)
 
         scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(N_, 1, 1, 2)
@@ -64,19 +86,17 @@ def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spat
     output_proposals = torch.log(output_proposals / (1 - output_proposals))
     output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
     output_proposals = output_proposals.masked_fill(~output_proposals_valid, float('inf'))
-
-    output_memory = memory
-    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
-    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
-    return output_memory, output_proposals
+    return output_proposals, output_proposals_valid
 
 
-def gen_sineembed_for_position(pos_tensor):
+def gen_sineembed_for_position(pos_tensor, d_model=256):
     # n_query, bs, _ = pos_tensor.size()
-    # sineembed_tensor = torch.zeros(n_query, bs, 256)
+    # sineembed_tensor = torch.zeros(n_query, bs, d_model * 2), d_model // 2 features per coordinate
     scale = 2 * math.pi
-    dim_t = torch.arange(128, dtype=torch.float32, device=pos_tensor.device)
-    dim_t = 10000 ** (2 * torch.div(dim_t, 2,rounding_mode='floor') / 128)
+    num_feats = d_model // 2
+    dim_t = SHAPE_CACHE.get(
+        ("sineembed_dim_t", pos_tensor.device, num_feats), lambda: gen_sineembed_dim_t(pos_tensor.device, num_feats)
+    )
     x_embed = pos_tensor[:, :, 0] * scale
     y_embed = pos_tensor[:, :, 1] * scale
     pos_x = x_embed[:, :, None] / dim_t
@@ -100,6 +120,11 @@ def gen_sineembed_for_position(pos_tensor):
     return pos
 
 
+def gen_sineembed_dim_t(device, num_feats=128):
+    dim_t = torch.arange(num_feats, dtype=torch.float32, device=device)
+    return 10000 ** (2 * torch.div(dim_t, 2,rounding_mode='floor') / num_feats)
+
+
 def _get_activation_fn(activation):
     """Return an activation function given a string"""
     if activation == "relu":
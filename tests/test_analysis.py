@@ -0,0 +1,51 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+from torch import nn
+
+from cotdet.modeling.pixel_encoder.ops.functions.ms_deform_attn_func import ms_deform_attn_core_pytorch
+from cotdet.utils.analysis import FlopCountAnalysis
+
+
+class MSDeformAttnFunction(torch.autograd.Function):
+    # stands for the compiled op, which fvcore sees as prim::PythonOp.MSDeformAttnFunction
+    @staticmethod
+    def forward(ctx, value, spatial_shapes, level_start_index, sampling_locations, attention_weights, im2col_step):
+        return ms_deform_attn_core_pytorch(value, spatial_shapes, sampling_locations, attention_weights)
+
+
+class DeformableSampling(nn.Module):
+    def __init__(self, spatial_shapes, compiled):
+        super().__init__()
+        self.spatial_shapes = spatial_shapes
+        self.level_start_index = torch.cat([spatial_shapes.new_zeros(1), spatial_shapes.prod(1).cumsum(0)[:-1]])
+        self.compiled = compiled
+
+    def forward(self, value, sampling_locations, attention_weights):
+        if self.compiled:
+            return MSDeformAttnFunction.apply(
+                value, self.spatial_shapes, self.level_start_index, sampling_locations, attention_weights, 64
+            )
+        return ms_deform_attn_core_pytorch(value, self.spatial_shapes, sampling_locations, attention_weights)
+
+
+class TestFlopCount(unittest.TestCase):
+    def test_deformable_attention(self):
+        # N, M, D, Lq, L, P
+        n, m, d, lq, l, p = 2, 4, 8, 10, 2, 3
+        spatial_shapes = torch.tensor([[8, 8], [4, 4]])
+        inputs = (
+            torch.rand(n, int(spatial_shapes.prod(1).sum()), m, d),
+            torch.rand(n, lq, m, l, p, 2),
+            torch.rand(n, lq, m, l, p),
+        )
+        expected = n * lq * m * l * p * d * 5
+        for compiled in (True, False):
+            flops = FlopCountAnalysis(DeformableSampling(spatial_shapes, compiled), inputs)
+            flops.unsupported_ops_warnings(False)
+            self.assertEqual(flops.total(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from cotdet.utils import box_ops
+
+
+def random_boxes(n, dtype=torch.float, generator=None):
+    # valid xyxy boxes, as produced by box_cxcywh_to_xyxy from normalized predictions
+    cxcy = torch.rand(n, 2, dtype=dtype, generator=generator)
+    wh = torch.rand(n, 2, dtype=dtype, generator=generator)
+    return box_ops.box_cxcywh_to_xyxy(torch.cat([cxcy, wh * 0.5], dim=1))
+
+
+class TestGeneralizedBoxIoUPairwise(unittest.TestCase):
+    def test_matches_diagonal(self):
+        generator = torch.Generator().manual_seed(0)
+        boxes1 = random_boxes(100, generator=generator)
+        boxes2 = random_boxes(100, generator=generator)
+        # identical and disjoint pairs
+        boxes1[:25] = boxes2[:25]
+        boxes1[25:50] = boxes2[25:50] + 2
+        reference = torch.diag(box_ops.generalized_box_iou(boxes1, boxes2))
+        giou = box_ops.generalized_box_iou_pairwise(boxes1, boxes2)
+        self.assertEqual(giou.shape, (100,))
+        self.assertTrue(torch.allclose(giou, reference, rtol=1e-4, atol=1e-6))
+
+    def test_gradients(self):
+        generator = torch.Generator().manual_seed(0)
+        boxes1 = random_boxes(8, torch.double, generator).requires_grad_()
+        boxes2 = random_boxes(8, torch.double, generator)
+        self.assertTrue(
+            torch.autograd.gradcheck(lambda b: box_ops.generalized_box_iou_pairwise(b, boxes2), (boxes1,))
+        )
+
+        # the same gradients as the diagonal of the full matrix
+        grads = []
+        for loss in [
+            lambda b: (1 - torch.diag(box_ops.generalized_box_iou(b, boxes2))).sum(),
+            lambda b: (1 - box_ops.generalized_box_iou_pairwise(b, boxes2)).sum(),
+        ]:
+            boxes1.grad = None
+            loss(boxes1).backward()
+            grads.append(boxes1.grad.clone())
+        self.assertTrue(torch.allclose(grads[0], grads[1], rtol=1e-4, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
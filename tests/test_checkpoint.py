@@ -0,0 +1,152 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import os
+import tempfile
+import unittest
+from collections.abc import Mapping
+
+import torch
+from torch import nn
+
+from detectron2.checkpoint import DetectionCheckpointer, PeriodicCheckpointer
+from detectron2.utils.logger import setup_logger
+
+from cotdet.checkpoint import AsyncCheckpointer, is_sharded_checkpoint
+
+
+def create_model():
+    m = nn.Module()
+    m.backbone = nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.ReLU())
+    m.head = nn.Linear(8, 2)
+    m.register_buffer("half_buffer", torch.randn(3, 2).to(torch.bfloat16))
+    m.register_buffer("flags", torch.rand(5) > 0.5)
+    m.register_buffer("scalar", torch.tensor(3.0))
+    m.register_buffer("empty", torch.zeros(0, 4))
+    return m
+
+
+def train_step(model, optimizer, scheduler, seed):
+    torch.manual_seed(seed)
+    loss = model.head(model.backbone(torch.randn(6, 4))).square().mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    scheduler.step()
+
+
+def create_trainer(seed):
+    torch.manual_seed(seed)
+    model = create_model()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.1)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=2)
+    return model, optimizer, scheduler
+
+
+class TestAsyncCheckpointer(unittest.TestCase):
+    def setUp(self):
+        setup_logger()
+
+    def assertStateEqual(self, a, b):
+        if isinstance(a, Mapping):
+            # state dicts are OrderedDicts
+            self.assertIsInstance(b, Mapping)
+        else:
+            self.assertEqual(type(a), type(b))
+        if isinstance(a, torch.Tensor):
+            self.assertEqual(a.dtype, b.dtype)
+            self.assertTrue(a.equal(b))
+        elif isinstance(a, Mapping):
+            self.assertEqual(list(a.keys()), list(b.keys()))
+            for k in a:
+                self.assertStateEqual(a[k], b[k])
+        elif isinstance(a, (list, tuple)):
+            self.assertEqual(len(a), len(b))
+            for x, y in zip(a, b):
+                self.assertStateEqual(x, y)
+        else:
+            self.assertEqual(a, b)
+
+    def test_save_resume(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as d:
+            model, optimizer, scheduler = create_trainer(0)
+            for it in range(3):
+                train_step(model, optimizer, scheduler, it)
+            checkpointer = AsyncCheckpointer(model, d, optimizer=optimizer, scheduler=scheduler)
+            checkpointer.save("model_0000002", iteration=2)
+            # training goes on while the checkpoint is written
+            expected = {
+                "model": {k: v.clone() for k, v in model.state_dict().items()},
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+            }
+            expected["optimizer"]["state"] = {
+                k: {n: v.clone() for n, v in s.items()} for k, s in expected["optimizer"]["state"].items()
+            }
+            train_step(model, optimizer, scheduler, 3)
+            checkpointer.wait()
+
+            save_file = os.path.join(d, "model_0000002.pth")
+            self.assertTrue(is_sharded_checkpoint(save_file))
+            with open(os.path.join(d, "last_checkpoint")) as f:
+                self.assertEqual(f.read(), "model_0000002.pth")
+
+            model2, optimizer2, scheduler2 = create_trainer(1)
+            checkpointer2 = AsyncCheckpointer(model2, d, optimizer=optimizer2, scheduler=scheduler2)
+            extra = checkpointer2.resume_or_load("", resume=True)
+            self.assertEqual(extra, {"iteration": 2})
+            self.assertStateEqual(model2.state_dict(), expected["model"])
+            self.assertStateEqual(optimizer2.state_dict(), expected["optimizer"])
+            self.assertStateEqual(scheduler2.state_dict(), expected["scheduler"])
+
+            # the resumed training follows the original one
+            model3, optimizer3, scheduler3 = create_trainer(2)
+            AsyncCheckpointer(model3, d, optimizer=optimizer3, scheduler=scheduler3).resume_or_load(
+                "", resume=True
+            )
+            train_step(model3, optimizer3, scheduler3, 3)
+            self.assertStateEqual(model3.state_dict(), model.state_dict())
+
+    def test_overwrite(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as d:
+            model, optimizer, scheduler = create_trainer(0)
+            checkpointer = AsyncCheckpointer(model, d, optimizer=optimizer)
+            checkpointer.save("model_final")
+            train_step(model, optimizer, scheduler, 0)
+            checkpointer.save("model_final")
+            checkpointer.wait()
+            self.assertEqual(sorted(os.listdir(d))[:2], ["last_checkpoint", "model_final.pth"])
+            self.assertEqual(len([f for f in os.listdir(d) if ".shards-" in f]), 1)
+
+            model2, _, _ = create_trainer(1)
+            AsyncCheckpointer(model2, d).load(os.path.join(d, "model_final.pth"))
+            self.assertStateEqual(model2.state_dict(), model.state_dict())
+
+    def test_max_to_keep(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as d:
+            model, optimizer, scheduler = create_trainer(0)
+            checkpointer = AsyncCheckpointer(model, d, optimizer=optimizer)
+            periodic_checkpointer = PeriodicCheckpointer(checkpointer, 1, max_to_keep=2)
+            for it in range(5):
+                train_step(model, optimizer, scheduler, it)
+                periodic_checkpointer.step(it)
+            checkpointer.wait()
+            self.assertEqual(
+                sorted(f for f in os.listdir(d) if f.endswith(".pth")), ["model_0000003.pth", "model_0000004.pth"]
+            )
+            shards = sorted(f for f in os.listdir(d) if ".shards-" in f)
+            self.assertEqual([f.split(".shards-")[0] for f in shards], ["model_0000003.pth", "model_0000004.pth"])
+
+            model2, _, _ = create_trainer(1)
+            AsyncCheckpointer(model2, d).resume_or_load("", resume=True)
+            self.assertStateEqual(model2.state_dict(), model.state_dict())
+
+    def test_load_regular_checkpoint(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as d:
+            model, _, _ = create_trainer(0)
+            DetectionCheckpointer(model, d).save("model_0000000")
+            model2, _, _ = create_trainer(1)
+            AsyncCheckpointer(model2, d).resume_or_load("", resume=True)
+            self.assertStateEqual(model2.state_dict(), model.state_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import os
+import tempfile
+import unittest
+
+import torch
+
+from detectron2.modeling import build_model
+from detectron2.structures import ImageList
+from detectron2.utils.events import EventStorage
+
+from cotdet.distillation import CoTDetDistiller, TeacherOutputCache
+
+from tiny_model import get_tiny_cfg
+
+
+class TestCoTDetDistiller(unittest.TestCase):
+    def create_distiller(self, directory, teacher_opts=(), opts=()):
+        teacher_cfg = get_tiny_cfg(directory, teacher_opts)
+        teacher_config = os.path.join(directory, "teacher.yaml")
+        with open(teacher_config, "w") as f:
+            f.write(teacher_cfg.dump())
+        cfg = get_tiny_cfg(directory, [
+            "MODEL.CoTDet.DISTILLATION.ENABLED", True,
+            "MODEL.CoTDet.DISTILLATION.TEACHER_CONFIG", teacher_config,
+        ] + list(opts))
+        torch.manual_seed(0)
+        return CoTDetDistiller(cfg, build_model(cfg))
+
+    def test_teacher_inference_options(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as directory:
+            distiller = self.create_distiller(directory, [
+                "MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD", 0.5,
+                "MODEL.CoTDet.TEST.EARLY_EXIT.ENABLED", True,
+                "MODEL.CoTDet.TEST.QUERY_SCHEDULE", [20, 10],
+            ])
+        predictor = distiller.teacher.sem_seg_head.predictor
+        self.assertEqual(predictor.relevance_threshold, 0)
+        self.assertIsNone(predictor.decoder.early_exit)
+        self.assertIsNone(predictor.decoder.dec_layer_number)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as directory:
+            cache_dir = os.path.join(directory, "cache")
+            # the default scale jittering never gives the same image twice
+            distiller = self.create_distiller(directory, opts=["MODEL.CoTDet.DISTILLATION.CACHE_DIR", cache_dir])
+            self.assertIsNone(distiller.cache)
+            distiller = self.create_distiller(directory, opts=[
+                "MODEL.CoTDet.DISTILLATION.CACHE_DIR", cache_dir,
+                "INPUT.RANDOM_FLIP", "none",
+                "INPUT.MIN_SCALE", 1.0,
+                "INPUT.MAX_SCALE", 1.0,
+            ])
+            self.assertIsInstance(distiller.cache, TeacherOutputCache)
+
+            record = {"file_name": "a.jpg", "image": torch.zeros(3, 64, 48)}
+            key = TeacherOutputCache.key(record, (64, 64), 3)
+            self.assertEqual(key, TeacherOutputCache.key(dict(record, image=torch.ones(3, 64, 48)), (64, 64), 3))
+            self.assertNotEqual(key, TeacherOutputCache.key(record, (64, 64), 4))
+            self.assertNotEqual(key, TeacherOutputCache.key(record, (64, 96), 3))
+            self.assertNotEqual(key, TeacherOutputCache.key(dict(record, file_name="b.jpg"), (64, 64), 3))
+
+            cache = distiller.cache
+            self.assertIsNone(cache.load([key]))
+            cache.save([key], [{"pred_boxes": torch.rand(20, 4)}])
+            self.assertEqual(len(cache.load([key])), 1)
+            self.assertEqual((cache.hits, cache.misses, cache.hit_rate()), (1, 1, 0.5))
+
+            # the teacher runs on the first pass only
+            generator = torch.Generator().manual_seed(0)
+            batched_inputs = [
+                {"file_name": "{}.jpg".format(i), "image": torch.randint(0, 256, (3, 64, 64), generator=generator)}
+                for i in range(2)
+            ]
+            images = ImageList.from_tensors([x["image"].float() for x in batched_inputs], 32)
+            task_ids = torch.tensor([3, 11])
+            with EventStorage() as storage:
+                outputs = distiller.teacher_outputs(batched_inputs, images, task_ids, None)
+                cached = distiller.teacher_outputs(batched_inputs, images, task_ids, None)
+                self.assertEqual(storage.history("distill_cache_hit_rate").latest(), 3 / 6)
+            for x, y in zip(outputs, cached):
+                self.assertEqual(x.keys(), y.keys())
+                self.assertTrue(torch.allclose(x["pred_boxes"], y["pred_boxes"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from tiny_model import build_tiny_model
+
+
+def build_early_exit_model(score_cutoff):
+    return build_tiny_model([
+        "MODEL.CoTDet.TEST.EARLY_EXIT.ENABLED", True,
+        "MODEL.CoTDet.TEST.EARLY_EXIT.MIN_LAYERS", 1,
+        "MODEL.CoTDet.TEST.EARLY_EXIT.SCORE_DELTA", 0.0,
+        "MODEL.CoTDet.TEST.EARLY_EXIT.SCORE_CUTOFF", score_cutoff,
+    ])
+
+
+class TestEarlyExit(unittest.TestCase):
+    def test_score_cutoff_of_the_first_layer(self):
+        generator = torch.Generator().manual_seed(0)
+        image = torch.randint(0, 256, (3, 96, 128), generator=generator).float()
+        # no layer is stable with a zero score delta, only the cutoff stops the decoding
+        for score_cutoff, depth in [(0.0, 1), (1.0, 2)]:
+            model = build_early_exit_model(score_cutoff)
+            decoder = model.sem_seg_head.predictor.decoder
+            with torch.no_grad():
+                model([{"image": image, "task_id": 3}, {"image": image, "task_id": 5}])
+            self.assertEqual(decoder.batch_exit_depths, {depth: 1})
+
+    def test_is_stable_without_previous_layer(self):
+        decoder = build_early_exit_model(0.5).sem_seg_head.predictor.decoder
+        boxes = torch.rand(20, 2, 4)
+        scores = torch.full((20, 2), 0.1)
+        self.assertFalse(decoder.is_stable(scores, None, boxes, boxes))
+        scores[0] = 0.9
+        self.assertTrue(decoder.is_stable(scores, None, boxes, boxes))
+        # all the images of the batch are above the cutoff
+        scores[0, 1] = 0.1
+        self.assertFalse(decoder.is_stable(scores, None, boxes, boxes))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from detectron2.export import TracingAdapter
+
+from cotdet.export import CoTDetDeployModel, pytorch_deformable_attention
+from cotdet.modeling.pixel_encoder.ops.modules import MSDeformAttn
+
+from tiny_model import build_tiny_model
+
+
+def create_inputs():
+    generator = torch.Generator().manual_seed(0)
+    return [
+        {"image": torch.randint(0, 256, (3, 96, 128), generator=generator).float(), "height": 192, "width": 256,
+         "task_id": 3},
+        {"image": torch.randint(0, 256, (3, 128, 80), generator=generator).float(), "height": 128, "width": 80,
+         "task_id": 11},
+    ]
+
+
+def sort_instances(instances):
+    return instances[instances.scores.argsort(descending=True)]
+
+
+class TestCoTDetDeployModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.model = build_tiny_model()
+        cls.deploy_model = CoTDetDeployModel(cls.model)
+
+    def assertInstancesClose(self, results, references):
+        self.assertEqual(len(results), len(references))
+        for r, reference in zip(results, references):
+            r, reference = sort_instances(r["instances"]), sort_instances(reference["instances"])
+            self.assertGreater(len(reference), 0)
+            self.assertEqual(r.image_size, reference.image_size)
+            self.assertTrue(torch.allclose(r.scores, reference.scores, atol=1e-5))
+            self.assertTrue(r.pred_classes.equal(reference.pred_classes))
+            self.assertTrue(torch.allclose(r.pred_boxes.tensor, reference.pred_boxes.tensor, atol=1e-3))
+            # a few pixels on the border of the masks may flip
+            self.assertLess((r.pred_masks != reference.pred_masks).float().mean().item(), 1e-3)
+
+    def test_model_untouched(self):
+        # the compiled deformable attention is only turned off to export the model
+        modules = [m for m in self.model.modules() if isinstance(m, MSDeformAttn)]
+        self.assertGreater(len(modules), 0)
+        self.assertTrue(all(m.use_msda for m in modules))
+        with pytorch_deformable_attention(self.model):
+            self.assertFalse(any(m.use_msda for m in modules))
+        self.assertTrue(all(m.use_msda for m in modules))
+
+    def test_eager_parity(self):
+        inputs = create_inputs()
+        with torch.no_grad():
+            references = self.model(inputs)
+            results = self.deploy_model.inference(inputs)
+        self.assertInstancesClose(results, references)
+
+    def test_traced_parity(self):
+        inputs = create_inputs()
+        images, task_ids, _ = self.deploy_model.preprocess(inputs)
+        with torch.no_grad():
+            with pytorch_deformable_attention(self.model):
+                traced = torch.jit.trace(TracingAdapter(self.deploy_model, (images, task_ids)), (images, task_ids))
+            references = self.model(inputs)
+            results = self.deploy_model.inference(inputs, exported=traced)
+            # the task ids are inputs of the graph, not constants
+            num_tasks = len(self.model.sem_seg_head.predictor.task_captions)
+            inputs = [dict(x, task_id=(x["task_id"] + 1) % num_tasks) for x in inputs]
+            self.assertInstancesClose(self.deploy_model.inference(inputs, exported=traced), self.model(inputs))
+        self.assertInstancesClose(results, references)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from detectron2.layers import ShapeSpec
+
+from cotdet.modeling.pixel_encoder.ops.functions.ms_deform_attn_func import (
+    MSDA,
+    MSDeformAttnFunction,
+    ms_deform_attn_core_pytorch,
+)
+from cotdet.modeling.pixel_encoder.pixel_encoder import CoTDetEncoder
+
+HAS_MSDA = MSDA is not None and torch.cuda.is_available()
+
+
+def create_inputs(device, channels=8):
+    N, M, Lq, P = 2, 2, 5, 4
+    shapes = torch.as_tensor([(12, 10), (6, 5), (3, 3)], dtype=torch.long, device=device)
+    level_start_index = torch.cat((shapes.new_zeros((1,)), shapes.prod(1).cumsum(0)[:-1]))
+    S, L = int(shapes.prod(1).sum()), len(shapes)
+    value = torch.randn(N, S, M, channels, device=device)
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2, device=device)
+    attention_weights = torch.rand(N, Lq, M, L, P, device=device) + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    return value, shapes, level_start_index, sampling_locations, attention_weights
+
+
+def relative_error(x, reference):
+    return ((x.float() - reference).norm() / reference.norm()).item()
+
+
+def create_encoder():
+    input_shape = {
+        "res2": ShapeSpec(channels=16, stride=4),
+        "res3": ShapeSpec(channels=32, stride=8),
+        "res4": ShapeSpec(channels=64, stride=16),
+        "res5": ShapeSpec(channels=64, stride=32),
+    }
+    return CoTDetEncoder(
+        input_shape,
+        transformer_dropout=0.0,
+        transformer_nheads=4,
+        transformer_dim_feedforward=64,
+        transformer_enc_layers=2,
+        conv_dim=32,
+        mask_dim=32,
+        norm="GN",
+        transformer_in_features=["res3", "res4", "res5"],
+        common_stride=4,
+        num_feature_levels=3,
+        total_num_feature_levels=4,
+        feature_order="low2high",
+    )
+
+
+def create_features(device, size=64):
+    strides = {"res2": 4, "res3": 8, "res4": 16, "res5": 32}
+    channels = {"res2": 16, "res3": 32, "res4": 64, "res5": 64}
+    return {k: torch.randn(2, channels[k], size // s, size // s, device=device) for k, s in strides.items()}
+
+
+class TestMSDeformAttnPrecision(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_pytorch_half_precision(self):
+        value, shapes, _, sampling_locations, attention_weights = create_inputs("cpu")
+        reference = ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights)
+        for dtype, tolerance in [(torch.bfloat16, 2e-2), (torch.float16, 2e-3)]:
+            output = ms_deform_attn_core_pytorch(
+                value.to(dtype), shapes, sampling_locations, attention_weights.to(dtype)
+            )
+            self.assertEqual(output.dtype, dtype)
+            self.assertLess(relative_error(output, reference), tolerance)
+
+    def test_pytorch_bfloat16_backward(self):
+        inputs = create_inputs("cpu")
+        grads = []
+        for dtype in [torch.float32, torch.bfloat16]:
+            value, shapes, _, sampling_locations, attention_weights = [x.clone() for x in inputs]
+            value = value.to(dtype).requires_grad_()
+            attention_weights = attention_weights.to(dtype).requires_grad_()
+            sampling_locations.requires_grad_()
+            output = ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights)
+            output.float().square().sum().backward()
+            self.assertEqual(value.grad.dtype, dtype)
+            grads.append([value.grad, sampling_locations.grad, attention_weights.grad])
+        for grad, reference in zip(grads[1], grads[0]):
+            self.assertLess(relative_error(grad, reference), 5e-2)
+
+    @unittest.skipIf(not HAS_MSDA, "requires the compiled MultiScaleDeformableAttention op")
+    def test_cuda_half_precision(self):
+        value, shapes, level_start_index, sampling_locations, attention_weights = create_inputs("cuda", 32)
+        value.requires_grad_()
+        sampling_locations.requires_grad_()
+        attention_weights.requires_grad_()
+        reference = MSDeformAttnFunction.apply(value, shapes, level_start_index, sampling_locations, attention_weights, 2)
+        reference.square().sum().backward()
+        reference_grads = [value.grad, sampling_locations.grad, attention_weights.grad]
+        self.assertLess(
+            relative_error(ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights), reference),
+            1e-4,
+        )
+
+        for dtype, tolerance in [(torch.float16, 2e-3), (torch.bfloat16, 2e-2)]:
+            half_value = value.detach().to(dtype).requires_grad_()
+            half_weights = attention_weights.detach().to(dtype).requires_grad_()
+            locations = sampling_locations.detach().requires_grad_()
+            output = MSDeformAttnFunction.apply(half_value, shapes, level_start_index, locations, half_weights, 2)
+            self.assertEqual(output.dtype, dtype)
+            self.assertLess(relative_error(output, reference), tolerance)
+            output.float().square().sum().backward()
+            self.assertEqual(half_value.grad.dtype, dtype)
+            grads = [half_value.grad, locations.grad, half_weights.grad]
+            for grad, reference_grad in zip(grads, reference_grads):
+                self.assertLess(relative_error(grad, reference_grad), 5 * tolerance)
+
+
+class TestCoTDetEncoderAMP(unittest.TestCase):
+    def _check_autocast(self, device, dtype, tolerance):
+        torch.manual_seed(0)
+        encoder = create_encoder().to(device).eval()
+        features = create_features(device)
+        with torch.no_grad():
+            references = encoder.forward_features(features, None)
+            with torch.autocast(device, dtype=dtype):
+                outputs = encoder.forward_features(features, None)
+        mask_features, _, multi_scale_features = outputs
+        self.assertLess(relative_error(mask_features, references[0]), tolerance)
+        self.assertEqual(len(multi_scale_features), len(references[2]))
+        for x, reference in zip(multi_scale_features, references[2]):
+            self.assertEqual(x.shape, reference.shape)
+            self.assertLess(relative_error(x, reference), tolerance)
+
+    def test_cpu_bfloat16(self):
+        self._check_autocast("cpu", torch.bfloat16, 5e-2)
+
+    @unittest.skipIf(not HAS_MSDA, "requires the compiled MultiScaleDeformableAttention op")
+    def test_cuda_float16(self):
+        self._check_autocast("cuda", torch.float16, 1e-2)
+
+    @unittest.skipIf(not HAS_MSDA, "requires the compiled MultiScaleDeformableAttention op")
+    def test_cuda_bfloat16(self):
+        self._check_autocast("cuda", torch.bfloat16, 5e-2)
+
+    def _check_amp_disabled(self, device, dtype):
+        encoder = create_encoder().to(device).eval()
+        encoder.amp = False
+        with torch.no_grad(), torch.autocast(device, dtype=dtype):
+            mask_features, _, multi_scale_features = encoder.forward_features(create_features(device), None)
+        self.assertEqual(mask_features.dtype, torch.float32)
+        for x in multi_scale_features:
+            self.assertEqual(x.dtype, torch.float32)
+
+    def test_encoder_amp_disabled_cpu(self):
+        self._check_amp_disabled("cpu", torch.bfloat16)
+
+    @unittest.skipIf(not torch.cuda.is_available(), "requires CUDA")
+    def test_encoder_amp_disabled_cuda(self):
+        self._check_amp_disabled("cuda", torch.float16)
+
+
+if __name__ == "__main__":
+    unittest.main()
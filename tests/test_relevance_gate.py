@@ -0,0 +1,35 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from tiny_model import build_tiny_model
+
+
+class TestRelevanceGate(unittest.TestCase):
+    def test_tasks_of_an_image(self):
+        model = build_tiny_model(["MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD", 0.5])
+        # the tokens score high for the class of task 3 and low for all the others
+        class_embed = model.sem_seg_head.predictor.class_embed
+        with torch.no_grad():
+            class_embed.bias.fill_(-20)
+            class_embed.bias[3] = 20
+
+        generator = torch.Generator().manual_seed(0)
+        image = torch.randint(0, 256, (3, 96, 128), generator=generator).float()
+        with torch.no_grad():
+            results = model([{"image": image, "task_ids": [3, 11]}])
+        task_results = {r["task_id"]: r for r in results[0]["task_results"]}
+        self.assertGreater(task_results[3]["relevance"], 0.5)
+        self.assertGreater(len(task_results[3]["instances"]), 0)
+        self.assertLess(task_results[11]["relevance"], 0.5)
+        self.assertEqual(len(task_results[11]["instances"]), 0)
+
+        # the same for single-task samples of the image
+        with torch.no_grad():
+            results = model([{"image": image, "task_id": 11}, {"image": image, "task_id": 3}])
+        self.assertEqual([len(r["instances"]) > 0 for r in results], [False, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
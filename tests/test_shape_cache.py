@@ -0,0 +1,86 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import unittest
+
+import torch
+
+from cotdet.utils.shape_cache import SHAPE_CACHE, ShapeCache
+from cotdet.utils.utils import gen_encoder_output_proposals
+
+
+def create_memory(spatial_shapes, batch_size, d_model=8):
+    spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long)
+    num_tokens = int(spatial_shapes.prod(1).sum())
+    memory = torch.randn(batch_size, num_tokens, d_model)
+    padding_mask = torch.zeros((batch_size, num_tokens), dtype=torch.bool)
+    return memory, padding_mask, spatial_shapes
+
+
+class TestShapeCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ShapeCache()
+        calls = []
+
+        def compute(shape):
+            calls.append(shape)
+            return torch.zeros(shape)
+
+        a = cache.get(("zeros", (2, 3)), lambda: compute((2, 3)))
+        b = cache.get(("zeros", (2, 3)), lambda: compute((2, 3)))
+        c = cache.get(("zeros", (4, 3)), lambda: compute((4, 3)))
+        self.assertIs(a, b)
+        self.assertEqual(c.shape, (4, 3))
+        self.assertEqual(calls, [(2, 3), (4, 3)])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "size": 2, "hit_rate": 1 / 3})
+
+        # the tensors of inference mode are kept apart
+        with torch.inference_mode():
+            d = cache.get(("zeros", (2, 3)), lambda: compute((2, 3)))
+        self.assertIsNot(a, d)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0, "hit_rate": 0.0})
+
+    def test_max_size(self):
+        cache = ShapeCache(max_size=2)
+        for key in ["a", "b", "a", "c"]:
+            cache.get((key,), lambda: torch.zeros(1))
+        # "b" is the least recently used
+        self.assertEqual(cache.stats()["size"], 2)
+        cache.get(("a",), lambda: torch.zeros(1))
+        cache.get(("b",), lambda: torch.zeros(1))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 4)
+
+        cache = ShapeCache(max_size=0)
+        cache.get(("a",), lambda: torch.zeros(1))
+        cache.get(("a",), lambda: torch.zeros(1))
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0, "hit_rate": 0.0})
+
+    def test_encoder_output_proposals(self):
+        SHAPE_CACHE.clear()
+        for spatial_shapes, batch_size in [([[16, 12], [8, 6], [4, 3]], 2), ([[8, 8], [4, 4]], 2)]:
+            memory, padding_mask, spatial_shapes = create_memory(spatial_shapes, batch_size)
+            shape_key = (tuple(map(tuple, spatial_shapes.tolist())), batch_size, memory.device)
+            misses = SHAPE_CACHE.stats()["misses"]
+            expected = gen_encoder_output_proposals(memory, padding_mask, spatial_shapes)
+            for _ in range(2):
+                output = gen_encoder_output_proposals(memory, padding_mask, spatial_shapes, shape_key=shape_key)
+                for x, y in zip(output, expected):
+                    self.assertTrue(x.equal(y))
+            # computed for new shapes, then reused
+            self.assertEqual(SHAPE_CACHE.stats()["misses"], misses + 1)
+        self.assertEqual(SHAPE_CACHE.stats()["hits"], 2)
+
+        # the proposals of the cache are not part of the graph, the memory is
+        memory.requires_grad_()
+        output_memory, output_proposals = gen_encoder_output_proposals(
+            memory, padding_mask, spatial_shapes, shape_key=shape_key
+        )
+        self.assertTrue(output_memory.requires_grad)
+        self.assertFalse(output_proposals.requires_grad)
+        SHAPE_CACHE.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+import math
+import tempfile
+import unittest
+
+import torch
+
+from detectron2.modeling import build_model
+from detectron2.structures import Boxes, Instances
+
+from cotdet.tiling import CoTDetWithTiling, _truncated, merge_tile_instances, tile_windows
+from tiny_model import get_tiny_cfg
+
+
+def create_tile_instances(window, boxes, scores, classes):
+    # instances in image coordinates with the box masks of the size of their tile
+    y0, x0, y1, x1 = window
+    instances = Instances((y1 - y0, x1 - x0))
+    instances.pred_boxes = Boxes(torch.tensor(boxes, dtype=torch.float).reshape(-1, 4))
+    instances.scores = torch.tensor(scores, dtype=torch.float)
+    instances.pred_classes = torch.tensor(classes, dtype=torch.int64)
+    masks = torch.zeros((len(scores), y1 - y0, x1 - x0), dtype=torch.bool)
+    for m, (bx0, by0, bx1, by1) in zip(masks, instances.pred_boxes.tensor.round().int().tolist()):
+        m[max(by0 - y0, 0) : by1 - y0, max(bx0 - x0, 0) : bx1 - x0] = True
+    instances.pred_masks = masks
+    return instances
+
+
+def random_tile_instances(windows, n, generator):
+    tile_instances = []
+    for y0, x0, y1, x1 in windows:
+        xy = torch.rand(n, 2, generator=generator) * torch.tensor([x1 - x0, y1 - y0]) * 0.8
+        wh = torch.rand(n, 2, generator=generator) * 20 + 4
+        boxes = torch.cat([xy, xy + wh], 1) + torch.tensor([x0, y0, x0, y0])
+        boxes[:, 2].clamp_(max=x1)
+        boxes[:, 3].clamp_(max=y1)
+        scores = torch.rand(n, generator=generator)
+        classes = torch.randint(2, (n,), generator=generator)
+        tile_instances.append(
+            create_tile_instances((y0, x0, y1, x1), boxes.round().tolist(), scores.tolist(), classes.tolist())
+        )
+    return tile_instances
+
+
+def greedy_merge(tile_instances, windows, image_size, method, threshold):
+    # the instances kept by a greedy merge over the pairs, by decreasing score and the truncated ones last
+    entries = []
+    for instances, window in zip(tile_instances, windows):
+        truncated = _truncated(instances.pred_boxes, window, image_size)
+        for k in range(len(instances)):
+            entries.append((instances[k], window, bool(truncated[k])))
+
+    def overlap(a, b):
+        (ia, wa, ta), (ib, wb, tb) = a, b
+        if method == "box":
+            ba, bb = ia.pred_boxes.tensor[0], ib.pred_boxes.tensor[0]
+            iw = (torch.minimum(ba[2], bb[2]) - torch.maximum(ba[0], bb[0])).clamp(min=0)
+            ih = (torch.minimum(ba[3], bb[3]) - torch.maximum(ba[1], bb[1])).clamp(min=0)
+            inter, area_a, area_b = float(iw * ih), float(ia.pred_boxes.area()), float(ib.pred_boxes.area())
+        else:
+            masks = []
+            for instances, (y0, x0, y1, x1) in ((ia, wa), (ib, wb)):
+                m = torch.zeros(image_size, dtype=torch.bool)
+                m[y0:y1, x0:x1] = instances.pred_masks[0]
+                masks.append(m)
+            inter, area_a, area_b = float((masks[0] & masks[1]).sum()), float(masks[0].sum()), float(masks[1].sum())
+        if ta or tb:
+            return inter / max(min(area_a, area_b), 1e-6)
+        return inter / max(area_a + area_b - inter, 1e-6)
+
+    keep = []
+    for e in sorted(entries, key=lambda e: (e[2], -float(e[0].scores[0]))):
+        if not any(e[0].pred_classes[0] == k[0].pred_classes[0] and overlap(e, k) >= threshold for k in keep):
+            keep.append(e)
+    return [float(e[0].scores[0]) for e in keep]
+
+
+class TestTiling(unittest.TestCase):
+    def test_tile_windows(self):
+        self.assertEqual(tile_windows(300, 400, 512, 0.25), [(0, 0, 300, 400)])
+        for height, width, size, overlap in [(1000, 1500, 512, 0.25), (513, 2048, 512, 0.1), (1024, 1024, 512, 0)]:
+            windows = tile_windows(height, width, size, overlap)
+            covered = torch.zeros((height, width), dtype=torch.bool)
+            for y0, x0, y1, x1 in windows:
+                self.assertTrue(0 < y1 - y0 <= size and 0 < x1 - x0 <= size)
+                covered[y0:y1, x0:x1] = True
+            self.assertTrue(covered.all())
+            # neighbouring tiles overlap by at least overlap * size
+            for starts in ({w[0] for w in windows}, {w[1] for w in windows}):
+                starts = sorted(starts)
+                for a, b in zip(starts, starts[1:]):
+                    self.assertLessEqual(b - a, size * (1 - overlap))
+
+    def test_merge_cut_object(self):
+        # an object seen whole by the first tile and cut by the left border of the second one
+        windows = [(0, 0, 100, 100), (0, 60, 100, 160)]
+        tile_instances = [
+            create_tile_instances(windows[0], [[50, 10, 90, 50]], [0.6], [1]),
+            create_tile_instances(windows[1], [[60, 10, 90, 50], [120, 10, 150, 50]], [0.9, 0.8], [1, 1]),
+        ]
+        for method in ("box", "mask"):
+            result = merge_tile_instances(tile_instances, windows, (100, 160), method, 0.5, 100)
+            self.assertTrue(result.scores.equal(torch.tensor([0.8, 0.6])))
+            self.assertEqual(result.pred_boxes.tensor.tolist(), [[120, 10, 150, 50], [50, 10, 90, 50]])
+            self.assertEqual(result.pred_masks.shape, (2, 100, 160))
+            self.assertEqual(result.pred_masks.sum((1, 2)).tolist(), [30 * 40, 40 * 40])
+
+    def test_merge_classes(self):
+        windows = [(0, 0, 100, 100)]
+        tile_instances = [create_tile_instances(windows[0], [[10, 10, 50, 50], [12, 10, 50, 50]], [0.9, 0.8], [0, 1])]
+        result = merge_tile_instances(tile_instances, windows, (100, 100), "box", 0.5, 100)
+        self.assertEqual(result.pred_classes.tolist(), [0, 1])
+        result = merge_tile_instances(tile_instances, windows, (100, 100), "box", 0.5, 1)
+        self.assertEqual(result.pred_classes.tolist(), [0])
+
+    def test_matches_greedy_merge(self):
+        generator = torch.Generator().manual_seed(0)
+        image_size = (90, 130)
+        windows = tile_windows(*image_size, 64, 0.25)
+        tile_instances = random_tile_instances(windows, 12, generator)
+        for method in ("box", "mask"):
+            for threshold in (0.3, 0.7):
+                result = merge_tile_instances(tile_instances, windows, image_size, method, threshold, 1000)
+                expected = greedy_merge(tile_instances, windows, image_size, method, threshold)
+                self.assertEqual(result.scores.tolist(), expected)
+
+    def test_empty(self):
+        windows = [(0, 0, 100, 100), (0, 60, 100, 160)]
+        tile_instances = [create_tile_instances(w, [], [], []) for w in windows]
+        for method in ("box", "mask"):
+            result = merge_tile_instances(tile_instances, windows, (100, 160), method, 0.5, 100)
+            self.assertEqual(len(result), 0)
+            self.assertEqual(result.pred_masks.shape, (0, 100, 160))
+
+    def test_tiled_model(self):
+        with tempfile.TemporaryDirectory(prefix="cotdet_test") as directory:
+            cfg = get_tiny_cfg(directory, ["MODEL.CoTDet.TEST.TILING.SIZE", 64])
+            torch.manual_seed(0)
+            model = build_model(cfg).eval()
+        tiled_model = CoTDetWithTiling(cfg, model)
+        # the hooks of both modules run
+        calls = []
+        tiled_model.register_forward_hook(lambda module, inputs, outputs: calls.append("tiled"))
+        model.register_forward_hook(lambda module, inputs, outputs: calls.append("model"))
+
+        generator = torch.Generator().manual_seed(0)
+        image = torch.randint(0, 256, (3, 96, 160), generator=generator).float()
+        results = tiled_model([{"image": image, "task_id": 3, "height": 48, "width": 80}])
+        num_batches = math.ceil(len(tile_windows(96, 160, 64, 0.25)) / cfg.MODEL.CoTDet.TEST.TILING.BATCH_SIZE)
+        self.assertEqual(calls, ["model"] * num_batches + ["tiled"])
+        self.assertEqual(results[0]["instances"].image_size, (48, 80))
+        self.assertEqual(results[0]["instances"].pred_masks.shape[1:], (48, 80))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+The tiny CoTDet of configs/COCOTASK_R18_tiny.yaml with random weights and a synthetic knowledge base,
+shared by the tests.
+"""
+import os
+import tempfile
+
+import torch
+
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+
+from cotdet import add_maskformer2_config
+from cotdet.data.synthetic import write_synthetic_knowledge
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "COCOTASK_R18_tiny.yaml")
+
+
+def get_tiny_cfg(directory, opts=()):
+    """
+    Args:
+        directory (str): where to write the synthetic knowledge base
+        opts (list): config options to override, as for `CfgNode.merge_from_list`
+    """
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(CONFIG_FILE)
+    cfg.merge_from_list(list(opts))
+    task_name, knowledge_base = write_synthetic_knowledge(directory, 8)
+    cfg.MODEL.CoTDet.KNOWLEDGE.TASK_NAME = task_name
+    cfg.MODEL.CoTDet.KNOWLEDGE.KNOWLEDGE_BASE = knowledge_base
+    return cfg
+
+
+def build_tiny_model(opts=()):
+    """
+    Args:
+        opts (list): config options to override, as for `CfgNode.merge_from_list`
+
+    Returns:
+        CoTDet: in eval mode, seeded
+    """
+    # the knowledge is read when the model is built
+    with tempfile.TemporaryDirectory(prefix="cotdet_test") as directory:
+        cfg = get_tiny_cfg(directory, opts)
+        torch.manual_seed(0)
+        return build_model(cfg).eval()
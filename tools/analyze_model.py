@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Count the FLOPs, activations and parameters of CoTDet per module, for a given input size,
+number of queries and number of tasks per image. The inputs are random, the model does not
+need weights. The counts of the knowledge retrieval depend on the number of queries only.
+
+Run it from the root of the repository, e.g.
+    python tools/analyze_model.py --config-file configs/COCOTASK_R50.yaml --tasks flop activation \\
+        --input-size 1024 1024 --num-queries 300 --num-tasks 1 --synthetic-knowledge
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.analysis import parameter_count_table
+from detectron2.utils.logger import setup_logger
+from fvcore.nn import flop_count_table
+
+from cotdet import add_maskformer2_config
+from cotdet.data.synthetic import write_synthetic_knowledge
+from cotdet.utils.analysis import ActivationCountAnalysis, FlopCountAnalysis, by_module_table
+
+logger = logging.getLogger("cotdet")
+
+# the modules reported in the summary
+MAIN_MODULES = [
+    "backbone",
+    "sem_seg_head.pixel_decoder",
+    "sem_seg_head.pixel_decoder.transformer",
+    "sem_seg_head.predictor",
+    "sem_seg_head.predictor.decoder",
+    "sem_seg_head.predictor.know_pool",
+]
+
+
+def setup(args, directory):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if args.num_queries > 0:
+        cfg.MODEL.CoTDet.NUM_OBJECT_QUERIES = args.num_queries
+    if args.synthetic_knowledge:
+        task_name, knowledge_base = write_synthetic_knowledge(directory, args.knowledge_size)
+        cfg.MODEL.CoTDet.KNOWLEDGE.TASK_NAME = task_name
+        cfg.MODEL.CoTDet.KNOWLEDGE.KNOWLEDGE_BASE = knowledge_base
+    cfg.freeze()
+    return cfg
+
+
+def build_inputs(cfg, args):
+    h, w = args.input_size or (cfg.INPUT.IMAGE_SIZE, cfg.INPUT.IMAGE_SIZE)
+    image = torch.randint(0, 256, (3, h, w), dtype=torch.uint8)
+    if args.num_tasks == 1:
+        return [{"image": image, "height": h, "width": w, "task_id": 0}]
+    # a multi-task record: the image is encoded once and decoded for every task
+    return [{"image": image, "height": h, "width": w, "task_ids": list(range(args.num_tasks))}]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-file", required=True, metavar="FILE")
+    parser.add_argument("--tasks", choices=["flop", "activation", "parameter"], required=True, nargs="+")
+    parser.add_argument("--input-size", type=int, nargs=2, metavar=("H", "W"), help="default: INPUT.IMAGE_SIZE")
+    parser.add_argument("--num-queries", type=int, default=0, help="default: MODEL.CoTDet.NUM_OBJECT_QUERIES")
+    parser.add_argument("--num-tasks", type=int, default=1, help="number of tasks decoded for the image")
+    parser.add_argument("--synthetic-knowledge", action="store_true", help="use a random knowledge base")
+    parser.add_argument("--knowledge-size", type=int, default=8, help="knowledge entries per task, if synthetic")
+    parser.add_argument("--max-depth", type=int, default=3, help="depth of the modules in the tables")
+    parser.add_argument("--output", help="write the counts of the main modules to this json file")
+    parser.add_argument("opts", default=[], nargs=argparse.REMAINDER, help="modify config options")
+    args = parser.parse_args()
+
+    setup_logger(name="fvcore")
+    setup_logger(name="cotdet")
+    with tempfile.TemporaryDirectory(prefix="cotdet_analyze") as directory:
+        cfg = setup(args, directory)
+        model = build_model(cfg)
+    model.eval()
+    inputs = build_inputs(cfg, args)
+    h, w = inputs[0]["image"].shape[-2:]
+    logger.info(
+        "Input {}x{}, {} queries, {} tasks".format(h, w, cfg.MODEL.CoTDet.NUM_OBJECT_QUERIES, args.num_tasks)
+    )
+
+    result = {
+        "input_size": [h, w],
+        "num_queries": cfg.MODEL.CoTDet.NUM_OBJECT_QUERIES,
+        "num_tasks": args.num_tasks,
+    }
+    with torch.no_grad():
+        for task in args.tasks:
+            if task == "parameter":
+                logger.info("Parameter count:\n" + parameter_count_table(model, max_depth=args.max_depth))
+                continue
+            if task == "flop":
+                counts = FlopCountAnalysis(model, inputs)
+                unit, scale = "GFLOPs", 1e9
+            else:
+                counts = ActivationCountAnalysis(model, inputs)
+                unit, scale = "M activations", 1e6
+            logger.info("{} per module:\n".format(unit) + flop_count_table(counts, max_depth=args.max_depth + 1))
+            main = by_module_table(counts, MAIN_MODULES)
+            lines = ["{:<44}{:>14}".format("module", unit)]
+            lines += ["{:<44}{:>14.3f}".format(m, c / scale) for m, c in main.items()]
+            lines.append("{:<44}{:>14.3f}".format("total", counts.total() / scale))
+            logger.info("{} of the main modules:\n".format(unit) + "\n".join(lines))
+            result[task] = {"total": counts.total(), "by_module": main, "by_operator": dict(counts.by_operator())}
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        logger.info("Wrote the counts to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
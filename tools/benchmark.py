@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+A script to benchmark CoTDet.
+
+Run it from the root of the repository, e.g.
+    python tools/benchmark.py --config-file configs/COCOTASK_R50.yaml --task data
+    python tools/benchmark.py --task giou --max-iter 100
+    python tools/benchmark.py --config-file configs/COCOTASK_R50.yaml --task sparse_encoder --eval MODEL.WEIGHTS model.pth
+    python tools/benchmark.py --config-file configs/COCOTASK_R50.yaml --task query_pruning --eval MODEL.WEIGHTS model.pth
+    python tools/benchmark.py --config-file configs/COCOTASK_R50.yaml --task quantization --eval MODEL.WEIGHTS model.pth MODEL.DEVICE cpu
+    python tools/benchmark.py --config-file configs/COCOTASK_R50.yaml --task streaming MODEL.WEIGHTS model.pth
+"""
+
+import itertools
+import logging
+import os
+import random
+import sys
+from functools import partial
+
+import torch
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_train_loader, get_detection_dataset_dicts
+from detectron2.engine import default_argument_parser, launch
+from detectron2.evaluation.testing import flatten_results_dict
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils import comm
+from detectron2.utils.collect_env import collect_env_info
+from detectron2.utils.logger import setup_logger
+from fvcore.common.timer import Timer
+
+from cotdet import add_maskformer2_config, COCOTaskDatasetMapper, CoTDetStream
+from cotdet.data.batched_augmentation import BatchedLSJAugmentation
+from cotdet.data.stage_timer import DataStageTimer
+from cotdet.utils import box_ops
+from cotdet.utils.module_timer import ModuleTimer, instrument_cotdet
+from cotdet.utils.quantization import linear_quantization_errors, quantize_cotdet
+
+logger = logging.getLogger("detectron2")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    setup_logger(distributed_rank=comm.get_rank())
+    return cfg
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark_data(args):
+    """
+    Measure the training data pipeline in images per second: the data loader alone and,
+    when INPUT.BATCHED_AUG.ENABLED is set, the batched augmentation that the model runs
+    on the loaded batch. Run it with the option on and off to compare both pipelines.
+    """
+    cfg = setup(args)
+    data_loader = build_detection_train_loader(cfg, mapper=COCOTaskDatasetMapper(cfg, True))
+    batched_aug = BatchedLSJAugmentation(cfg) if cfg.INPUT.BATCHED_AUG.ENABLED else None
+    device = torch.device(cfg.MODEL.DEVICE)
+    pixel_mean = torch.tensor(cfg.MODEL.PIXEL_MEAN, device=device).view(-1, 1, 1)
+    pixel_std = torch.tensor(cfg.MODEL.PIXEL_STD, device=device).view(-1, 1, 1)
+
+    warmup, max_iter = 10, args.max_iter
+    loader_time = aug_time = 0.0
+    num_images = 0
+    data_iter = iter(data_loader)
+    for _ in range(warmup):
+        next(data_iter)
+    for _ in tqdm.trange(max_iter):
+        timer = Timer()
+        batch = next(data_iter)
+        loader_time += timer.seconds()
+        num_images += len(batch)
+        if batched_aug is None:
+            continue
+        timer.reset()
+        images = [x["image"].to(device, non_blocking=True) for x in batch]
+        image_index = None
+        if "task_instances" in batch[0]:
+            # multi-task records, one ground truth per (image, task) sample as in CoTDet.forward
+            instances = [inst.to(device) for x in batch for _, inst in x["task_instances"]]
+            image_index = torch.as_tensor(
+                [i for i, x in enumerate(batch) for _ in x["task_instances"]], device=device
+            )
+        else:
+            instances = [x["instances"].to(device) for x in batch]
+        batched_aug(images, instances, pixel_mean, pixel_std, cfg.MODEL.CoTDet.SIZE_DIVISIBILITY, image_index)
+        _sync(device)
+        aug_time += timer.seconds()
+
+    logger.info(
+        "Data loader ({} workers): {:.2f} images/s".format(
+            cfg.DATALOADER.NUM_WORKERS, num_images / loader_time
+        )
+    )
+    if batched_aug is not None:
+        logger.info(
+            "{} on {}: {:.2f} images/s, loader + augmentation: {:.2f} images/s".format(
+                batched_aug, device, num_images / aug_time, num_images / (loader_time + aug_time)
+            )
+        )
+
+
+def benchmark_data_stages(args):
+    """
+    Run the training mapper in the main process on random records and print the percentiles
+    of the time spent in each of its stages.
+    """
+    cfg = setup(args)
+    dataset_dicts = get_detection_dataset_dicts(
+        cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS
+    )
+    timer = DataStageTimer(COCOTaskDatasetMapper.STAGES, record_samples=True)
+    mapper = COCOTaskDatasetMapper(cfg, True, stage_timer=timer)
+
+    total = Timer()
+    for _ in tqdm.trange(args.max_iter):
+        mapper(random.choice(dataset_dicts))
+    total_time = total.seconds()
+
+    totals = timer.totals()
+    lines = ["{:<26}{:>10}{:>10}{:>10}{:>10}{:>8}".format("stage", "p50 ms", "p90 ms", "p99 ms", "mean ms", "share")]
+    for stage, (p50, p90, p99) in timer.percentiles().items():
+        seconds, count = totals[timer.stages.index(stage)]
+        lines.append(
+            "{:<26}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>7.1f}%".format(
+                stage, p50 * 1e3, p90 * 1e3, p99 * 1e3, seconds / count * 1e3, seconds / total_time * 100
+            )
+        )
+    logger.info(
+        "Mapper stages over {} images, {:.2f} images/s per worker:\n".format(
+            args.max_iter, args.max_iter / total_time
+        )
+        + "\n".join(lines)
+    )
+
+
+def benchmark_checkpointing(args):
+    """
+    Train a few iterations with activation checkpointing off, on the encoder, on the decoder
+    and on both, and print a table of the peak GPU memory and the time per iteration.
+    """
+    cfg = setup(args)
+    assert torch.cuda.is_available(), "--task checkpointing measures GPU memory"
+    data_loader = build_detection_train_loader(cfg, mapper=COCOTaskDatasetMapper(cfg, True))
+    batches = list(itertools.islice(data_loader, 5))
+    enc_layers = list(range(cfg.MODEL.SEM_SEG_HEAD.TRANSFORMER_ENC_LAYERS))
+    dec_layers = list(range(cfg.MODEL.CoTDet.DEC_LAYERS))
+    settings = {
+        "none": ([], [], []),
+        "encoder": (enc_layers, [], []),
+        "decoder": ([], dec_layers, dec_layers),
+        "all": (enc_layers, dec_layers, dec_layers),
+    }
+
+    warmup, max_iter = 3, args.max_iter
+    rows = []
+    for name, (enc, dec, heads) in settings.items():
+        cur_cfg = cfg.clone()
+        cur_cfg.defrost()
+        cur_cfg.MODEL.CoTDet.CHECKPOINT.ENC_LAYERS = enc
+        cur_cfg.MODEL.CoTDet.CHECKPOINT.DEC_LAYERS = dec
+        cur_cfg.MODEL.CoTDet.CHECKPOINT.PRED_HEADS = heads
+        model = build_model(cur_cfg)
+        model.train()
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+        torch.cuda.reset_peak_memory_stats()
+        timer = Timer()
+        for it, batch in enumerate(itertools.islice(itertools.cycle(batches), warmup + max_iter)):
+            if it == warmup:
+                torch.cuda.synchronize()
+                timer.reset()
+            with torch.cuda.amp.autocast(enabled=cur_cfg.SOLVER.AMP.ENABLED):
+                losses = sum(model(batch).values())
+            optimizer.zero_grad()
+            losses.backward()
+            optimizer.step()
+        torch.cuda.synchronize()
+        seconds = timer.seconds() / max_iter
+        rows.append((name, torch.cuda.max_memory_allocated() / 1024**3, seconds, len(batches[0]) / seconds))
+        del model, optimizer
+        torch.cuda.empty_cache()
+
+    lines = ["{:<10}{:>16}{:>12}{:>12}".format("ckpt", "peak mem (GB)", "s / iter", "images/s")]
+    lines += ["{:<10}{:>16.2f}{:>12.3f}{:>12.2f}".format(*row) for row in rows]
+    logger.info(
+        "Activation checkpointing, {} images per GPU:\n".format(len(batches[0])) + "\n".join(lines)
+    )
+
+
+def _inference_settings(args, cfg, model, settings, regions):
+    """
+    For every (name, apply) of `settings`, call `apply()`, time the `regions` of the model
+    (see :func:`instrument_cotdet`) in inference on the first test dataset, and with `--eval`
+    evaluate the model on the test datasets.
+
+    Returns:
+        list[list]: the name, the median ms of every region and the APs of every setting
+        list[dict]: the flattened results of the evaluation of every setting, empty without `--eval`
+    """
+    from train_net import Trainer
+
+    timer = ModuleTimer(sync_cuda=True, track_memory=False)
+    instrument_cotdet(timer, model, time_backward=False)
+    data_loader = Trainer.build_test_loader(cfg, cfg.DATASETS.TEST[0])
+    batches = list(itertools.islice(data_loader, 5 + args.max_iter))
+
+    rows, evaluations = [], []
+    for name, apply in settings:
+        apply()
+        timer.reset()
+        with torch.no_grad():
+            for it, batch in enumerate(batches):
+                model(batch)
+                timer.step()
+                if it + 1 == 5:
+                    timer.reset()
+        summary = timer.summary()
+        row = [name] + [summary[r]["median_ms"] for r in regions]
+        if args.eval:
+            results = flatten_results_dict(Trainer.test(cfg, model))
+            row.append(" ".join("{}={:.2f}".format(k, v) for k, v in results.items() if k.endswith("/AP")))
+            evaluations.append(results)
+        else:
+            row.append("")
+        rows.append(row)
+    return rows, evaluations
+
+
+def _build_eval_model(cfg):
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    return model
+
+
+def benchmark_sparse_encoder(args):
+    """
+    Time the pixel encoder in inference on the first test dataset for every ratio of
+    `--sparse-ratios` (MODEL.SEM_SEG_HEAD.ENCODER_SPARSE_RATIO), and with `--eval` evaluate
+    MODEL.WEIGHTS on the test datasets with each of them, to trade the encoder latency for AP.
+    """
+    cfg = setup(args)
+    model = _build_eval_model(cfg)
+    transformer = model.sem_seg_head.pixel_decoder.transformer
+    settings = [
+        ("{:.2f}".format(r), partial(setattr, transformer, "sparse_ratio", r)) for r in args.sparse_ratios
+    ]
+    rows, _ = _inference_settings(args, cfg, model, settings, ["pixel_encoder"])
+
+    lines = ["{:<8}{:>16}  {}".format("ratio", "encoder ms", "AP" if args.eval else "")]
+    lines += ["{:<8}{:>16.2f}  {}".format(*row) for row in rows]
+    logger.info(
+        "Sparse pixel encoder, median over {} batches of {}:\n".format(args.max_iter, cfg.DATASETS.TEST[0])
+        + "\n".join(lines)
+    )
+
+
+def _parse_query_schedule(schedule, num_layers):
+    # "300x3,150x3,100x3" -> [300, 300, 300, 150, 150, 150, 100, 100, 100]
+    ret = []
+    for item in schedule.split(","):
+        num_queries, _, repeat = item.partition("x")
+        ret += [int(num_queries)] * int(repeat or 1)
+    assert len(ret) == num_layers, "{} has {} layers instead of {}".format(schedule, len(ret), num_layers)
+    return ret
+
+
+def benchmark_query_pruning(args):
+    """
+    Time the decoder in inference on the first test dataset for every schedule of
+    `--query-schedules` (MODEL.CoTDet.TEST.QUERY_SCHEDULE, e.g. "300x3,150x3,100x3" for 9
+    layers), and with `--eval` evaluate MODEL.WEIGHTS on the test datasets with each of them.
+    The empty schedule "" keeps all the queries.
+    """
+    cfg = setup(args)
+    model = _build_eval_model(cfg)
+    predictor = model.sem_seg_head.predictor
+    settings = []
+    for schedule in args.query_schedules:
+        dec_layer_number = None
+        if schedule:
+            dec_layer_number = _parse_query_schedule(schedule, predictor.num_layers)
+            dec_layer_number = predictor.check_query_schedule(dec_layer_number)
+        settings.append((schedule or "all", partial(setattr, predictor.decoder, "dec_layer_number", dec_layer_number)))
+    regions = ["decoder_layers", "decoder", "postprocess"]
+    rows, _ = _inference_settings(args, cfg, model, settings, regions)
+
+    lines = ["{:<20}{:>18}{:>14}{:>16}  {}".format("schedule", "dec. layers ms", "heads ms", "postprocess ms",
+                                                   "AP" if args.eval else "")]
+    lines += ["{:<20}{:>18.2f}{:>14.2f}{:>16.2f}  {}".format(*row) for row in rows]
+    logger.info(
+        "Query pruning, median over {} batches of {}:\n".format(args.max_iter, cfg.DATASETS.TEST[0])
+        + "\n".join(lines)
+    )
+
+
+def benchmark_quantization(args):
+    """
+    Compare the dynamic INT8 quantization of MODEL.CoTDet.TEST.QUANTIZATION with fp32 for MODEL.WEIGHTS
+    on CPU: the relative output error of every quantized layer on `--calibration-batches` batches of the
+    first test dataset, the median time of the regions of the model in inference, and with `--eval` the
+    AP on every test dataset.
+    """
+    from train_net import Trainer
+
+    cfg = setup(args)
+    assert cfg.MODEL.DEVICE == "cpu", "the dynamic INT8 quantization only runs on CPU"
+    model = _build_eval_model(cfg)
+    quantization = cfg.MODEL.CoTDet.TEST.QUANTIZATION
+
+    data_loader = Trainer.build_test_loader(cfg, cfg.DATASETS.TEST[0])
+    errors = linear_quantization_errors(
+        model, quantization.MODULES, itertools.islice(data_loader, args.calibration_batches), quantization.EXCLUDE
+    )
+    lines = ["{:<72}{:>12}".format("layer", "rel. error")]
+    lines += ["{:<72}{:>12.4f}".format(k, v) for k, v in sorted(errors.items(), key=lambda x: -x[1])]
+    logger.info(
+        "Output error of the quantized layers over {} batches, the largest first:\n".format(args.calibration_batches)
+        + "\n".join(lines)
+    )
+
+    settings = [
+        ("fp32", lambda: None),
+        ("int8", partial(quantize_cotdet, model, quantization.MODULES, quantization.EXCLUDE)),
+    ]
+    regions = ["backbone", "pixel_encoder", "knowledge_retrieval", "decoder_layers", "decoder", "postprocess"]
+    rows, evaluations = _inference_settings(args, cfg, model, settings, regions)
+    lines = ["{:<8}".format("") + "".join("{:>21}".format(r + " ms") for r in regions + ["total"])]
+    for row in rows:
+        times = row[1:-1]
+        lines.append("{:<8}".format(row[0]) + "".join("{:>21.2f}".format(t) for t in times + [sum(times)]))
+    logger.info(
+        "Quantization, median over {} batches of {}:\n".format(args.max_iter, cfg.DATASETS.TEST[0]) + "\n".join(lines)
+    )
+
+    if evaluations:
+        fp32, int8 = evaluations
+        keys = [k for k in fp32 if k.endswith("/AP")]
+        lines = ["{:<40}{:>10}{:>10}{:>10}".format("AP", "fp32", "int8", "delta")]
+        lines += ["{:<40}{:>10.2f}{:>10.2f}{:>+10.2f}".format(k, fp32[k], int8[k], int8[k] - fp32[k]) for k in keys]
+        if keys:
+            mean_fp32, mean_int8 = [sum(x[k] for k in keys) / len(keys) for x in (fp32, int8)]
+            lines.append("{:<40}{:>10.2f}{:>10.2f}{:>+10.2f}".format("mean", mean_fp32, mean_int8, mean_int8 - mean_fp32))
+        logger.info("Accuracy of the quantized model:\n" + "\n".join(lines))
+
+
+def benchmark_streaming(args):
+    """
+    Compare the frames per second of :class:`CoTDetStream` with the inference of every frame on its
+    own, on a stream of `--max-iter` frames panning over the first image of the first test dataset by
+    `--stream-shift` pixels per frame: with the reuse of the queries only, and with the reuse of the
+    features below `--feature-reuse-threshold` too.
+    """
+    from train_net import Trainer
+
+    cfg = setup(args)
+    model = _build_eval_model(cfg)
+    record = next(iter(Trainer.build_test_loader(cfg, cfg.DATASETS.TEST[0])))[0]
+    record = {k: record[k] for k in ("image", "task_id")}
+    frames = [
+        dict(record, image=torch.roll(record["image"], t * args.stream_shift, dims=-1)) for t in range(args.max_iter + 5)
+    ]
+
+    stream = CoTDetStream(cfg, model)
+    settings = [
+        ("per frame", lambda frame: model([frame])[0], None),
+        ("queries", stream, 0.0),
+        ("queries+features", stream, args.feature_reuse_threshold),
+    ]
+    rows = []
+    for name, f, threshold in settings:
+        if threshold is not None:
+            stream.feature_reuse_threshold = threshold
+            stream.reset()
+            stream.stats.clear()
+        ids = set()
+        with torch.no_grad():
+            for it, frame in enumerate(frames):
+                if it == 5:
+                    _sync(model.device)
+                    timer = Timer()
+                instances = f(frame)["instances"]
+                if instances.has("ID"):
+                    ids.update(instances.ID)
+        _sync(model.device)
+        fps = args.max_iter / timer.seconds()
+        stats = stream.stats if threshold is not None else {}
+        rows.append([name, fps, stats.get("encoded", len(frames)), stats.get("selection", len(frames)), len(ids)])
+
+    lines = ["{:<20}{:>10}{:>10}{:>12}{:>10}".format("", "fps", "encoded", "selections", "tracks")]
+    lines += ["{:<20}{:>10.2f}{:>10}{:>12}{:>10}".format(*row) for row in rows]
+    logger.info(
+        "Streaming inference of {} frames of {}:\n".format(len(frames), cfg.DATASETS.TEST[0]) + "\n".join(lines)
+    )
+
+
+def _random_boxes(n, device, dtype=torch.float):
+    # valid xyxy boxes, as produced by box_cxcywh_to_xyxy from normalized predictions
+    cxcy, wh = torch.rand(n, 2, device=device, dtype=dtype), torch.rand(n, 2, device=device, dtype=dtype)
+    return box_ops.box_cxcywh_to_xyxy(torch.cat([cxcy, wh * 0.5], dim=1))
+
+
+def benchmark_giou(args):
+    """
+    Compare the GIoU loss of N matched pairs computed as the diagonal of the [N, N]
+    `generalized_box_iou` matrix and with the element-wise `generalized_box_iou_pairwise`.
+    N is the number of matched boxes of a layer, e.g. DN scalar x number of GT boxes for the
+    DN outputs. Their values and gradients are compared in tests/test_box_ops.py.
+    """
+    setup_logger(distributed_rank=comm.get_rank())
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def full_loss(boxes1, boxes2):
+        return (1 - torch.diag(box_ops.generalized_box_iou(boxes1, boxes2))).sum()
+
+    def pairwise_loss(boxes1, boxes2):
+        return (1 - box_ops.generalized_box_iou_pairwise(boxes1, boxes2)).sum()
+
+    rows = []
+    for n in [10, 30, 100, 300, 1000, 3000, 10000]:
+        boxes1 = _random_boxes(n, device).requires_grad_()
+        boxes2 = _random_boxes(n, device)
+        with torch.no_grad():
+            boxes1[: n // 4] = boxes2[: n // 4]
+
+        row = [n]
+        for f in [full_loss, pairwise_loss]:
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+            for it in range(args.max_iter + 5):
+                if it == 5:
+                    _sync(device)
+                    timer = Timer()
+                boxes1.grad = None
+                f(boxes1, boxes2).backward()
+            _sync(device)
+            row.append(timer.seconds() / args.max_iter * 1e3)
+            row.append(torch.cuda.max_memory_allocated() / 1024**2 if device.type == "cuda" else float("nan"))
+        rows.append(row)
+
+    lines = ["{:>8}{:>14}{:>14}{:>14}{:>14}{:>10}".format(
+        "N", "diag ms", "diag MB", "pairwise ms", "pairwise MB", "speedup")]
+    lines += ["{:>8}{:>14.3f}{:>14.1f}{:>14.3f}{:>14.1f}{:>9.1f}x".format(*row, row[1] / row[3]) for row in rows]
+    logger.info(
+        "GIoU loss forward + backward on {}:\n".format(device) + "\n".join(lines)
+    )
+
+
+def main() -> None:
+    parser = default_argument_parser()
+    parser.add_argument(
+        "--task",
+        choices=["data", "data_stages", "checkpointing", "giou", "sparse_encoder", "query_pruning", "quantization",
+                 "streaming"],
+        required=True,
+    )
+    parser.add_argument("--max-iter", type=int, default=200, help="number of iterations to measure")
+    parser.add_argument(
+        "--sparse-ratios", type=float, nargs="+", default=[1.0, 0.5, 0.3, 0.1], help="for --task sparse_encoder"
+    )
+    parser.add_argument(
+        "--query-schedules", nargs="+", default=["", "300x3,150x3,100x3", "300x2,200x2,100x5"],
+        help="for --task query_pruning",
+    )
+    parser.add_argument(
+        "--calibration-batches", type=int, default=20, help="for --task quantization, to measure the layer errors"
+    )
+    parser.add_argument("--stream-shift", type=int, default=2, help="for --task streaming, pixels per frame")
+    parser.add_argument(
+        "--feature-reuse-threshold", type=float, default=0.02, help="for --task streaming, see CoTDetStream"
+    )
+    parser.add_argument("--eval", action="store_true", help="also evaluate the AP, for the sparse_encoder, "
+                        "query_pruning and quantization tasks")
+    args = parser.parse_args()
+    assert not args.eval_only
+
+    logger.info("Environment info:\n" + collect_env_info())
+    if args.task == "data":
+        f = benchmark_data
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "data_stages":
+        f = benchmark_data_stages
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "checkpointing":
+        f = benchmark_checkpointing
+        assert args.num_gpus == 1 and args.num_machines == 1
+    elif args.task == "giou":
+        f = benchmark_giou
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "sparse_encoder":
+        f = benchmark_sparse_encoder
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "query_pruning":
+        f = benchmark_query_pruning
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "quantization":
+        f = benchmark_quantization
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    elif args.task == "streaming":
+        f = benchmark_streaming
+        assert args.num_gpus <= 1 and args.num_machines == 1
+    launch(
+        f,
+        args.num_gpus,
+        args.num_machines,
+        args.machine_rank,
+        args.dist_url,
+        args=(args,),
+    )
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Time the stages of CoTDet on synthetic data: the mapper, backbone, pixel encoder, knowledge
+retrieval, decoder, matcher, criterion and backward in training, and the same forward stages
+plus postprocessing in inference. The default tiny config runs on CPU without any download,
+images and knowledge base are random.
+
+Run it from the root of the repository, e.g.
+    python tools/benchmark_suite.py --output bench.json
+    python tools/benchmark_suite.py --output bench.json --baseline baseline.json --tolerance 0.2
+It exits with status 1 when a stage is slower than in the baseline by more than the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+from cotdet import add_maskformer2_config, COCOTaskDatasetMapper
+from cotdet.data.synthetic import write_synthetic_knowledge, write_synthetic_records
+from cotdet.utils.module_timer import ModuleTimer, instrument_cotdet
+from cotdet.utils.shape_cache import SHAPE_CACHE
+
+logger = logging.getLogger("cotdet")
+
+DEFAULT_CONFIG = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "COCOTASK_R18_tiny.yaml"
+)
+RESULT_VERSION = 1
+
+
+def setup(args, directory):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    task_name, knowledge_base = write_synthetic_knowledge(directory, args.knowledge_size)
+    cfg.MODEL.CoTDet.KNOWLEDGE.TASK_NAME = task_name
+    cfg.MODEL.CoTDet.KNOWLEDGE.KNOWLEDGE_BASE = knowledge_base
+    cfg.freeze()
+    return cfg
+
+
+def run_suite(args):
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="cotdet_bench") as directory:
+        cfg = setup(args, directory)
+        batch_size = cfg.SOLVER.IMS_PER_BATCH
+        records = write_synthetic_records(
+            directory, batch_size * 4, cfg.INPUT.IMAGE_SIZE, cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES, seed=args.seed
+        )
+        device = torch.device(cfg.MODEL.DEVICE)
+        timer = ModuleTimer(sync_cuda=True, track_memory=False)
+
+        mapper = COCOTaskDatasetMapper(cfg, True)
+        model = instrument_cotdet(timer, build_model(cfg))
+
+        def batches():
+            while True:
+                for i in range(0, len(records), batch_size):
+                    yield records[i : i + batch_size]
+
+        results = {}
+        data = batches()
+        model.train()
+        for it in range(args.warmup + args.max_iter):
+            with timer.time("mapper"):
+                batch = [mapper(r) for r in next(data)]
+            losses = model(batch)
+            loss = sum(losses.values())
+            model.zero_grad(set_to_none=True)
+            loss.backward()
+            timer.step()
+            if it + 1 == args.warmup:
+                timer.reset()
+        results["train"] = timer.summary()
+
+        timer.reset()
+        model.eval()
+        with torch.no_grad():
+            for it in range(args.warmup + args.max_iter):
+                # the inputs of the model, the mapper was measured in training
+                batch = [mapper(r) for r in next(data)]
+                for x in batch:
+                    x.pop("instances")
+                model(batch)
+                timer.step()
+                if it + 1 == args.warmup:
+                    timer.reset()
+        results["inference"] = timer.summary()
+        shape_cache = SHAPE_CACHE.stats()
+
+    return {
+        "version": RESULT_VERSION,
+        "config": {
+            "config_file": args.config_file,
+            "opts": args.opts,
+            "batch_size": batch_size,
+            "image_size": cfg.INPUT.IMAGE_SIZE,
+            "knowledge_size": args.knowledge_size,
+            "max_iter": args.max_iter,
+        },
+        "env": {
+            "torch": torch.__version__,
+            "device": str(device),
+            "num_threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "shape_cache": shape_cache,
+        "stages": {
+            "{}/{}".format(mode, stage): stats for mode, stages in results.items() for stage, stats in stages.items()
+        },
+    }
+
+
+def compare(result, baseline, tolerance, min_ms):
+    """
+    Compare the median times of the stages with a baseline result.
+
+    Returns:
+        list[dict]: one entry per stage of the baseline, with "regression" set when the stage
+        is slower than the baseline by more than `tolerance` and by more than `min_ms`.
+    """
+    if baseline["config"] != result["config"]:
+        logger.warning("The baseline was measured with another config: {}".format(baseline["config"]))
+    if baseline["env"] != result["env"]:
+        logger.warning("The baseline was measured in another environment: {}".format(baseline["env"]))
+    rows = []
+    for stage, base in baseline["stages"].items():
+        if stage not in result["stages"]:
+            logger.warning("Stage {} of the baseline was not measured.".format(stage))
+            continue
+        base_ms, ms = base["median_ms"], result["stages"][stage]["median_ms"]
+        ratio = ms / base_ms if base_ms > 0 else float("inf")
+        rows.append(
+            {
+                "stage": stage,
+                "baseline_ms": base_ms,
+                "median_ms": ms,
+                "ratio": ratio,
+                "regression": ratio > 1 + tolerance and ms - base_ms > min_ms,
+            }
+        )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-file", default=DEFAULT_CONFIG, metavar="FILE")
+    parser.add_argument("--max-iter", type=int, default=20, help="number of iterations to measure")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--knowledge-size", type=int, default=8, help="knowledge entries per task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-threads", type=int, default=0, help="torch CPU threads, 0 to keep the default")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file written by a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown of a stage")
+    parser.add_argument("--min-ms", type=float, default=0.5, help="ignore slowdowns smaller than this")
+    parser.add_argument("opts", default=[], nargs=argparse.REMAINDER, help="modify config options")
+    args = parser.parse_args()
+
+    setup_logger(name="cotdet")
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    result = run_suite(args)
+
+    lines = ["{:<32}{:>12}{:>12}{:>12}".format("stage", "median ms", "mean ms", "p90 ms")]
+    for stage, stats in result["stages"].items():
+        lines.append(
+            "{:<32}{:>12.2f}{:>12.2f}{:>12.2f}".format(stage, stats["median_ms"], stats["mean_ms"], stats["p90_ms"])
+        )
+    logger.info("CoTDet stages over {} iterations:\n".format(args.max_iter) + "\n".join(lines))
+    logger.info("Shape cache: {}".format(result["shape_cache"]))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        assert baseline["version"] == RESULT_VERSION, baseline["version"]
+        rows = compare(result, baseline, args.tolerance, args.min_ms)
+        result["comparison"] = {"baseline": args.baseline, "tolerance": args.tolerance, "stages": rows}
+        lines = ["{:<32}{:>12}{:>12}{:>8}".format("stage", "baseline ms", "median ms", "ratio")]
+        for row in rows:
+            lines.append(
+                "{:<32}{:>12.2f}{:>12.2f}{:>7.2f}x{}".format(
+                    row["stage"], row["baseline_ms"], row["median_ms"], row["ratio"],
+                    "  REGRESSION" if row["regression"] else "",
+                )
+            )
+        logger.info("Comparison with {}:\n".format(args.baseline) + "\n".join(lines))
+        regressions = [row["stage"] for row in rows if row["regression"]]
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        logger.info("Wrote the results to {}".format(args.output))
+    if regressions:
+        logger.error("Slower than the baseline by more than {:.0%}: {}".format(args.tolerance, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Calibrate MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD, the relevance gate that skips the decoding of
+the images without any object of their task. It runs MODEL.WEIGHTS with the gate disabled on
+the single-task test datasets, records the relevance of every image and the ground truth
+objects it detects, and reports for every threshold the rate of skipped images and the recall
+that skipping them would lose: the share of the detected objects that are in skipped images.
+
+Run it from the root of the repository, e.g.
+    python tools/calibrate_relevance_gate.py --config-file configs/COCOTASK_R50.yaml \\
+        --max-recall-loss 0.005 --output gate.json MODEL.WEIGHTS model.pth
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.structures import Boxes, BoxMode, pairwise_iou
+from detectron2.utils.logger import setup_logger
+
+from cotdet import add_maskformer2_config
+
+logger = logging.getLogger("cotdet")
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    # decode every image to measure what the gate would skip
+    cfg.MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD = 0.0
+    cfg.freeze()
+    return cfg
+
+
+def gt_boxes(record):
+    boxes = [BoxMode.convert(obj["bbox"], obj["bbox_mode"], BoxMode.XYXY_ABS) for obj in record["annotations"]]
+    return Boxes(torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4))
+
+
+def collect(cfg, model, dataset_name, iou_threshold, min_score):
+    """
+    Returns:
+        list[tuple]: the relevance, the number of ground truth objects and the number of them
+        detected with an IoU of at least `iou_threshold`, for every image of the dataset.
+    """
+    from train_net import Trainer
+
+    records = {r["image_id"]: r for r in DatasetCatalog.get(dataset_name)}
+    data_loader = Trainer.build_test_loader(cfg, dataset_name)
+    samples = []
+    with torch.no_grad():
+        for batch in tqdm.tqdm(data_loader, desc=dataset_name):
+            for x, r in zip(batch, model(batch)):
+                gt = gt_boxes(records[x["image_id"]])
+                instances = r["instances"].to("cpu")
+                pred = instances.pred_boxes[instances.scores >= min_score]
+                detected = 0
+                if len(gt) and len(pred):
+                    detected = int((pairwise_iou(gt, pred).max(1)[0] >= iou_threshold).sum())
+                samples.append((r["relevance"], len(gt), detected))
+    return samples
+
+
+def sweep(samples, thresholds):
+    """
+    Returns:
+        list[dict]: the skip rate and the recall loss of every threshold.
+    """
+    relevance, num_gt, detected = [np.asarray(x, dtype=np.float64) for x in zip(*samples)]
+    rows = []
+    for t in thresholds:
+        skipped = relevance < t
+        rows.append(
+            {
+                "threshold": float(t),
+                "skip_rate": float(skipped.mean()),
+                "gt_skipped": int(num_gt[skipped].sum()),
+                "recall_loss": float(detected[skipped].sum() / max(detected.sum(), 1)),
+            }
+        )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-file", required=True, metavar="FILE")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[round(0.05 * i, 2) for i in range(1, 20)])
+    parser.add_argument("--max-recall-loss", type=float, default=0.005, help="for the suggested threshold")
+    parser.add_argument("--iou-threshold", type=float, default=0.5, help="to count an object as detected")
+    parser.add_argument("--min-score", type=float, default=0.0, help="score of the detections that count")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("opts", default=[], nargs=argparse.REMAINDER, help="modify config options")
+    args = parser.parse_args()
+
+    setup_logger(name="cotdet")
+    cfg = setup(args)
+    assert cfg.MODEL.CoTDet.TEST.INSTANCE_ON and cfg.MODEL.CoTDet.TWO_STAGE
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    samples = []
+    for dataset_name in cfg.DATASETS.TEST:
+        # the multi-task datasets have one record per image, not per task
+        if "task_ids" in DatasetCatalog.get(dataset_name)[0]:
+            logger.info("Skipping the multi-task dataset {}".format(dataset_name))
+            continue
+        samples += collect(cfg, model, dataset_name, args.iou_threshold, args.min_score)
+    rows = sweep(samples, sorted(args.thresholds))
+
+    lines = ["{:>10}{:>12}{:>12}{:>14}".format("threshold", "skip rate", "GT skipped", "recall loss")]
+    lines += [
+        "{:>10.2f}{:>11.1%}{:>12}{:>13.2%}".format(r["threshold"], r["skip_rate"], r["gt_skipped"], r["recall_loss"])
+        for r in rows
+    ]
+    logger.info("Relevance gate over {} images:\n".format(len(samples)) + "\n".join(lines))
+    within = [r for r in rows if r["recall_loss"] <= args.max_recall_loss]
+    suggested = within[-1]["threshold"] if within else 0.0
+    logger.info(
+        "Suggested MODEL.CoTDet.TEST.RELEVANCE_THRESHOLD for a recall loss of at most {:.2%}: {}".format(
+            args.max_recall_loss, suggested
+        )
+    )
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "num_images": len(samples),
+                    "max_recall_loss": args.max_recall_loss,
+                    "suggested_threshold": suggested,
+                    "thresholds": rows,
+                },
+                f,
+                indent=2,
+            )
+        logger.info("Wrote the results to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Write registered datasets into tar shards that can be streamed with DATASETS.TRAIN_TAR_SHARDS.
+
+Run it from the root of the repository, e.g.
+    python tools/convert_to_tar_shards.py --datasets coco_task_train --output shards/coco-task-%06d.tar
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.data import get_detection_dataset_dicts
+from detectron2.utils.logger import setup_logger
+
+import cotdet  # noqa: F401, register the datasets
+from cotdet.data.tar_dataset import write_tar_shards
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--datasets", nargs="+", required=True, help="names of registered datasets")
+    parser.add_argument("--output", required=True, help="path pattern of the shards, e.g. shards/%%06d.tar")
+    parser.add_argument("--samples-per-shard", type=int, default=1000)
+    args = parser.parse_args()
+
+    logger = setup_logger(name="cotdet")
+    dataset_dicts = get_detection_dataset_dicts(args.datasets, filter_empty=True)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    paths = write_tar_shards(dataset_dicts, args.output, args.samples_per_shard)
+    logger.info("Wrote {} records into {} shards".format(len(dataset_dicts), len(paths)))
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
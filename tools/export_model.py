@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright (c) IDEA, Inc. and its affiliates.
+"""
+Export the instance inference of CoTDet to TorchScript or ONNX by tracing
+:class:`cotdet.export.CoTDetDeployModel` with :class:`detectron2.export.TracingAdapter`, on the
+first batch of the first test dataset. The exported graph takes the normalized padded images and
+the task ids and returns the top-k scores, classes, boxes and mask logits of every image, the
+Python stages before and after it are `CoTDetDeployModel.preprocess` and `postprocess`. The graph
+is traced for the size of the sample images.
+
+Run it from the root of the repository, e.g.
+    python tools/export_model.py --config-file configs/COCOTASK_R50.yaml --format torchscript \\
+        --output exported MODEL.WEIGHTS model.pth
+    python tools/export_model.py --config-file configs/COCOTASK_R50.yaml --format onnx \\
+        --output exported MODEL.WEIGHTS model.pth MODEL.DEVICE cpu
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.export import TracingAdapter, dump_torchscript_IR
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+from cotdet import add_maskformer2_config
+from cotdet.export import CoTDetDeployModel, OUTPUT_NAMES, pytorch_deformable_attention
+
+logger = logging.getLogger("cotdet")
+
+ONNX_OPSET_VERSION = 16  # GridSample of the deformable attention
+
+
+def setup(args):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    return cfg
+
+
+def max_score_diff(outputs, references):
+    # the top-k of the traced graph may come in another order
+    return (outputs[0].sort(1)[0] - references[0].sort(1)[0]).abs().max().item()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-file", required=True, metavar="FILE")
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--output", required=True, help="output directory")
+    parser.add_argument("opts", default=[], nargs=argparse.REMAINDER, help="modify config options")
+    args = parser.parse_args()
+
+    setup_logger(name="cotdet")
+    setup_logger(name="detectron2")
+    cfg = setup(args)
+    from train_net import Trainer
+
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    deploy_model = CoTDetDeployModel(model)
+
+    batched_inputs = next(iter(Trainer.build_test_loader(cfg, cfg.DATASETS.TEST[0])))
+    images, task_ids, _ = deploy_model.preprocess(batched_inputs)
+    traceable_model = TracingAdapter(deploy_model, (images, task_ids))
+    os.makedirs(args.output, exist_ok=True)
+    with torch.no_grad():
+        if args.format == "torchscript":
+            with pytorch_deformable_attention(model):
+                ts_model = torch.jit.trace(traceable_model, (images, task_ids))
+            path = os.path.join(args.output, "model.ts")
+            torch.jit.save(ts_model, path)
+            dump_torchscript_IR(ts_model, args.output)
+            # the reference runs the compiled deformable attention, when the model has it
+            diff = max_score_diff(ts_model(images, task_ids), deploy_model(images, task_ids))
+            logger.info("Max difference of the scores of the traced model: {:.2e}".format(diff))
+        else:
+            path = os.path.join(args.output, "model.onnx")
+            with pytorch_deformable_attention(model):
+                torch.onnx.export(
+                    traceable_model,
+                    (images, task_ids),
+                    path,
+                    input_names=["images", "task_ids"],
+                    output_names=list(OUTPUT_NAMES),
+                    opset_version=ONNX_OPSET_VERSION,
+                )
+    logger.info("Exported the model for inputs of shape {} to {}".format(tuple(images.shape), path))
+    logger.info("Outputs: {}".format(", ".join(OUTPUT_NAMES)))
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
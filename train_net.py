@@ -11,9 +11,13 @@ This script is based on Mask2Former.
 
 import copy
 import itertools
+import logging
 import os
+import time
+from collections import Counter
 from typing import Any, Dict, List, Set
 import torch
+from torch.nn.parallel import DistributedDataParallel
 import detectron2.utils.comm as comm
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
@@ -22,6 +26,7 @@ from detectron2.engine import (
     DefaultTrainer,
     default_argument_parser,
     default_setup,
+    hooks,
     launch,
 )
 from detectron2.evaluation import (
@@ -30,13 +35,27 @@ from detectron2.evaluation import (
     verify_results,
 )
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
-from detectron2.solver.build import maybe_add_gradient_clipping
+from detectron2.solver.build import maybe_add_gradient_clipping, reduce_param_groups
+from detectron2.utils.events import get_event_storage
 from detectron2.utils.logger import setup_logger
 
 # MaskFormer
 from cotdet import (
     add_maskformer2_config,
-    COCOTaskDatasetMapper
+    COCOTaskDatasetMapper,
+    MultiTaskEvaluator,
+    DatasetOrderEvaluator,
+    AsyncEvalHook,
+    build_bucketed_test_loader,
+    TarShardDataset,
+    DataStageTimingHook,
+    AsyncCheckpointer,
+    ModuleTimer,
+    ModuleTimingHook,
+    instrument_cotdet,
+    quantize_cotdet,
+    CoTDetWithTiling,
+    CoTDetDistiller,
 )
 import random
 from detectron2.engine import (
@@ -69,20 +88,92 @@ class Trainer(DefaultTrainer):
 
         if evaluator_type == "coco_task":
             evaluator_list.append(COCOEvaluator(dataset_name, output_dir=output_folder))
+        if evaluator_type == "coco_task_multi":
+            evaluator_list.append(MultiTaskEvaluator(dataset_name, output_dir=output_folder))
 
+        if cfg.TEST.BUCKETED_BATCHING.ENABLED:
+            # the bucketed test loader does not follow the dataset order
+            return DatasetOrderEvaluator(DatasetEvaluators(evaluator_list), dataset_name)
         return DatasetEvaluators(evaluator_list)
 
+    @classmethod
+    def test(cls, cfg, model, evaluators=None):
+        if cfg.MODEL.CoTDet.TEST.TILING.ENABLED:
+            results = super().test(cfg, CoTDetWithTiling(cfg, model), evaluators=evaluators)
+        else:
+            results = super().test(cfg, model, evaluators=evaluators)
+        if cfg.MODEL.CoTDet.TEST.EARLY_EXIT.ENABLED:
+            log_exit_depths(model)
+        return results
+
+    @classmethod
+    def build_test_loader(cls, cfg, dataset_name):
+        if cfg.TEST.BUCKETED_BATCHING.ENABLED:
+            return build_bucketed_test_loader(cfg, dataset_name)
+        return super().build_test_loader(cfg, dataset_name)
+
     @classmethod
     def build_train_loader(cls, cfg):
         # Semantic segmentation dataset mapper
 
         if cfg.INPUT.DATASET_MAPPER_NAME == "coco_task":
             mapper = COCOTaskDatasetMapper(cfg, True)
-            return build_detection_train_loader(cfg, mapper=mapper)
+            if cfg.DATASETS.TRAIN_TAR_SHARDS:
+                dataset = TarShardDataset(
+                    cfg.DATASETS.TRAIN_TAR_SHARDS, shuffle_buffer_size=cfg.DATALOADER.SHUFFLE_BUFFER_SIZE
+                )
+                data_loader = build_detection_train_loader(cfg, mapper=mapper, dataset=dataset)
+            else:
+                data_loader = build_detection_train_loader(cfg, mapper=mapper)
+            # read by the DataStageTimingHook
+            data_loader.stage_timer = mapper.stage_timer
+            return data_loader
         else:
             mapper = None
             return build_detection_train_loader(cfg, mapper=mapper)
 
+    def build_hooks(self):
+        if self.cfg.SOLVER.ASYNC_CHECKPOINT:
+            # replace the checkpointer before the PeriodicCheckpointer gets it
+            self.checkpointer = AsyncCheckpointer(
+                self.checkpointer.model, self.cfg.OUTPUT_DIR, **self.checkpointer.checkpointables
+            )
+        ret = super().build_hooks()
+        stage_timer = getattr(self.data_loader, "stage_timer", None)
+        if stage_timer is not None:
+            # right after IterationTimer, so that the writers see the stage times
+            ret.insert(1, DataStageTimingHook(stage_timer))
+        timing_cfg = self.cfg.SOLVER.MODULE_TIMING
+        if timing_cfg.ENABLED:
+            timer = ModuleTimer(sync_cuda=timing_cfg.SYNC_CUDA, track_memory=timing_cfg.MEMORY)
+            instrument_cotdet(timer, self.model)
+            # before the writers, like the DataStageTimingHook
+            ret.insert(1, ModuleTimingHook(timer, timing_cfg.PERIOD))
+        if self.cfg.TEST.ASYNC_EVAL.ENABLED:
+            # evaluate in the background on the main process instead of stopping all ranks
+            eval_idx = [i for i, h in enumerate(ret) if isinstance(h, hooks.EvalHook)][0]
+            ret.pop(eval_idx)
+            if comm.is_main_process():
+                async_cfg = self.cfg.TEST.ASYNC_EVAL
+                ret.insert(eval_idx, AsyncEvalHook(
+                    self.cfg.TEST.EVAL_PERIOD,
+                    evaluate_snapshot,
+                    self.cfg,
+                    self.cfg.OUTPUT_DIR,
+                    max_in_flight=async_cfg.MAX_IN_FLIGHT,
+                    val_metric=async_cfg.BEST_METRIC,
+                    mode=async_cfg.BEST_MODE,
+                ))
+        return ret
+
+    def train(self):
+        try:
+            return super().train()
+        finally:
+            if isinstance(self.checkpointer, AsyncCheckpointer):
+                # the last checkpoint may still be written in the background
+                self.checkpointer.wait()
+
     @classmethod
     def build_lr_scheduler(cls, cfg, optimizer):
         """
@@ -139,6 +230,10 @@ class Trainer(DefaultTrainer):
                 if isinstance(module, torch.nn.Embedding):
                     hyperparams["weight_decay"] = weight_decay_embed
                 params.append({"params": [value], **hyperparams})
+        # merge the parameters with the same hyperparams into a few groups,
+        # so that the multi-tensor (foreach) kernels can update them together
+        params = reduce_param_groups(params)
+        logging.getLogger("detectron2").info("Optimizer: {} parameter groups".format(len(params)))
 
         def maybe_add_full_model_gradient_clipping(optim):
             # detectron2 doesn't have full model gradient clipping now
@@ -151,20 +246,39 @@ class Trainer(DefaultTrainer):
 
             class FullModelGradientClippingOptimizer(optim):
                 def step(self, closure=None):
-                    all_params = itertools.chain(*[x["params"] for x in self.param_groups])
-                    torch.nn.utils.clip_grad_norm_(all_params, clip_norm_val)
+                    if getattr(self, "_all_params", None) is None:
+                        self._all_params = list(itertools.chain(*[x["params"] for x in self.param_groups]))
+                    torch.nn.utils.clip_grad_norm_(self._all_params, clip_norm_val, foreach=True)
                     super().step(closure=closure)
 
             return FullModelGradientClippingOptimizer if enable else optim
 
+        def maybe_add_step_timing(optim):
+            if not cfg.SOLVER.TIME_OPTIMIZER_STEP:
+                return optim
+
+            class StepTimingOptimizer(optim):
+                def step(self, closure=None):
+                    # synchronize so that the kernels of the step are included
+                    device = self.param_groups[0]["params"][0].device
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    start = time.perf_counter()
+                    super().step(closure=closure)
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    get_event_storage().put_scalar("optimizer_time", time.perf_counter() - start)
+
+            return StepTimingOptimizer
+
         optimizer_type = cfg.SOLVER.OPTIMIZER
         if optimizer_type == "SGD":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.SGD)(
-                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM
+            optimizer = maybe_add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.SGD))(
+                params, cfg.SOLVER.BASE_LR, momentum=cfg.SOLVER.MOMENTUM, foreach=True
             )
         elif optimizer_type == "ADAMW":
-            optimizer = maybe_add_full_model_gradient_clipping(torch.optim.AdamW)(
-                params, cfg.SOLVER.BASE_LR
+            optimizer = maybe_add_step_timing(maybe_add_full_model_gradient_clipping(torch.optim.AdamW))(
+                params, cfg.SOLVER.BASE_LR, foreach=True
             )
         else:
             raise NotImplementedError(f"no optimizer type {optimizer_type}")
@@ -172,6 +286,43 @@ class Trainer(DefaultTrainer):
             optimizer = maybe_add_gradient_clipping(cfg, optimizer)
         return optimizer
 
+
+def log_exit_depths(model):
+    """
+    Log the histogram of the number of decoder layers run per batch with the early exit, which
+    is decided for the whole batch, over all the processes, and reset it.
+    """
+    if isinstance(model, DistributedDataParallel):
+        model = model.module
+    decoder = model.sem_seg_head.predictor.decoder
+    depths = sum(comm.all_gather(decoder.batch_exit_depths), Counter())
+    decoder.batch_exit_depths.clear()
+    if not comm.is_main_process() or not depths:
+        return
+    total = sum(depths.values())
+    lines = ["{:>8}{:>10}{:>8}".format("layers", "batches", "share")]
+    lines += ["{:>8}{:>10}{:>7.1f}%".format(d, n, n / total * 100) for d, n in sorted(depths.items())]
+    mean = sum(d * n for d, n in depths.items()) / total
+    logging.getLogger("detectron2").info(
+        "Decoder early exit per batch, {:.2f} of {} layers on average:\n".format(mean, decoder.num_layers)
+        + "\n".join(lines)
+    )
+
+
+def evaluate_snapshot(cfg, weights):
+    """
+    Evaluate a snapshot of the weights in a process of the AsyncEvalHook.
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DEVICE = cfg.TEST.ASYNC_EVAL.DEVICE
+    cfg.freeze()
+    setup_logger(output=os.path.join(cfg.OUTPUT_DIR, "async_eval"), name="detectron2")
+    model = Trainer.build_model(cfg)
+    DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).load(weights)
+    return Trainer.test(cfg, model)
+
+
 def setup(args):
     """
     Create configs and perform basic setups.
@@ -194,13 +345,18 @@ def main(args):
     print("Command cfg:", cfg)
     if args.eval_only:
         model = Trainer.build_model(cfg)
-        DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
+        # also reads the sharded checkpoints of SOLVER.ASYNC_CHECKPOINT
+        AsyncCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
-        checkpointer = DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR)
+        checkpointer = AsyncCheckpointer(model, save_dir=cfg.OUTPUT_DIR)
         checkpointer.resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume
         )
+        quantization = cfg.MODEL.CoTDet.TEST.QUANTIZATION
+        if quantization.ENABLED:
+            assert cfg.MODEL.DEVICE == "cpu", "the dynamic INT8 quantization only runs on CPU"
+            quantize_cotdet(model, quantization.MODULES, quantization.EXCLUDE)
         res = Trainer.test(cfg, model)
 
         if comm.is_main_process():
@@ -208,6 +364,9 @@ def main(args):
         return res
 
     trainer = Trainer(cfg)
+    if cfg.MODEL.CoTDet.DISTILLATION.ENABLED:
+        student = trainer.model.module if isinstance(trainer.model, DistributedDataParallel) else trainer.model
+        student.distiller = CoTDetDistiller(cfg, student)
     trainer.resume_or_load(resume=args.resume)
     return trainer.train()
 